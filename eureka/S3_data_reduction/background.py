@@ -3,6 +3,7 @@ from tqdm import tqdm
 import ccdproc as ccdp
 from astropy import units
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
 import matplotlib.pyplot as plt
 from astropy.nddata import CCDData
 from astropy.stats import SigmaClip
@@ -10,12 +11,14 @@ from photutils import MMMBackground, MedianBackground, Background2D
 import os
 
 from ..lib import clipping
+from ..lib import readECF
+from ..lib import maskflags
 from ..lib.plots import figure_filetype
 
-__all__ = ['BGsubtraction', 'fitbg', 'fitbg2', 'fitbg3']
+__all__ = ['BGsubtraction', 'BGPool', 'fitbg', 'fitbg2', 'fitbg3']
 
 
-def BGsubtraction(data, meta, log, isplots):
+def BGsubtraction(data, meta, log, isplots, pool=None):
     """Does background subtraction using inst.fit_bg & background.fitbg
 
     Parameters
@@ -29,6 +32,10 @@ def BGsubtraction(data, meta, log, isplots):
         The open log in which notes from this step can be added.
     isplots : int
         The amount of plots saved; set in ecf.
+    pool : eureka.S3_data_reduction.background.BGPool; optional
+        A persistent pool of workers to use when meta.ncpu > 1. Defaults
+        to None, in which case a new pool is started (and closed) for
+        this call.
 
     Returns
     -------
@@ -62,13 +69,13 @@ def BGsubtraction(data, meta, log, isplots):
     def writeBG(arg):
         bg_data, bg_mask, n = arg
         data['bg'][n] = bg_data
-        data['mask'][n] = bg_mask
+        maskflags.update(data['mask'].values[n], bg_mask, maskflags.BG_FIT)
         return
 
     def writeBG_WFC3(arg):
         bg_data, bg_mask, datav0, datavariance, n = arg
         data['bg'][n] = bg_data
-        data['mask'][n] = bg_mask
+        maskflags.update(data['mask'].values[n], bg_mask, maskflags.BG_FIT)
         data['v0'][n] = datav0
         data['variance'][n] = datavariance
         return
@@ -76,11 +83,24 @@ def BGsubtraction(data, meta, log, isplots):
     # Compute background for each integration
     log.writelog('  Performing background subtraction',
                  mute=(not meta.verbose))
-    data['bg'] = (['time', 'y', 'x'], np.zeros(data.flux.shape))
+    data['bg'] = (['time', 'y', 'x'], np.zeros(data.flux.shape,
+                                               dtype=meta.precision))
     data['bg'].attrs['flux_units'] = data['flux'].attrs['flux_units']
+    # The column fits are vectorized over integrations, so split the
+    # integrations into chunks which limit the size of the temporary arrays
+    # while still giving every CPU some work
+    ny, nx = data.flux.shape[1:]
+    chunk = max(1, 2**20//(ny*nx))
+    chunk = max(1, min(chunk, -(-(meta.n_int-meta.int_start)//meta.ncpu)))
+    intslices = [slice(n, min(n+chunk, meta.n_int))
+                 for n in range(meta.int_start, meta.n_int, chunk)]
     if meta.ncpu == 1:
         # Only 1 CPU
-        iterfn = range(meta.int_start, meta.n_int)
+        if meta.inst in ['niriss', 'wfc3']:
+            iterfn = range(meta.int_start, meta.n_int)
+        else:
+            # Fit several integrations at once
+            iterfn = intslices
         if meta.verbose:
             iterfn = tqdm(iterfn)
         for n in iterfn:
@@ -89,49 +109,54 @@ def BGsubtraction(data, meta, log, isplots):
                 writeBG(inst.fit_bg(data, meta, n, isplots))
             elif meta.inst == 'wfc3':
                 writeBG_WFC3(inst.fit_bg(data.flux[n].values,
-                                         data.mask[n].values,
+                                         maskflags.good(data.mask[n].values),
                                          data.v0[n].values,
                                          data.variance[n].values,
                                          n, meta, isplots))
             else:
-                writeBG(inst.fit_bg(data.flux[n].values, data.mask[n].values,
+                writeBG(inst.fit_bg(data.flux[n].values,
+                                    maskflags.good(data.mask[n].values),
                                     n, meta, isplots))
     else:
         # Multiple CPUs
-        pool = mp.Pool(meta.ncpu)
-        args_list = []
+        if pool is None:
+            # Only use a pool for this segment
+            bgpool = BGPool(meta.ncpu)
+        else:
+            bgpool = pool
 
         # Todo, convert NIRISS fit_bg to only accept individual frames
         # (see nircam and below for example)
         if meta.inst == 'niriss':
-            for n in range(meta.int_start, meta.n_int):
-                args_list.append((data, meta, n, isplots))
-            jobs = [pool.apply_async(func=inst.fit_bg, args=(*args,),
-                                     callback=writeBG) for args in args_list]
+            jobs = [bgpool.pool.apply_async(func=inst.fit_bg,
+                                            args=(data, meta, n, isplots,),
+                                            callback=writeBG)
+                    for n in range(meta.int_start, meta.n_int)]
         elif meta.inst == 'wfc3':
             # The WFC3 background subtraction needs a few more inputs
-            # and outputs
-            jobs = [pool.apply_async(func=inst.fit_bg,
-                                     args=(data.flux[n].values,
-                                           data.mask[n].values,
-                                           data.v0[n].values,
-                                           data.variance[n].values, n, meta,
-                                           isplots,),
-                                     callback=writeBG_WFC3)
+            # and outputs, as well as the full metadata object
+            jobs = [bgpool.pool.apply_async(func=inst.fit_bg,
+                                            args=(data.flux[n].values,
+                                                  maskflags.good(
+                                                      data.mask[n].values),
+                                                  data.v0[n].values,
+                                                  data.variance[n].values,
+                                                  n, meta, isplots,),
+                                            callback=writeBG_WFC3)
                     for n in range(meta.int_start, meta.n_int)]
         else:
-            jobs = [pool.apply_async(func=inst.fit_bg,
-                                     args=(data.flux[n].values,
-                                           data.mask[n].values,
-                                           n, meta, isplots,),
-                                     callback=writeBG)
-                    for n in range(meta.int_start, meta.n_int)]
-        pool.close()
+            # The workers read and write the frames in shared memory
+            jobs = bgpool.fit_bg(inst.fit_bg, data, meta, intslices,
+                                 isplots)
         iterfn = jobs
         if meta.verbose:
             iterfn = tqdm(iterfn)
         for job in iterfn:
             job.get()
+        if meta.inst not in ['niriss', 'wfc3']:
+            bgpool.collect(data)
+        if pool is None:
+            bgpool.close()
 
     # 9.  Background subtraction
     # Perform background subtraction
@@ -140,14 +165,204 @@ def BGsubtraction(data, meta, log, isplots):
     return data
 
 
+# The only metadata needed by the nircam-style fit_bg functions
+BGPOOL_META_KEYS = ['inst', 'bg_y1', 'bg_y2', 'bg_deg', 'p3thresh',
+                    'outputdir']
+
+# Shared memory blocks that a worker process is currently attached to
+shared_buffers = {}
+
+
+class BGPool:
+    """A persistent pool of workers for background subtraction.
+
+    The frames, masks, and fitted backgrounds are exchanged with the workers
+    through shared memory blocks instead of being pickled for every
+    integration. Both the worker processes and the shared memory blocks
+    are reused for every segment (and aperture/annulus pair) which is
+    passed to BGsubtraction, and the blocks are only reallocated when a
+    segment is larger than any seen before.
+    """
+
+    def __init__(self, ncpu):
+        """Start the worker processes.
+
+        Parameters
+        ----------
+        ncpu : int
+            The number of worker processes.
+        """
+        self.ncpu = ncpu
+        # Start the resource tracker before the workers so that they share
+        # it and do not try to clean up the shared memory blocks themselves
+        resource_tracker.ensure_running()
+        self.pool = mp.Pool(ncpu)
+        self.buffers = {}
+        self.arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def array(self, key, shape, dtype):
+        """Get an array of the requested shape in a shared memory block.
+
+        Parameters
+        ----------
+        key : str
+            The name of the array (e.g. 'flux').
+        shape : tuple
+            The shape of the array.
+        dtype : numpy.dtype
+            The data type of the array.
+
+        Returns
+        -------
+        ndarray
+            An array backed by shared memory.
+        tuple
+            The (block name, shape, dtype) needed to attach to the array
+            from another process.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(shape))*dtype.itemsize)
+        shm = self.buffers.get(key)
+        if shm is None or shm.size < nbytes:
+            if shm is not None:
+                # Release the old, smaller block
+                self.arrays.pop(key, None)
+                shm.close()
+                shm.unlink()
+            shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.buffers[key] = shm
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self.arrays[key] = arr
+        return arr, (shm.name, shape, dtype.str)
+
+    def fit_bg(self, func, data, meta, intslices, isplots=0):
+        """Submit the background fits for one segment to the workers.
+
+        Parameters
+        ----------
+        func : function
+            The instrument's fit_bg function (e.g. nircam.fit_bg).
+        data : Xarray Dataset
+            Dataset object containing the flux and mask arrays.
+        meta : eureka.lib.readECF.MetaClass
+            The metadata object.
+        intslices : list
+            The slices of integrations handed to each job.
+        isplots : int; optional
+            The amount of plots saved; set in ecf. Default is 0.
+
+        Returns
+        -------
+        list
+            The multiprocessing.pool.AsyncResult objects of the jobs. Once
+            they have finished, call collect to copy the results into data.
+        """
+        flux, fluxinfo = self.array('flux', data.flux.shape, data.flux.dtype)
+        mask, maskinfo = self.array('mask', data.flux.shape, bool)
+        bg, bginfo = self.array('bg', data.flux.shape, data.bg.dtype)
+        flux[:] = data.flux.values
+        mask[:] = maskflags.good(data.mask.values)
+        bg[:] = 0
+        # Only send the few settings which are needed to the workers
+        bgmeta = readECF.MetaClass(**{key: getattr(meta, key)
+                                      for key in BGPOOL_META_KEYS
+                                      if hasattr(meta, key)})
+        return [self.pool.apply_async(func=fit_bg_shared,
+                                      args=(func, fluxinfo, maskinfo, bginfo,
+                                            n, bgmeta, isplots))
+                for n in intslices]
+
+    def collect(self, data):
+        """Copy the fitted backgrounds and updated masks into data.
+
+        Parameters
+        ----------
+        data : Xarray Dataset
+            Dataset object which was passed to fit_bg.
+        """
+        data['bg'][:] = self.arrays.pop('bg')
+        maskflags.update(data['mask'].values, self.arrays.pop('mask'),
+                         maskflags.BG_FIT)
+        self.arrays.pop('flux', None)
+
+    def close(self):
+        """Stop the worker processes and free the shared memory."""
+        self.pool.close()
+        self.pool.join()
+        self.arrays = {}
+        for shm in self.buffers.values():
+            shm.close()
+            shm.unlink()
+        self.buffers = {}
+
+
+def attach_shared(info):
+    """Attach to an array held in shared memory by a BGPool.
+
+    Parameters
+    ----------
+    info : tuple
+        The (block name, shape, dtype) of the array.
+
+    Returns
+    -------
+    ndarray
+        The shared array.
+    """
+    name, shape, dtype = info
+    if name not in shared_buffers:
+        shared_buffers[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shared_buffers[name].buf)
+
+
+def fit_bg_shared(func, fluxinfo, maskinfo, bginfo, n, meta, isplots=0):
+    """Run an instrument's fit_bg on frames held in shared memory.
+
+    Parameters
+    ----------
+    func : function
+        The instrument's fit_bg function (e.g. nircam.fit_bg).
+    fluxinfo : tuple
+        The (block name, shape, dtype) of the shared flux array.
+    maskinfo : tuple
+        The (block name, shape, dtype) of the shared mask array.
+    bginfo : tuple
+        The (block name, shape, dtype) of the shared background array.
+    n : int or slice
+        The integration(s) to fit.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    isplots : int; optional
+        The amount of plots saved; set in ecf. Default is 0.
+    """
+    # Forget blocks which the pool has since released
+    for name in list(shared_buffers):
+        if name not in [fluxinfo[0], maskinfo[0], bginfo[0]]:
+            shared_buffers.pop(name).close()
+    flux = attach_shared(fluxinfo)
+    mask = attach_shared(maskinfo)
+    bg = attach_shared(bginfo)
+    bg[n], mask[n], _ = func(flux[n], mask[n], n, meta, isplots)
+
+
 def fitbg(dataim, meta, mask, x1, x2, deg=1, threshold=5, isrotate=False,
           isplots=0):
     '''Fit sky background with out-of-spectra data.
 
+    The polynomial fits for every column (and every integration, if given
+    a 3D array) are solved at once using masked normal equations, and
+    outliers are rejected from all columns simultaneously on each pass.
+
     Parameters
     ----------
     dataim : ndarray
-        The data array.
+        The data array with shape (ny, nx) or (n_int, ny, nx).
     meta : eureka.lib.readECF.MetaClass
         The metadata object.
     mask : ndarray
@@ -177,106 +392,121 @@ def fitbg(dataim, meta, mask, x1, x2, deg=1, threshold=5, isrotate=False,
     # Assume x is the spatial direction and y is the wavelength direction
     # Otherwise, rotate array
     if isrotate == 1:
-        dataim = dataim[::-1].T
-        mask = mask[::-1].T
+        dataim = np.swapaxes(dataim[..., ::-1, :], -1, -2)
+        mask = np.swapaxes(mask[..., ::-1, :], -1, -2)
     elif isrotate == 2:
-        dataim = dataim.T
-        mask = mask.T
+        dataim = np.swapaxes(dataim, -1, -2)
+        mask = np.swapaxes(mask, -1, -2)
 
     # Convert x1 and x2 to array, if need be
-    ny, nx = np.shape(dataim)
+    shape = np.shape(dataim)
+    ny, nx = shape[-2:]
     if type(x1) == int or type(x1) == np.int64:
         x1 = np.zeros(ny, dtype=int)+x1
     if type(x2) == int or type(x2) == np.int64:
         x2 = np.zeros(ny, dtype=int)+x2
 
-    if deg < 0:
+    if deg is None:
+        # No background subtraction
+        bg = np.zeros(shape)
+    elif deg < 0:
         # Calculate median background of entire frame
         # Assumes all x1 and x2 values are the same
-        submask = np.concatenate((mask[:, :x1[0]].T, mask[:, x2[0]+1:nx].T)).T
-        subdata = np.concatenate((dataim[:, :x1[0]].T,
-                                  dataim[:, x2[0]+1:nx].T)).T
-        bg = np.zeros((ny, nx)) + np.median(subdata[np.where(submask)])
-    elif deg is None:
-        # No background subtraction
-        bg = np.zeros((ny, nx))
+        submask = np.concatenate((mask[..., :x1[0]], mask[..., x2[0]+1:nx]),
+                                 axis=-1)
+        subdata = np.concatenate((dataim[..., :x1[0]],
+                                  dataim[..., x2[0]+1:nx]), axis=-1)
+        if len(shape) == 2:
+            bg = np.zeros(shape) + np.median(subdata[np.where(submask)])
+        else:
+            bg = np.zeros(shape)
+            for n in range(shape[0]):
+                bg[n] += np.median(subdata[n][np.where(submask[n])])
     else:
-        degs = np.ones(ny)*deg
-        # Initiate background image with zeros
-        bg = np.zeros((ny, nx))
-        # Fit polynomial to each column
-        for j in range(ny):
-            nobadpixels = False
-            # Create x indices for background sections of frame
-            xvals = np.concatenate((range(x1[j]),
-                                    range(x2[j]+1, nx))).astype(int)
-            # If too few good pixels then average
-            too_few_pix = (np.sum(mask[j, :x1[j]]) < deg
-                           or np.sum(mask[j, x2[j]+1:nx]) < deg)
-            if too_few_pix:
-                degs[j] = 0
-            while not nobadpixels:
-                try:
-                    goodxvals = xvals[np.where(mask[j, xvals])]
-                except:
-                    # FINDME: Need to change this except to only catch the
-                    # specific type of exception we expect
-                    print("****Warning: Background subtraction failed!****")
-                    print(j)
-                    print(xvals)
-                    print(np.where(mask[j, xvals]))
-                    return
-                dataslice = dataim[j, goodxvals]
-                # Check for at least 1 good x value
-                if len(goodxvals) == 0:
-                    nobadpixels = True  # exit while loop
-                    # Use coefficients from previous row
-                else:
-                    # Fit along spatial direction with a polynomial of
-                    # degree 'deg'
-                    coeffs = np.polyfit(goodxvals, dataslice, deg=degs[j])
-                    # Evaluate model at goodexvals
-                    model = np.polyval(coeffs, goodxvals)
-                    # Calculate residuals and number of sigma from the model
-                    residuals = dataslice - model
-                    # Simple standard deviation (faster but prone to missing
-                    # scanned background stars)
-                    # stdres = np.std(residuals)
-                    # Median Absolute Deviation (slower but more robust)
-                    # stdres  = np.median(np.abs(np.ediff1d(residuals)))
-                    # Mean Absolute Deviation (good comprimise)
-                    stdres = np.mean(np.abs(np.ediff1d(residuals)))
-                    if stdres == 0:
-                        stdres = np.inf
-                    stdevs = np.abs(residuals) / stdres
-                    # Find worst data point
-                    loc = np.argmax(stdevs)
-                    # Mask data point if > threshold
-                    if stdevs[loc] > threshold:
-                        mask[j, goodxvals[loc]] = 0
-                    else:
-                        nobadpixels = True  # exit while loop
-
-            # Evaluate background model at all points, write model to
-            # background image
-            if len(goodxvals) != 0:
-                bg[j] = np.polyval(coeffs, range(nx))
-                if isplots >= 6:
-                    plt.figure(3601)
-                    plt.clf()
-                    plt.title(str(j))
-                    plt.plot(goodxvals, dataslice, 'bo')
-                    plt.plot(range(nx), bg[j], 'g-')
-                    fname = 'figs'+os.sep+'Fig6_BG_'+str(j)+figure_filetype
-                    plt.savefig(meta.outputdir + fname, dpi=300)
-                    plt.pause(0.01)
+        # Work on one row of the (rotated) frame at a time, stacking all
+        # integrations together
+        rowdata = np.reshape(dataim, (-1, nx))
+        rowmask = np.reshape(np.copy(mask), (-1, nx))
+        nrows = rowdata.shape[0]
+        xvals = np.arange(nx)
+        x1 = np.tile(x1, nrows//ny)
+        x2 = np.tile(x2, nrows//ny)
+        # Background sections of frame
+        inbg = ((xvals < x1[:, np.newaxis]) | (xvals > x2[:, np.newaxis]))
+        # If too few good pixels then average
+        too_few_pix = ((np.sum(rowmask*(xvals < x1[:, np.newaxis]), axis=1)
+                        < deg) |
+                       (np.sum(rowmask*(xvals > x2[:, np.newaxis]), axis=1)
+                        < deg))
+        # Use a scaled abscissa to keep the normal equations well
+        # conditioned
+        half = max(nx-1, 1)/2
+        vander = np.vander((xvals-half)/half, deg+1, increasing=True)
+        coeffs = np.zeros((nrows, deg+1))
+        bg = np.zeros((nrows, nx))
+        active = np.where(np.any(inbg & (rowmask != 0), axis=1))[0]
+        while len(active) > 0:
+            good = inbg[active] & (rowmask[active] != 0)
+            weights = good.astype(float)
+            dataslice = np.where(good, rowdata[active], 0)
+            # Fit along spatial direction with a polynomial of degree 'deg'
+            # (or 0 for rows with too few pixels) using the normal equations
+            alpha = np.einsum('rx,xi,xj->rij', weights, vander, vander)
+            beta = dataslice @ vander
+            isavg = too_few_pix[active]
+            alpha[isavg, 1:, :] = 0
+            alpha[isavg, :, 1:] = 0
+            alpha[np.ix_(isavg, np.arange(1, deg+1), np.arange(1, deg+1))] = \
+                np.eye(deg)
+            beta[isavg, 1:] = 0
+            coeffs[active] = (np.linalg.pinv(alpha) @
+                              beta[:, :, np.newaxis])[:, :, 0]
+            model = coeffs[active] @ vander.T
+            # Calculate residuals and number of sigma from the model
+            residuals = np.where(good, dataslice - model, 0)
+            # Mean Absolute Deviation of consecutive good residuals
+            ngood = np.sum(good, axis=1)
+            order = np.argsort(~good, axis=1, kind='stable')
+            packed = np.take_along_axis(residuals, order, axis=1)
+            consecutive = np.arange(1, nx) < ngood[:, np.newaxis]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                stdres = (np.sum(np.abs(np.diff(packed, axis=1))*consecutive,
+                                 axis=1) / (ngood-1))
+            stdres[stdres == 0] = np.inf
+            stdevs = np.where(good, np.abs(residuals), -np.inf)
+            # Find worst data point
+            loc = np.argmax(stdevs, axis=1)
+            with np.errstate(invalid='ignore'):
+                worst = stdevs[np.arange(len(active)), loc] / stdres
+            # Mask data point if > threshold
+            isbad = worst > threshold
+            rowmask[active[isbad], loc[isbad]] = 0
+            active = active[isbad]
+
+        # Evaluate background model at all points, write model to
+        # background image
+        hasfit = np.any(inbg & (np.reshape(mask, (-1, nx)) != 0), axis=1)
+        bg[hasfit] = coeffs[hasfit] @ vander.T
+        if isplots >= 6:
+            for j in np.where(hasfit)[0]:
+                good = inbg[j] & (rowmask[j] != 0)
+                plt.figure(3601)
+                plt.clf()
+                plt.title(str(j % ny))
+                plt.plot(xvals[good], rowdata[j, good], 'bo')
+                plt.plot(range(nx), bg[j], 'g-')
+                fname = 'figs'+os.sep+'Fig6_BG_'+str(j % ny)+figure_filetype
+                plt.savefig(meta.outputdir + fname, dpi=300)
+                plt.pause(0.01)
+        bg = bg.reshape(shape)
+        mask = rowmask.reshape(shape)
 
     if isrotate == 1:
-        bg = (bg.T)[::-1]
-        mask = (mask.T)[::-1]
+        bg = np.swapaxes(bg, -1, -2)[..., ::-1, :]
+        mask = np.swapaxes(mask, -1, -2)[..., ::-1, :]
     elif isrotate == 2:
-        bg = (bg.T)
-        mask = (mask.T)
+        bg = np.swapaxes(bg, -1, -2)
+        mask = np.swapaxes(mask, -1, -2)
 
     return bg, mask
 
@@ -1,9 +1,17 @@
+import os
+import glob
+from functools import lru_cache
 import numpy as np
 import scipy.interpolate as spi
 from scipy.constants import arcsec
 from astropy.io import fits
 import crds
 
+# The reference files found for each set of header keywords. Every segment
+# of a visit uses the same reference files, so each is only looked up once
+# per process.
+_ancil_cache = {}
+
 
 def rate2count(data):
     """This function converts the data, uncertainty, and variance arrays from
@@ -77,23 +85,13 @@ def dn2electrons(data, meta):
     - Apr 20, 2022 Kevin Stevenson
         Convert to using Xarray Dataset
     """
-    # Subarray parameters
-    xstart = data.attrs['mhdr']['SUBSTRT1']
-    ystart = data.attrs['mhdr']['SUBSTRT2']
-    nx = data.attrs['mhdr']['SUBSIZE1']
-    ny = data.attrs['mhdr']['SUBSIZE2']
-
-    # Load gain array in units of e-/ADU
-    gain = fits.getdata(meta.gainfile)[ystart:ystart+ny, xstart:xstart+nx]
-
-    # Like in the case of MIRI data, the gain file data has to be
-    # rotated by 90 degrees
-    if data.attrs['shdr']['DISPAXIS'] == 2:
-        gain = np.swapaxes(gain, 0, 1)
-
-    # Gain subarray
-    subgain = gain[meta.ywindow[0]:meta.ywindow[1],
-                   meta.xwindow[0]:meta.xwindow[1]]
+    # Load the gain array of the subarray window in units of e-/ADU
+    subgain = load_gain(meta.gainfile, data.attrs['mhdr']['SUBSTRT1'],
+                        data.attrs['mhdr']['SUBSTRT2'],
+                        data.attrs['mhdr']['SUBSIZE1'],
+                        data.attrs['mhdr']['SUBSIZE2'],
+                        data.attrs['shdr']['DISPAXIS'],
+                        tuple(meta.ywindow), tuple(meta.xwindow))
 
     # Convert to electrons
     data['flux'] *= subgain
@@ -135,35 +133,26 @@ def bright2dn(data, meta, mjy=False):
     - Apr 20, 2022 Kevin Stevenson
         Convert to using Xarray Dataset
     """
-    # Load response function and wavelength
-    phot = fits.getdata(meta.photfile)
-    if meta.inst == 'nircam':
-        ind = np.where((phot['filter'] == data.attrs['mhdr']['FILTER']) *
-                       (phot['pupil'] == data.attrs['mhdr']['PUPIL']) *
-                       (phot['order'] == 1))[0][0]
+    # The columns and values which select the row of the photom file
+    if meta.inst in ['nircam', 'niriss']:
+        selection = (('filter', data.attrs['mhdr']['FILTER']),
+                     ('pupil', data.attrs['mhdr']['PUPIL']),
+                     ('order', 1))
     elif meta.inst == 'miri':
-        ind = np.where((phot['filter'] == data.attrs['mhdr']['FILTER']) *
-                       (phot['subarray'] == data.attrs['mhdr']['SUBARRAY'])
-                       )[0][0]
+        selection = (('filter', data.attrs['mhdr']['FILTER']),
+                     ('subarray', data.attrs['mhdr']['SUBARRAY']))
     elif meta.inst == 'nirspec':
-        ind = np.where((phot['filter'] == data.attrs['mhdr']['FILTER']) *
-                       (phot['grating'] == data.attrs['mhdr']['GRATING']) *
-                       (phot['slit'] == data.attrs['shdr']['SLTNAME']))[0][0]
-    elif meta.inst == 'niriss':
-        ind = np.where((phot['filter'] == data.attrs['mhdr']['FILTER']) *
-                       (phot['pupil'] == data.attrs['mhdr']['PUPIL']) *
-                       (phot['order'] == 1))[0][0]
+        selection = (('filter', data.attrs['mhdr']['FILTER']),
+                     ('grating', data.attrs['mhdr']['GRATING']),
+                     ('slit', data.attrs['shdr']['SLTNAME']))
     else:
         raise ValueError(f'The bright2dn function has not been edited to '
                          f'handle the instrument {meta.inst}.\nIt can '
                          f'currently only handle JWST niriss, nirspec, nircam,'
                          f' and miri observations.')
 
-    response_wave = phot['wavelength'][ind]
-    response_vals = phot['relresponse'][ind]
-    igood = np.where(response_wave > 0)[0]
-    response_wave = response_wave[igood]
-    response_vals = response_vals[igood]
+    # Load response function and wavelength
+    response_wave, response_vals = load_response(meta.photfile, selection)
     # Interpolate response at desired wavelengths
     f = spi.interp1d(response_wave, response_vals, kind='cubic',
                      bounds_error=False, fill_value='extrapolate')
@@ -271,7 +260,8 @@ def convert_to_e(data, meta, log):
                        'reference files for non-JWST observations!')
             log.writelog(message, mute=True)
             raise ValueError(message)
-        meta.photfile, meta.gainfile = retrieve_ancil(data.attrs['filename'])
+        meta.photfile, meta.gainfile = retrieve_ancil(data.attrs['filename'],
+                                                      meta.ancil_dir)
     else:
         log.writelog('  Converting from electrons per second (e/s) to '
                      'electrons', mute=(not meta.verbose))
@@ -308,17 +298,104 @@ def convert_to_e(data, meta, log):
     return data, meta
 
 
-def retrieve_ancil(fitsname):
+@lru_cache(maxsize=None)
+def load_gain(gainfile, xstart, ystart, nx, ny, dispaxis, ywindow, xwindow):
+    """Loads the gain array of a subarray window.
+
+    The arrays are kept in memory, so the gain file is only read once per
+    process for each subarray window.
+
+    Parameters
+    ----------
+    gainfile : str
+        The full path to the gain calibration file.
+    xstart : int
+        The SUBSTRT1 header keyword.
+    ystart : int
+        The SUBSTRT2 header keyword.
+    nx : int
+        The SUBSIZE1 header keyword.
+    ny : int
+        The SUBSIZE2 header keyword.
+    dispaxis : int
+        The DISPAXIS header keyword.
+    ywindow : tuple
+        The (start, stop) rows of the region of interest.
+    xwindow : tuple
+        The (start, stop) columns of the region of interest.
+
+    Returns
+    -------
+    subgain : ndarray
+        The read-only gain array of the region of interest in units of
+        e-/ADU.
+    """
+    gain = fits.getdata(gainfile)[ystart:ystart+ny, xstart:xstart+nx]
+
+    # Like in the case of MIRI data, the gain file data has to be
+    # rotated by 90 degrees
+    if dispaxis == 2:
+        gain = np.swapaxes(gain, 0, 1)
+
+    # Gain subarray
+    subgain = np.array(gain[ywindow[0]:ywindow[1], xwindow[0]:xwindow[1]])
+    subgain.setflags(write=False)
+    return subgain
+
+
+@lru_cache(maxsize=None)
+def load_response(photfile, selection):
+    """Loads the response function of an instrument mode.
+
+    The response functions are kept in memory, so the photom file is only
+    read once per process for each instrument mode.
+
+    Parameters
+    ----------
+    photfile : str
+        The full path to the photom calibration file.
+    selection : tuple
+        The (column, value) pairs which select the row of the photom file.
+
+    Returns
+    -------
+    response_wave : ndarray
+        The read-only wavelengths of the response function.
+    response_vals : ndarray
+        The read-only values of the response function.
+    """
+    phot = fits.getdata(photfile)
+    isrow = np.ones(len(phot), dtype=bool)
+    for column, value in selection:
+        isrow &= phot[column] == value
+    ind = np.where(isrow)[0][0]
+
+    response_wave = phot['wavelength'][ind]
+    response_vals = phot['relresponse'][ind]
+    igood = np.where(response_wave > 0)[0]
+    response_wave = np.array(response_wave[igood])
+    response_vals = np.array(response_vals[igood])
+    response_wave.setflags(write=False)
+    response_vals.setflags(write=False)
+    return response_wave, response_vals
+
+
+def retrieve_ancil(fitsname, ancil_dir=None):
     '''Use crds package to find/download the needed ancilliary files.
 
     This code requires that the CRDS_PATH and CRDS_SERVER_URL environment
     variables be set in your .bashrc file (or equivalent, e.g.
-    .bash_profile or .zshrc)
+    .bash_profile or .zshrc), unless ancil_dir is given. The files found
+    for each set of header keywords are remembered, so CRDS is only asked
+    once per process for all the segments of a visit.
 
     Parameters
     ----------
     fitsname : str
         The filename of the file currently being analyzed.
+    ancil_dir : str; optional
+        A directory of reference files to search instead of using CRDS,
+        see find_ancil. Defaults to None (use CRDS).
 
     Returns
     -------
@@ -336,26 +413,89 @@ def retrieve_ancil(fitsname):
     - 2022-03-28 Taylor J Bell
         Removed jwst dependency, using crds package now instead.
     '''
-    with fits.open(fitsname) as file:
-        # Automatically get the best reference files using the information
-        # contained in the FITS header and the crds package. The parameters
-        # below are easily obtained from model.get_crds_parameters(), but
-        # datamodels is a jwst sub-package. Instead, I've resorted to manually
-        # populating the required lines for finding gain and photom
-        # reference files.
-        parameters = {
-            "meta.ref_file.crds.context_used": file[0].header["CRDS_CTX"],
-            "meta.ref_file.crds.sw_version": file[0].header["CRDS_VER"],
-            "meta.instrument.name": file[0].header["INSTRUME"],
-            "meta.instrument.detector": file[0].header["DETECTOR"],
-            "meta.observation.date": file[0].header["DATE-OBS"],
-            "meta.observation.time": file[0].header["TIME-OBS"],
-            "meta.exposure.type": file[0].header["EXP_TYPE"],
-            }
-        observatory = file[0].header['TELESCOP'].lower()
+    header = fits.getheader(fitsname)
+    if ancil_dir is not None:
+        key = (ancil_dir, header['INSTRUME'], header.get('DETECTOR'),
+               header.get('EXP_TYPE'), header['DATE-OBS'],
+               header['TIME-OBS'])
+        if key not in _ancil_cache:
+            _ancil_cache[key] = find_ancil(ancil_dir, header)
+        return _ancil_cache[key]
+
+    # Automatically get the best reference files using the information
+    # contained in the FITS header and the crds package. The parameters
+    # below are easily obtained from model.get_crds_parameters(), but
+    # datamodels is a jwst sub-package. Instead, I've resorted to manually
+    # populating the required lines for finding gain and photom
+    # reference files.
+    parameters = {
+        "meta.ref_file.crds.context_used": header["CRDS_CTX"],
+        "meta.ref_file.crds.sw_version": header["CRDS_VER"],
+        "meta.instrument.name": header["INSTRUME"],
+        "meta.instrument.detector": header["DETECTOR"],
+        "meta.observation.date": header["DATE-OBS"],
+        "meta.observation.time": header["TIME-OBS"],
+        "meta.exposure.type": header["EXP_TYPE"],
+        }
+    observatory = header['TELESCOP'].lower()
+    key = (observatory,)+tuple(sorted(parameters.items()))
+    if key not in _ancil_cache:
         refiles = crds.getreferences(parameters, ["gain", "photom"],
                                      observatory=observatory)
-        gain_filename = refiles["gain"]
-        phot_filename = refiles["photom"]
+        _ancil_cache[key] = (refiles["photom"], refiles["gain"])
 
-    return phot_filename, gain_filename
+    return _ancil_cache[key]
+
+
+def find_ancil(ancil_dir, header):
+    '''Finds the photom and gain files in a local directory.
+
+    This stands in for CRDS, e.g. when offline or in tests. Like CRDS, the
+    chosen file of each type is the one matching the instrument, detector,
+    and exposure type with the latest USEAFTER date before the observation.
+
+    Parameters
+    ----------
+    ancil_dir : str
+        The directory holding the reference files (*.fits).
+    header : astropy.io.fits.Header
+        The primary header of the file currently being analyzed.
+
+    Returns
+    -------
+    phot_filename : str
+        The full path to the photom calibration file.
+    gain_filename : str
+        The full path to the gain calibration file.
+
+    Raises
+    ------
+    ValueError
+        No matching reference file of a type was found.
+    '''
+    date = f"{header['DATE-OBS']}T{header['TIME-OBS']}"
+    best = {'PHOTOM': None, 'GAIN': None}
+    for filename in sorted(glob.glob(os.path.join(ancil_dir, '*.fits'))):
+        refhdr = fits.getheader(filename)
+        reftype = str(refhdr.get('REFTYPE', '')).upper()
+        if (reftype not in best or
+                refhdr.get('INSTRUME') != header['INSTRUME']):
+            continue
+        if refhdr.get('DETECTOR', 'ANY') not in ['ANY',
+                                                 header.get('DETECTOR')]:
+            continue
+        exp_types = str(refhdr.get('EXP_TYPE', 'ANY')).split('|')
+        if 'ANY' not in exp_types and header.get('EXP_TYPE') not in exp_types:
+            continue
+        useafter = refhdr.get('USEAFTER', '')
+        if useafter > date:
+            continue
+        if best[reftype] is None or useafter >= best[reftype][0]:
+            best[reftype] = (useafter, os.path.abspath(filename))
+
+    for reftype, found in best.items():
+        if found is None:
+            raise ValueError(f'No {reftype.lower()} reference file for '
+                             f'{header["INSTRUME"]} was found in '
+                             f'{ancil_dir}.')
+    return best['PHOTOM'][1], best['GAIN'][1]
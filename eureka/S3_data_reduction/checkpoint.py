@@ -0,0 +1,194 @@
+import os
+import re
+import glob
+import json
+import pickle
+import hashlib
+import threading
+from . import stepcache
+
+# The name of the manifest in the top folder of each run
+MANIFEST = 'S3_Checkpoint.json'
+
+
+def config_key(meta):
+    '''Gets the key of the settings which can change the outputs of a run.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object, before any aperture/annulus pair is reduced.
+
+    Returns
+    -------
+    str
+        The key of the run's settings.
+    '''
+    sha = hashlib.sha256()
+    stepcache.hash_params(sha, meta, stepcache.IGNORED_KEYS +
+                          stepcache.SEGMENT_KEYS)
+    return sha.hexdigest()
+
+
+def find_run(meta, config):
+    '''Finds the latest Stage 3 run which can be resumed.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    config : str
+        The key returned by config_key for the current settings.
+
+    Returns
+    -------
+    tuple or None
+        The (datetime, run number) of the latest run of this event whose
+        checkpoint manifest was made with the same settings, or None if
+        there is none.
+    '''
+    rootdir = os.path.join(meta.topdir, *meta.outputdir_raw.split(os.sep))
+    pattern = re.compile(r'S3_(.+)_'+re.escape(meta.eventlabel) +
+                         r'_run(\d+)$')
+    runs = []
+    for rundir in glob.glob(os.path.join(rootdir, 'S3_*_run*')):
+        match = pattern.match(os.path.basename(rundir))
+        if match is not None:
+            runs.append((match.group(1), int(match.group(2)), rundir))
+    for datetime, run, rundir in sorted(runs, reverse=True):
+        try:
+            with open(os.path.join(rundir, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if manifest.get('config') == config:
+            return datetime, run
+    return None
+
+
+class Checkpoint:
+    '''Records which segments of each aperture/annulus pair of a run are
+    done, so that an interrupted run can be resumed.
+
+    The top folder of the run holds a manifest listing the finished
+    segments of each pair along with the input file they were made
+    from, and each pair's folder holds the reduced Dataset (without the
+    large 3D arrays) and the metadata changes of each finished segment.
+
+    Parameters
+    ----------
+    rundir : str
+        The top folder of the run.
+    config : str
+        The key returned by config_key for the current settings.
+    '''
+    def __init__(self, rundir, config):
+        self.filename = os.path.join(rundir, MANIFEST)
+        self.config = config
+        # The manifest may be updated by the FluxData writer thread
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+        if self.manifest.get('config') != config:
+            # Checkpoints made with other settings cannot be reused
+            self.manifest = {'config': config, 'pairs': {}}
+
+    def load(self, meta, event_ap_bg, segments):
+        '''Loads the finished segments of a pair.
+
+        Parameters
+        ----------
+        meta : eureka.lib.readECF.MetaClass
+            The metadata object.
+        event_ap_bg : str
+            The event label including the aperture and annulus sizes.
+        segments : iterable
+            The indices of the segments in meta.segment_list to reduce.
+
+        Returns
+        -------
+        list
+            The (data, changes) of the segments which are done, in order.
+            Only the segments before the first unfinished one are
+            returned, so the metadata changes can be applied in order.
+        '''
+        entries = self.manifest['pairs'].get(event_ap_bg, {})
+        done = []
+        for m in segments:
+            entry = entries.get(str(m))
+            if entry is None or entry['input'] != input_info(meta, m):
+                break
+            try:
+                with open(os.path.join(meta.outputdir,
+                                       entry['checkpoint']), 'rb') as f:
+                    done.append(pickle.load(f))
+            except (OSError, EOFError, pickle.UnpicklingError):
+                break
+        return done
+
+    def save(self, meta, event_ap_bg, m, data, changes):
+        '''Records that a segment of a pair is done.
+
+        Parameters
+        ----------
+        meta : eureka.lib.readECF.MetaClass
+            The metadata object.
+        event_ap_bg : str
+            The event label including the aperture and annulus sizes.
+        m : int
+            The index of the segment in meta.segment_list.
+        data : Xarray Dataset
+            The Dataset object returned by reduce_segment.
+        changes : dict
+            The metadata attributes which reduce_segment changed, see
+            stepcache.get_changes.
+        '''
+        name = f'S3_{event_ap_bg}_Checkpoint_seg{str(m+1).zfill(4)}.pkl'
+        write_atomic(os.path.join(meta.outputdir, name),
+                     pickle.dumps((data, changes),
+                                  protocol=pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            entries = self.manifest['pairs'].setdefault(event_ap_bg, {})
+            entries[str(m)] = {'input': input_info(meta, m),
+                               'checkpoint': name}
+            write_atomic(self.filename,
+                         json.dumps(self.manifest, indent=1).encode())
+
+
+def input_info(meta, m):
+    '''Gets the path, size, and modification time of an input file.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    m : int
+        The index of the segment in meta.segment_list.
+
+    Returns
+    -------
+    list
+        The absolute path, size, and modification time (in ns).
+    '''
+    filename = os.path.abspath(meta.segment_list[m])
+    stat = os.stat(filename)
+    return [filename, stat.st_size, stat.st_mtime_ns]
+
+
+def write_atomic(filename, content):
+    '''Writes a file so that it is either complete or not there at all.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file.
+    content : bytes
+        The content of the file.
+    '''
+    tmpname = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(content)
+    os.replace(tmpname, filename)
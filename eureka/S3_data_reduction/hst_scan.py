@@ -1,7 +1,12 @@
+import os
+import pickle
+import hashlib
+import multiprocessing as mp
 import numpy as np
 from astropy.io import fits
 import scipy.interpolate as spi
 import scipy.signal as sps
+import scipy.stats
 import sys
 try:
     import image_registration as imr
@@ -11,9 +16,13 @@ except ModuleNotFoundError:
 from ..lib import gaussian as g
 from ..lib import centroid, smoothing
 
+# The version of the cached master flats, masks, and centroids, which is
+# part of every key. Bump it whenever a code change alters them.
+CACHE_VERSION = 1
+
 
 def imageCentroid(filenames, guess, trim, ny, CRPIX1, CRPIX2, POSTARG1,
-                  POSTARG2):
+                  POSTARG2, headers=None, ncpu=1, cachedir=None):
     '''Calculate centroid for a list of direct images.
 
     Parameters
@@ -36,6 +45,17 @@ def imageCentroid(filenames, guess, trim, ny, CRPIX1, CRPIX2, POSTARG1,
         The value of POSTARG1 in the science FITS header
     POSTARG2 : float
         The value of POSTARG2 in the science FITS header
+    headers : dict; optional
+        The header values of the direct images, as returned by
+        eureka.S3_data_reduction.wfc3.read_headers. Defaults to None,
+        which reads the headers from the files.
+    ncpu : int; optional
+        The number of processes used to centroid the direct images.
+        Defaults to 1.
+    cachedir : str; optional
+        A directory in which the centroid of each direct image is cached,
+        keyed by the file (its path, size, and modification time), guess,
+        and trim. Defaults to None (no cache).
 
     Returns
     -------
@@ -53,21 +73,37 @@ def imageCentroid(filenames, guess, trim, ny, CRPIX1, CRPIX2, POSTARG1,
     - December 8, 2021, Taylor J Bell
         Updated for Eureka
     '''
+    filenames = [filename.rstrip() for filename in filenames]
     nfiles = len(filenames)
+
+    # Centroid the direct images which are not cached
+    results = [None]*nfiles
+    if cachedir is not None:
+        keys = [centroid_cache_key(filename, guess, trim)
+                for filename in filenames]
+        results = [load_cached_centroid(cachedir, key) for key in keys]
+    todo = [i for i in range(nfiles) if results[i] is None]
+    args = [(filenames[i], guess, trim) for i in todo]
+    if ncpu > 1 and len(todo) > 1:
+        with mp.Pool(min(ncpu, len(todo))) as pool:
+            new_results = pool.starmap(centroid_file, args)
+    else:
+        new_results = [centroid_file(*arg) for arg in args]
+    for i, result in zip(todo, new_results):
+        results[i] = result
+        if cachedir is not None:
+            store_cached_centroid(cachedir, keys[i], result)
+
     centers = []
-    # images = []
     for i in range(nfiles):
-        # images.append(fits.getdata(filenames[i].rstrip()))
-        image = fits.getdata(filenames[i].rstrip())
-        # hdr0 = fits.getheader(filenames[i],0)
-        # hdr1 = fits.getheader(filenames[i],1)
-        calhdr0 = fits.getheader(filenames[i].rstrip(), 0)
-        calhdr1 = fits.getheader(filenames[i].rstrip(), 1)
-        # Calculate centroid, correct for difference in image size, if any
-        # centers.append(centroid.ctrgauss(images[i], guess=guess, trim=trim) -
-        #                (images[i].shape[0]-ny)/2.)
-        centers.append(centroid.ctrgauss(image, guess=guess, trim=trim) -
-                       (image.shape[0]-ny)/2.)
+        if headers is not None:
+            calhdr0 = calhdr1 = headers[filenames[i]]
+        else:
+            calhdr0 = fits.getheader(filenames[i], 0)
+            calhdr1 = fits.getheader(filenames[i], 1)
+        # Correct for difference in image size, if any
+        center, image_ny = results[i]
+        centers.append(center - (image_ny-ny)/2.)
         xoffset = (CRPIX1 - calhdr1['CRPIX1'] +
                    (POSTARG1[i] - calhdr0['POSTARG1'])/0.135)
         yoffset = (CRPIX2 - calhdr1['CRPIX2'] +
@@ -107,6 +143,102 @@ def imageCentroid(filenames, guess, trim, ny, CRPIX1, CRPIX2, POSTARG1,
     return centers  # , images
 
 
+def centroid_file(filename, guess, trim):
+    '''Calculate the centroid of one direct image.
+
+    Parameters
+    ----------
+    filename : str
+        The direct image filename.
+    guess : array_like
+        The initial guess of the position of the star.  Has the form
+        (y, x) of the guess center.
+    trim : int
+        If trim!=0, trims the image in a box of 2*trim pixels around
+        the guess center.
+
+    Returns
+    -------
+    center : ndarray
+        The (y, x) centroid.
+    image_ny : int
+        The number of rows in the image.
+    '''
+    image = fits.getdata(filename)
+    return centroid.ctrgauss(image, guess=guess, trim=trim), image.shape[0]
+
+
+def centroid_cache_key(filename, guess, trim):
+    '''Gets the key of a direct image centroid in the cache.
+
+    Parameters
+    ----------
+    filename : str
+        The direct image filename.
+    guess : array_like
+        The initial guess of the position of the star.
+    trim : int
+        The size of the box around the guess.
+
+    Returns
+    -------
+    str
+        The key of the centroid.
+    '''
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    sha = hashlib.sha256()
+    sha.update(pickle.dumps((CACHE_VERSION, filename, stat.st_size,
+                             stat.st_mtime_ns, np.asarray(guess).tolist(),
+                             np.asarray(trim).tolist())))
+    return f'centroid_{sha.hexdigest()}'
+
+
+def load_cached_centroid(cachedir, key):
+    '''Loads a direct image centroid from the cache.
+
+    Parameters
+    ----------
+    cachedir : str
+        The directory holding the cache.
+    key : str
+        The key returned by centroid_cache_key.
+
+    Returns
+    -------
+    tuple or None
+        The (center, image_ny) returned by centroid_file, or None if it is
+        not cached.
+    '''
+    try:
+        with open(os.path.join(cachedir, key+'.pkl'), 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def store_cached_centroid(cachedir, key, result):
+    '''Saves a direct image centroid in the cache.
+
+    Parameters
+    ----------
+    cachedir : str
+        The directory holding the cache, which is created if needed.
+    key : str
+        The key returned by centroid_cache_key.
+    result : tuple
+        The (center, image_ny) returned by centroid_file.
+    '''
+    os.makedirs(cachedir, exist_ok=True)
+    filename = os.path.join(cachedir, key+'.pkl')
+    # Write to a temporary file first, so other processes never see
+    # partly written entries
+    tmpname = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpname, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpname, filename)
+
+
 def groupFrames(dates):
     '''Group frames by orbit and batch number
 
@@ -281,7 +413,7 @@ def calibrateLambda(x, centroid, grism):
 
 
 def makeflats(flatfile, wave, xwindow, ywindow, flatoffset, n_spec, ny, nx,
-              sigma=5, isplots=0):
+              sigma=5, isplots=0, cachedir=None):
     '''Makes master flatfield image and new mask for WFC3 data.
 
     Parameters
@@ -298,6 +430,9 @@ def makeflats(flatfile, wave, xwindow, ywindow, flatoffset, n_spec, ny, nx,
         Number of spectra.
     sigma : float
         Sigma rejection level.
+    cachedir : str; optional
+        A directory in which the master flats are cached, see
+        load_cached_flats. Defaults to None (no cache).
 
     Returns
     -------
@@ -313,6 +448,13 @@ def makeflats(flatfile, wave, xwindow, ywindow, flatoffset, n_spec, ny, nx,
     - November 2012, Kevin Stevenson
         Initial version.
     '''
+    if cachedir is not None:
+        key = flat_cache_key('makeflats', flatfile, wave, xwindow, ywindow,
+                             flatoffset, n_spec, ny, nx, sigma)
+        cached = load_cached_flats(cachedir, key)
+        if cached is not None:
+            return cached
+
     # Read in flat frames
     hdulist = fits.open(flatfile)
     flat_mhdr = hdulist[0].header
@@ -421,11 +563,14 @@ def makeflats(flatfile, wave, xwindow, ywindow, flatoffset, n_spec, ny, nx,
         flat_master.append(flat_new)
         mask_master.append(mask)
 
+    if cachedir is not None:
+        store_cached_flats(cachedir, key, flat_master, mask_master)
+
     return flat_master, mask_master
 
 
 def makeBasicFlats(flatfile, xwindow, ywindow, flatoffset, ny, nx, sigma=5,
-                   isplots=0):
+                   isplots=0, cachedir=None):
     '''Makes master flatfield image (with no wavelength correction) and new
     mask for WFC3 data.
 
@@ -441,6 +586,9 @@ def makeBasicFlats(flatfile, xwindow, ywindow, flatoffset, ny, nx, sigma=5,
         Number of spectra
     sigma : float
         Sigma rejection level
+    cachedir : str; optional
+        A directory in which the master flats are cached, see
+        load_cached_flats. Defaults to None (no cache).
 
     Returns
     -------
@@ -458,6 +606,13 @@ def makeBasicFlats(flatfile, xwindow, ywindow, flatoffset, ny, nx, sigma=5,
     - February 2018, Kevin Stevenson
         Removed wavelength dependence.
     '''
+    if cachedir is not None:
+        key = flat_cache_key('makeBasicFlats', flatfile, xwindow, ywindow,
+                             flatoffset, ny, nx, sigma)
+        cached = load_cached_flats(cachedir, key)
+        if cached is not None:
+            return cached
+
     # Read in flat frames
     hdulist = fits.open(flatfile)
     # flat_mhdr = hdulist[0].header
@@ -522,9 +677,99 @@ def makeBasicFlats(flatfile, xwindow, ywindow, flatoffset, ny, nx, sigma=5,
     flat_master.append(flat_new)
     mask_master.append(mask)
 
+    if cachedir is not None:
+        store_cached_flats(cachedir, key, flat_master, mask_master)
+
     return flat_master, mask_master
 
 
+def flat_cache_key(name, flatfile, *args):
+    '''Gets the key of a master flat in the cache.
+
+    Parameters
+    ----------
+    name : str
+        The name of the function which makes the master flat.
+    flatfile : str
+        The flat field file.
+    *args
+        The other inputs which the master flat depends on (the wavelengths,
+        windows, offsets, frame size, and sigma rejection level).
+
+    Returns
+    -------
+    str
+        The key of the master flat.
+    '''
+    filename = os.path.abspath(flatfile)
+    stat = os.stat(filename)
+    # Convert any arrays so equal inputs always give the same key
+    args = [np.asarray(arg).tolist() for arg in args]
+    sha = hashlib.sha256()
+    sha.update(pickle.dumps((CACHE_VERSION, name, filename, stat.st_size,
+                             stat.st_mtime_ns, args)))
+    return f'{name}_{sha.hexdigest()}'
+
+
+def load_cached_flats(cachedir, key):
+    '''Loads master flats and masks from the cache.
+
+    The flats and masks of each key are saved as two .npy files holding
+    one frame per spectrum, which are memory mapped when they are loaded.
+    The frames are copy-on-write, so changing them in memory never
+    changes the cache.
+
+    Parameters
+    ----------
+    cachedir : str
+        The directory holding the cache.
+    key : str
+        The key returned by flat_cache_key.
+
+    Returns
+    -------
+    tuple or None
+        The lists of master flats and masks, or None if they are not
+        cached.
+    '''
+    try:
+        flat = np.load(os.path.join(cachedir, key+'_flat.npy'),
+                       mmap_mode='c')
+        mask = np.load(os.path.join(cachedir, key+'_mask.npy'),
+                       mmap_mode='c')
+    except (OSError, ValueError):
+        return None
+    return list(flat), list(mask)
+
+
+def store_cached_flats(cachedir, key, flat_master, mask_master):
+    '''Saves master flats and masks in the cache.
+
+    Parameters
+    ----------
+    cachedir : str
+        The directory holding the cache, which is created if needed.
+    key : str
+        The key returned by flat_cache_key.
+    flat_master : list
+        The master flatfield images.
+    mask_master : list
+        The bad-pixel mask images.
+    '''
+    os.makedirs(cachedir, exist_ok=True)
+    # Save the mask first, since an entry is only complete once its flat
+    # is there
+    for suffix, frames in [('_mask.npy', mask_master),
+                           ('_flat.npy', flat_master)]:
+        filename = os.path.join(cachedir, key+suffix)
+        # Write to a temporary file first, so other processes never see
+        # partly written entries
+        tmpname = f'{filename}.{os.getpid()}.tmp'
+        with open(tmpname, 'wb') as f:
+            np.save(f, np.array(frames))
+        os.replace(tmpname, filename)
+
+
 def calc_slitshift2(spectrum, xrng, ywindow, xwindow, width=5, deg=1):
     '''Calculate slit shifts
 
@@ -737,6 +982,155 @@ def calcDrift2D(im1, im2, m, n):
     return drift2D, m, n
 
 
+class Drift2D:
+    """Measures the 2D drift of many images with respect to one reference
+    image.
+
+    This gives the same offsets as calcDrift2D (image_registration's
+    chi2_shift with its automatic upsampling), but the Fourier transform of
+    the reference image is only computed once, and the images are
+    registered together as a stack.
+
+    Parameters
+    ----------
+    ref : ndarray
+        The reference image.
+    max_auto_size : int; optional
+        The size of the upsampled chi-squared map around the coarse minimum,
+        as in chi2_shift. Defaults to 512.
+    max_nsig : float; optional
+        The significance of the region of the coarse chi-squared map used
+        to choose the upsampling factor, as in chi2_shift. Defaults to 1.1.
+    step : int; optional
+        The upsampled chi-squared map is first computed every step points,
+        and then in full only around the smallest of these values. Defaults
+        to 8.
+    batch_size : int; optional
+        The number of images whose upsampled maps are computed at once,
+        which bounds the memory used. Defaults to 16.
+    """
+    def __init__(self, ref, max_auto_size=512, max_nsig=1.1, step=8,
+                 batch_size=16):
+        ref = np.nan_to_num(np.asarray(ref, dtype=float))
+        self.shape = ref.shape
+        ny, nx = self.shape
+        self.ref_fft = np.fft.rfft2(ref)
+        self.ref_sum2 = np.sum(ref**2)
+        self.max_auto_size = max_auto_size
+        self.step = step
+        self.batch_size = batch_size
+        # The delta-chi-squared of max_nsig for 2 degrees of freedom
+        self.m_auto = scipy.stats.chi2.ppf(
+            1-scipy.stats.norm.sf(max_nsig)*2, 2)
+        # The central pixel of each axis
+        self.ycen = ny/2 - (1 if ny % 2 == 0 else 0.5)
+        self.xcen = nx/2 - (1 if nx % 2 == 0 else 0.5)
+        self.freqy = np.fft.fftfreq(ny)
+        self.freqx = np.fft.fftfreq(nx)
+
+    def chi2(self, images):
+        """Computes the chi-squared maps of some images.
+
+        Parameters
+        ----------
+        images : ndarray
+            The images, with shape (number of images, ny, nx).
+
+        Returns
+        -------
+        ndarray
+            The chi-squared of each image against the reference image for
+            every integer (circular) shift.
+        """
+        images = np.nan_to_num(np.asarray(images, dtype=float))
+        # Cross-correlate the reference image with each image
+        kernels = np.fft.ifftshift(images[:, ::-1, ::-1], axes=(1, 2))
+        xcorr = np.fft.irfft2(self.ref_fft*np.fft.rfft2(kernels),
+                              s=self.shape)
+        sum2 = np.sum(images**2, axis=(1, 2))
+        return sum2[:, np.newaxis, np.newaxis] + self.ref_sum2 - 2*xcorr
+
+    def measure(self, images):
+        """Measures the drift of some images.
+
+        Parameters
+        ----------
+        images : ndarray
+            The images, with shape (number of images, ny, nx).
+
+        Returns
+        -------
+        drift2D : ndarray
+            The x and y offsets of each image with respect to the reference
+            image, with shape (number of images, 2).
+        """
+        images = np.asarray(images)
+        drift2D = np.zeros((len(images), 2))
+        for start in range(0, len(images), self.batch_size):
+            stop = min(start+self.batch_size, len(images))
+            drift2D[start:stop] = self.measure_batch(images[start:stop])
+        return drift2D
+
+    def measure_batch(self, images):
+        """Measures the drift of a batch of images.
+
+        Parameters
+        ----------
+        images : ndarray
+            The images, with shape (number of images, ny, nx).
+
+        Returns
+        -------
+        drift2D : ndarray
+            The x and y offsets of each image with respect to the reference
+            image, with shape (number of images, 2).
+        """
+        chi2 = self.chi2(images)
+        # Use the inverse FFT for the Fourier interpolation, as in
+        # image_registration.fft_tools.fourier_interp2d
+        chi2_ifft = np.fft.ifft2(chi2)
+        ny, nx = self.shape
+        size = self.max_auto_size
+        drift2D = np.zeros((len(images), 2))
+        for i in range(len(images)):
+            ymax, xmax = np.unravel_index(np.argmin(chi2[i]), self.shape)
+
+            # Choose the upsampling factor from the size of the region
+            # around the minimum
+            region = chi2[i]-chi2[i].min() < self.m_auto
+            if np.sum(region) > 1:
+                yvals, xvals = np.nonzero(region)
+                extent = max(np.ptp(xvals), np.ptp(yvals))
+            else:
+                extent = 1
+            usfac = max(size/2./extent, 1)
+
+            # The positions of the upsampled map, centred on the minimum
+            yout = np.linspace(-(size-1.)/usfac/2., (size-1.)/usfac/2., size)
+            xout = yout + (nx-1)/2. + xmax - self.xcen
+            yout = yout + (ny-1)/2. + ymax - self.ycen
+            kerny = np.exp(-2j*np.pi*yout[:, np.newaxis] *
+                           self.freqy[np.newaxis])
+            kernx = np.exp(-2j*np.pi*self.freqx[:, np.newaxis] *
+                           xout[np.newaxis])
+
+            # Find the minimum on a coarse grid of the upsampled map, and
+            # then on the full grid around it
+            coarse = np.arange(0, size, self.step)
+            ups = (kerny[coarse] @ chi2_ifft[i] @ kernx[:, coarse]).real
+            iy, ix = np.unravel_index(np.argmin(ups), ups.shape)
+            fine_y = np.arange(max(coarse[iy]-self.step, 0),
+                               min(coarse[iy]+self.step+1, size))
+            fine_x = np.arange(max(coarse[ix]-self.step, 0),
+                               min(coarse[ix]+self.step+1, size))
+            ups = (kerny[fine_y] @ chi2_ifft[i] @ kernx[:, fine_x]).real
+            iy, ix = np.unravel_index(np.argmin(ups), ups.shape)
+
+            drift2D[i] = [self.xcen - xout[fine_x[ix]],
+                          self.ycen - yout[fine_y[iy]]]
+        return drift2D
+
+
 def replacePixels(shiftdata, shiftmask, m, n, i, j, k, ktot, ny, nx, sy, sx):
     """Replace bad pixels
 
@@ -790,6 +1184,39 @@ def replacePixels(shiftdata, shiftmask, m, n, i, j, k, ktot, ny, nx, sy, sx):
     return shift, m, n, i, j
 
 
+def replacePixelsFrame(data, mask, ny, nx, sy, sx):
+    """Replace all of the bad pixels of a frame at once.
+
+    Each bad pixel is replaced by the Gaussian-weighted mean of the good
+    pixels around it, as replacePixels does for one pixel.
+
+    Parameters
+    ----------
+    data : ndarray
+        The frame, or a stack of frames along the first axes.
+    mask : ndarray
+        The mask, which is 1 (or True) for good pixels and 0 for bad pixels.
+        Same shape as data.
+    ny : int
+        The half-height of the Gaussian kernel.
+    nx : int
+        The half-width of the Gaussian kernel.
+    sy : float
+        The standard deviation of the Gaussian kernel along the y axis.
+    sx : float
+        The standard deviation of the Gaussian kernel along the x axis.
+
+    Returns
+    -------
+    ndarray
+        A copy of data with the bad pixels replaced (by 0 where there are no
+        good pixels within the kernel).
+    """
+    mask = np.asarray(mask)
+    smoothed = smoothing.gauss_smooth_mask(data, mask, (ny, nx), (sy, sx))
+    return np.where(mask == 0, smoothed, data)
+
+
 def drift_fit2D(meta, data, validRange=9):
     '''Measures the spectrum drift over all frames and all non-destructive reads.
 
@@ -2,6 +2,7 @@ import numpy as np
 from astropy.io import fits
 import astraeus.xarrayIO as xrio
 from . import nircam
+from ..lib import util
 
 
 def read(filename, data, meta):
@@ -49,10 +50,21 @@ def read(filename, data, meta):
     data.attrs['intstart'] = data.attrs['mhdr']['INTSTART']
     data.attrs['intend'] = data.attrs['mhdr']['INTEND']
 
-    sci = hdulist['SCI', 1].data
-    err = hdulist['ERR', 1].data
-    dq = hdulist['DQ', 1].data
-    v0 = hdulist['VAR_RNOISE', 1].data
+    # MIRI appears to be rotated by 90° compared to NIRCam, so rotating arrays
+    # to allow the re-use of NIRCam code. Having wavelengths increase from
+    # left to right on the rotated frame makes life easier
+    swap = data.attrs['shdr']['DISPAXIS'] == 2
+    if swap and meta.firstFile:
+        # If not, we've already done this and don't want to switch it back
+        temp = np.copy(meta.ywindow)
+        meta.ywindow = meta.xwindow
+        meta.xwindow = hdulist['SCI', 1].shape[1] - temp[::-1]
+
+    # Only read in the region of interest
+    sci = util.read_trimmed(hdulist['SCI', 1], meta, swap)
+    err = util.read_trimmed(hdulist['ERR', 1], meta, swap)
+    dq = util.read_trimmed(hdulist['DQ', 1], meta, swap)
+    v0 = util.read_trimmed(hdulist['VAR_RNOISE', 1], meta, swap)
     # If wavelengths are all zero --> use hardcoded wavelengths
     # Otherwise use the wavelength array from the header
     if np.all(hdulist['WAVELENGTH', 1].data == 0):
@@ -61,9 +73,14 @@ def read(filename, data, meta):
                   'currently hardcoded\n'
                   '           because they are not in the .fits files '
                   'themselves')
-        wave_2d = np.tile(wave_MIRI_hardcoded(), (sci.shape[2], 1))[:, ::-1]
+        wave_2d = np.tile(wave_MIRI_hardcoded(),
+                          (hdulist['SCI', 1].shape[2], 1))[:, ::-1]
     else:
         wave_2d = hdulist['WAVELENGTH', 1].data
+        if swap:
+            wave_2d = np.swapaxes(wave_2d, 0, 1)[:, ::-1]
+    wave_2d = wave_2d[meta.ywindow[0]:meta.ywindow[1],
+                      meta.xwindow[0]:meta.xwindow[1]]
     int_times = hdulist['INT_TIMES', 1].data[data.attrs['intstart']-1:
                                              data.attrs['intend']]
 
@@ -139,22 +156,6 @@ def read(filename, data, meta):
     time_units = 'BJD_TDB'
     wave_units = 'microns'
 
-    # MIRI appears to be rotated by 90° compared to NIRCam, so rotating arrays
-    # to allow the re-use of NIRCam code. Having wavelengths increase from
-    # left to right on the rotated frame makes life easier
-    if data.attrs['shdr']['DISPAXIS'] == 2:
-        sci = np.swapaxes(sci, 1, 2)[:, :, ::-1]
-        err = np.swapaxes(err, 1, 2)[:, :, ::-1]
-        dq = np.swapaxes(dq, 1, 2)[:, :, ::-1]
-        v0 = np.swapaxes(v0, 1, 2)[:, :, ::-1]
-        if not np.all(hdulist['WAVELENGTH', 1].data == 0):
-            wave_2d = np.swapaxes(wave_2d, 0, 1)[:, :, ::-1]
-        if meta.firstFile:
-            # If not, we've already done this and don't want to switch it back
-            temp = np.copy(meta.ywindow)
-            meta.ywindow = meta.xwindow
-            meta.xwindow = sci.shape[2] - temp[::-1]
-
     data['flux'] = xrio.makeFluxLikeDA(sci, time, flux_units, time_units,
                                        name='flux')
     data['err'] = xrio.makeFluxLikeDA(err, time, flux_units, time_units,
@@ -165,6 +166,8 @@ def read(filename, data, meta):
                                      name='v0')
     data['wave_2d'] = (['y', 'x'], wave_2d)
     data['wave_2d'].attrs['wave_units'] = wave_units
+    data = data.assign_coords(y=np.arange(*meta.ywindow),
+                              x=np.arange(*meta.xwindow))
 
     return data, meta
 
@@ -357,12 +360,12 @@ def fit_bg(dataim, datamask, n, meta, isplots=0):
 
     Parameters
     ----------
-    dataim : ndarray (2D)
-        The 2D image array.
-    datamask : ndarray (2D)
+    dataim : ndarray (2D or 3D)
+        The 2D image array, or a stack of images with shape (n_int, ny, nx).
+    datamask : ndarray (2D or 3D)
         An array of which data should be masked.
-    n : int
-        The current integration.
+    n : int or slice
+        The current integration, or the integrations in dataim.
     meta : eureka.lib.readECF.MetaClass
         The metadata object.
     isplots : int; optional
@@ -370,11 +373,11 @@ def fit_bg(dataim, datamask, n, meta, isplots=0):
 
     Returns
     -------
-    bg : ndarray (2D)
+    bg : ndarray (2D or 3D)
         The fitted background level.
-    mask : ndarray (2D)
+    mask : ndarray (2D or 3D)
         The updated mask after background subtraction.
-    n : int
-        The current integration number.
+    n : int or slice
+        The current integration number(s).
     """
     return nircam.fit_bg(dataim, datamask, n, meta, isplots=isplots)
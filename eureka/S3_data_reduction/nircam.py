@@ -1,8 +1,10 @@
 # NIRCam specific rountines go here
-# import numpy as np
+import numpy as np
 from astropy.io import fits
 import astraeus.xarrayIO as xrio
 from . import sigrej, background
+from ..lib import util
+from ..lib import maskflags
 
 
 def read(filename, data, meta):
@@ -46,11 +48,13 @@ def read(filename, data, meta):
     data.attrs['intstart'] = data.attrs['mhdr']['INTSTART']
     data.attrs['intend'] = data.attrs['mhdr']['INTEND']
 
-    sci = hdulist['SCI', 1].data
-    err = hdulist['ERR', 1].data
-    dq = hdulist['DQ', 1].data
-    v0 = hdulist['VAR_RNOISE', 1].data
-    wave_2d = hdulist['WAVELENGTH', 1].data
+    # Only read in the region of interest
+    sci = util.read_trimmed(hdulist['SCI', 1], meta)
+    err = util.read_trimmed(hdulist['ERR', 1], meta)
+    dq = util.read_trimmed(hdulist['DQ', 1], meta)
+    v0 = util.read_trimmed(hdulist['VAR_RNOISE', 1], meta)
+    wave_2d = hdulist['WAVELENGTH', 1].data[meta.ywindow[0]:meta.ywindow[1],
+                                            meta.xwindow[0]:meta.xwindow[1]]
     int_times = hdulist['INT_TIMES', 1].data[data.attrs['intstart']-1:
                                              data.attrs['intend']]
 
@@ -72,6 +76,8 @@ def read(filename, data, meta):
                                      name='v0')
     data['wave_2d'] = (['y', 'x'], wave_2d)
     data['wave_2d'].attrs['wave_units'] = wave_units
+    data = data.assign_coords(y=np.arange(*meta.ywindow),
+                              x=np.arange(*meta.xwindow))
 
     return data, meta
 
@@ -94,19 +100,21 @@ def flag_bg(data, meta):
     y1, y2, bg_thresh = meta.bg_y1, meta.bg_y2, meta.bg_thresh
 
     bgdata1 = data.flux[:, :y1]
-    bgmask1 = data.mask[:, :y1]
+    bgmask1 = maskflags.good(data.mask[:, :y1].values)
     bgdata2 = data.flux[:, y2:]
-    bgmask2 = data.mask[:, y2:]
+    bgmask2 = maskflags.good(data.mask[:, y2:].values)
     # bgerr1 = np.median(data.err[:, :y1])
     # bgerr2 = np.median(data.err[:, y2:])
     # estsig1 = [bgerr1 for j in range(len(bg_thresh))]
     # estsig2 = [bgerr2 for j in range(len(bg_thresh))]
     # FINDME: KBS removed estsig from inputs to speed up outlier detection.
     # Need to test performance with and without estsig on real data.
-    data['mask'][:, :y1] = sigrej.sigrej(bgdata1, bg_thresh, bgmask1)  # ,
-    #                                      estsig1)
-    data['mask'][:, y2:] = sigrej.sigrej(bgdata2, bg_thresh, bgmask2)  # ,
-    #                                     estsig2)
+    maskflags.update(data.mask.values[:, :y1],
+                     sigrej.sigrej_cube(bgdata1, bg_thresh, bgmask1),
+                     maskflags.BG_OUTLIER)
+    maskflags.update(data.mask.values[:, y2:],
+                     sigrej.sigrej_cube(bgdata2, bg_thresh, bgmask2),
+                     maskflags.BG_OUTLIER)
 
     return data
 
@@ -116,12 +124,12 @@ def fit_bg(dataim, datamask, n, meta, isplots=0):
 
     Parameters
     ----------
-    dataim : ndarray (2D)
-        The 2D image array.
-    datamask : ndarray (2D)
+    dataim : ndarray (2D or 3D)
+        The 2D image array, or a stack of images with shape (n_int, ny, nx).
+    datamask : ndarray (2D or 3D)
         An array of which data should be masked.
-    n : int
-        The current integration.
+    n : int or slice
+        The current integration, or the integrations in dataim.
     meta : eureka.lib.readECF.MetaClass
         The metadata object.
     isplots : int; optional
@@ -129,12 +137,12 @@ def fit_bg(dataim, datamask, n, meta, isplots=0):
 
     Returns
     -------
-    bg : ndarray (2D)
+    bg : ndarray (2D or 3D)
         The fitted background level.
-    mask : ndarray (2D)
+    mask : ndarray (2D or 3D)
         The updated mask after background subtraction.
-    n : int
-        The current integration number.
+    n : int or slice
+        The current integration number(s).
     """
     bg, mask = background.fitbg(dataim, meta, datamask, meta.bg_y1,
                                 meta.bg_y2, deg=meta.bg_deg,
@@ -5,14 +5,65 @@ from ..lib import smooth
 from . import plots_s3
 
 
+def fill_masked(subdata, mask, halfwidth=10):
+    '''Replace masked points in each row with the median of nearby points.
+
+    Masked points are replaced in order of increasing column number, so
+    later replacements make use of the values that were already replaced.
+
+    Parameters
+    ----------
+    subdata : ndarray
+        Data array whose last axis is the dispersion direction.
+    mask : ndarray
+        Outlier mask with the same shape as subdata.
+    halfwidth : int; optional
+        Half-width of the window used to compute the median. Defaults to 10.
+
+    Returns
+    -------
+    dataslice : ndarray (2D)
+        A copy of the data with shape (nrows, nx) where the masked points
+        have been replaced.
+    '''
+    nx = np.shape(subdata)[-1]
+    # Do not want to alter original data
+    dataslice = np.array(subdata, dtype=float).reshape(-1, nx)
+    rows, cols = np.where(np.reshape(mask, (-1, nx)) == 0)
+    if len(rows) == 0:
+        return dataslice
+    # Rank of each masked point within its row
+    counts = np.bincount(rows, minlength=dataslice.shape[0])
+    rank = np.arange(len(rows)) - (np.cumsum(counts) - counts)[rows]
+    offsets = np.arange(-halfwidth, halfwidth+1)
+    for r in range(rank.max()+1):
+        jr = rows[rank == r]
+        ir = cols[rank == r]
+        inds = ir[:, np.newaxis] + offsets
+        isfull = np.all((inds >= 0) & (inds < nx), axis=1)
+        # Windows fully within the row can be done all at once
+        dataslice[jr[isfull], ir[isfull]] = np.median(
+            dataslice[jr[isfull, np.newaxis], inds[isfull]], axis=1)
+        # Windows truncated by the edge of the row
+        for j, i in zip(jr[~isfull], ir[~isfull]):
+            dataslice[j, i] = np.median(
+                dataslice[j, np.max((0, i-halfwidth)):i+halfwidth+1])
+
+    return dataslice
+
+
 def profile_poly(subdata, mask, deg=3, threshold=10, isplots=0):
     '''Construct normalized spatial profile using polynomial fits along the
     wavelength direction.
 
+    All rows (and all integrations, if given a 3D array) are fit at once
+    using a shared Vandermonde matrix, and only the rows in which a new
+    outlier was found are refit on subsequent iterations.
+
     Parameters
     ----------
     subdata : ndarray
-        Background subtracted data.
+        Background subtracted data with shape (ny, nx) or (n_int, ny, nx).
     mask : ndarray
         Outlier mask.
     deg : int; optional
@@ -29,54 +80,55 @@ def profile_poly(subdata, mask, deg=3, threshold=10, isplots=0):
         Fitted profile in the same shape as the input data array.
     '''
     submask = np.copy(mask)
-    ny, nx = np.shape(subdata)
-    profile = np.zeros((ny, nx))
+    shape = np.shape(subdata)
+    ny, nx = shape[-2:]
+    rowdata = np.reshape(subdata, (-1, nx))
+    rowmask = np.reshape(submask, (-1, nx))
+    profile = np.zeros(rowdata.shape)
+    xvals = np.arange(nx)
+    vander = np.vander(xvals, deg+1)
     maxiter = nx
-    for j in range(ny):
-        nobadpixels = False
-        iternum = 0
-        while not nobadpixels and iternum < maxiter:
-            # Do not want to alter original data
-            dataslice = np.copy(subdata[j])
-            # Replace masked points with median of nearby points
-            for ind in np.where(submask[j] == 0)[0]:
-                dataslice[ind] = \
-                    np.median(dataslice[np.max((0, ind-10)):ind+11])
-
-            # Smooth each row
-            coeffs = np.polyfit(range(nx), dataslice, deg)
-            model = np.polyval(coeffs, range(nx))
-            if isplots == 7:
+    iternum = 0
+    active = np.arange(rowdata.shape[0])
+    while len(active) > 0 and iternum < maxiter:
+        # Replace masked points with median of nearby points
+        dataslice = fill_masked(rowdata[active], rowmask[active])
+
+        # Smooth each row
+        coeffs = np.polyfit(xvals, dataslice.T, deg)
+        model = (vander @ coeffs).T
+        profile[active] = model
+        if isplots == 7:
+            for k, j in enumerate(active):
                 plt.figure(3703)
                 plt.clf()
-                plt.suptitle(str(j) + "," + str(iternum))
-                plt.plot(dataslice, 'ro')
-                plt.plot(dataslice*submask[j], 'bo')
-                plt.plot(model, 'g-')
+                plt.suptitle(str(j % ny) + "," + str(iternum))
+                plt.plot(dataslice[k], 'ro')
+                plt.plot(dataslice[k]*rowmask[j], 'bo')
+                plt.plot(model[k], 'g-')
                 plt.pause(0.1)
 
-            # Calculate residuals and number of sigma from the model
-            residuals = submask[j]*(dataslice - model)
-            stdevs = np.abs(residuals) / np.std(residuals)
-            # Find worst data point
-            loc = np.argmax(stdevs)
-            # Mask data point if > threshold
-            if stdevs[loc] > threshold:
-                nobadpixels = False
-                submask[j, loc] = 0
-            else:
-                nobadpixels = True  # exit while loop
-            iternum += 1
-
-        profile[j] = model
+        # Calculate residuals and number of sigma from the model
+        residuals = rowmask[active]*(dataslice - model)
+        stdevs = (np.abs(residuals) /
+                  np.std(residuals, axis=1)[:, np.newaxis])
+        # Find worst data point
+        loc = np.argmax(stdevs, axis=1)
+        # Mask data point if > threshold
+        isbad = stdevs[np.arange(len(active)), loc] > threshold
+        rowmask[active[isbad], loc[isbad]] = 0
+        iternum += 1
         if iternum == maxiter:
-            print('WARNING: Max number of iterations reached for '
-                  'dataslice ' + str(j))
+            for j in active:
+                print('WARNING: Max number of iterations reached for '
+                      'dataslice ' + str(j % ny))
+        active = active[isbad]
 
+    profile = profile.reshape(shape)
     # Enforce positivity
     profile[np.where(profile < 0)] = 0
     # Normalize along spatial direction
-    profile /= np.sum(profile, axis=0)
+    profile /= np.sum(profile, axis=-2, keepdims=True)
 
     return profile
 
@@ -85,10 +137,14 @@ def profile_smooth(subdata, mask, threshold=10, window_len=21,
                    windowtype='hanning', isplots=0):
     '''Construct normalized spatial profile using a smoothing function.
 
+    All rows (and all integrations, if given a 3D array) are smoothed at
+    once along the dispersion direction, and only the rows in which a new
+    outlier was found are smoothed again on subsequent iterations.
+
     Parameters
     ----------
     subdata : ndarray
-        Background subtracted data.
+        Background subtracted data with shape (ny, nx) or (n_int, ny, nx).
     mask : ndarray
         Outlier mask.
     threshold : float; optional
@@ -108,63 +164,63 @@ def profile_smooth(subdata, mask, threshold=10, window_len=21,
         Fitted profile in the same shape as the input data array.
     '''
     submask = np.copy(mask)
-    ny, nx = np.shape(subdata)
-    profile = np.zeros((ny, nx))
-    maxiter = nx
-    for j in range(ny):
-        # Check for good pixels in row
-        if np.sum(submask[j]) > 0:
-            nobadpixels = False
-            iternum = 0
-            maxiter = np.sum(submask[j])
-            while not nobadpixels and iternum < maxiter:
-                # Do not want to alter original data
-                dataslice = np.copy(subdata[j])
-                # Replace masked points with median of nearby points
-                # dataslice[np.where(submask[j] == 0)] = 0
-                # FINDME: Code below appears to be effective, but is slow for
-                # lots of masked points
-                for ind in np.where(submask[j] == 0)[0]:
-                    dataslice[ind] = \
-                        np.median(dataslice[np.max((0, ind-10)):ind+11])
-
-                # Smooth each row
-                # model = smooth.smooth(dataslice, window_len=window_len,
-                #                       window=windowtype)
-                model = smooth.medfilt(dataslice, window_len)
-                if isplots == 7:
-                    plt.figure(3703)
-                    plt.clf()
-                    plt.suptitle(str(j) + "," + str(iternum))
-                    plt.plot(dataslice, 'ro')
-                    plt.plot(dataslice*submask[j], 'bo')
-                    plt.plot(model, 'g-')
-                    plt.pause(0.1)
-
-                # Calculate residuals and number of sigma from the model
-                igoodmask = np.where(submask[j] == 1)[0]
-                residuals = submask[j]*(dataslice - model)
-                stdevs = (np.abs(residuals[igoodmask]) /
-                          np.std(residuals[igoodmask]))
-                # Find worst data point
-                loc = np.argmax(stdevs)
-                # Mask data point if > threshold
-                if stdevs[loc] > threshold:
-                    nobadpixels = False
-                    submask[j, igoodmask[loc]] = 0
-                else:
-                    nobadpixels = True  # exit while loop
-                iternum += 1
-            # Copy model slice to profile
-            profile[j] = model
-            if iternum == maxiter:
-                print('WARNING: Max number of iterations reached for '
-                      'dataslice ' + str(j))
+    shape = np.shape(subdata)
+    ny, nx = shape[-2:]
+    rowdata = np.reshape(subdata, (-1, nx))
+    rowmask = np.reshape(submask, (-1, nx))
+    profile = np.zeros(rowdata.shape)
+    # Only fit rows with good pixels
+    maxiter = np.sum(rowmask, axis=1)
+    iternum = np.zeros(rowdata.shape[0], dtype=int)
+    active = np.where(maxiter > 0)[0]
+    while len(active) > 0:
+        # Replace masked points with median of nearby points
+        dataslice = fill_masked(rowdata[active], rowmask[active])
+
+        # Smooth each row
+        # model = smooth.smooth(dataslice, window_len=window_len,
+        #                       window=windowtype)
+        model = smooth.medfilt(dataslice, window_len)
+        # Copy model slice to profile
+        profile[active] = model
+        if isplots == 7:
+            for k, j in enumerate(active):
+                plt.figure(3703)
+                plt.clf()
+                plt.suptitle(str(j % ny) + "," + str(iternum[j]))
+                plt.plot(dataslice[k], 'ro')
+                plt.plot(dataslice[k]*rowmask[j], 'bo')
+                plt.plot(model[k], 'g-')
+                plt.pause(0.1)
 
+        # Calculate residuals and number of sigma from the model
+        isgood = rowmask[active] == 1
+        ngood = np.sum(isgood, axis=1)
+        residuals = rowmask[active]*(dataslice - model)
+        mean = np.sum(residuals*isgood, axis=1)/ngood
+        std = np.sqrt(np.sum(((residuals - mean[:, np.newaxis])*isgood)**2,
+                             axis=1)/ngood)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stdevs = np.abs(residuals) / std[:, np.newaxis]
+        # Only consider the good data points
+        stdevs[~isgood] = -np.inf
+        # Find worst data point
+        loc = np.argmax(stdevs, axis=1)
+        # Mask data point if > threshold
+        isbad = stdevs[np.arange(len(active)), loc] > threshold
+        rowmask[active[isbad], loc[isbad]] = 0
+        iternum[active] += 1
+        # Every row which reached the maximum number of iterations
+        for j in active[iternum[active] == maxiter[active]]:
+            print('WARNING: Max number of iterations reached for '
+                  'dataslice ' + str(j % ny))
+        active = active[isbad & (iternum[active] < maxiter[active])]
+
+    profile = profile.reshape(shape)
     # Enforce positivity
     profile[np.where(profile < 0)] = 0
     # Normalize along spatial direction
-    profile /= np.sum(profile, axis=0)
+    profile /= np.sum(profile, axis=-2, keepdims=True)
 
     return profile
 
@@ -356,10 +412,14 @@ def profile_wavelet2D(subdata, mask, wavelet, numlvls, isplots=0):
 def profile_gauss(subdata, mask, threshold=10, guess=None, isplots=0):
     '''Construct normalized spatial profile using a Gaussian smoothing function.
 
+    All columns (and all integrations, if given a 3D array) are fit at once
+    using a vectorized Levenberg-Marquardt solver, and only the columns in
+    which a new outlier was found are refit on subsequent iterations.
+
     Parameters
     ----------
     subdata : ndarray
-        Background subtracted data.
+        Background subtracted data with shape (ny, nx) or (n_int, ny, nx).
     mask : ndarray
         Outlier mask.
     threshold : float; optional
@@ -377,71 +437,84 @@ def profile_gauss(subdata, mask, threshold=10, guess=None, isplots=0):
         Fitted profile in the same shape as the input data array.
     '''
     submask = np.copy(mask)
-    ny, nx = np.shape(subdata)
-    profile = np.zeros((ny, nx))
+    shape = np.shape(subdata)
+    ny, nx = shape[-2:]
+    # Work on one column per row
+    coldata = np.reshape(np.swapaxes(subdata, -1, -2), (-1, ny))
+    colmask = np.reshape(np.swapaxes(submask, -1, -2), (-1, ny)).copy()
+    ncol = coldata.shape[0]
+    yvals = np.arange(ny)
+    profile = np.zeros(coldata.shape)
+    # Set initial guesses
+    guess = np.zeros((ncol, 3))
+    guess[:, 0] = ny/10.
+    guess[:, 1] = np.argmax(coldata, axis=1)
+    guess[:, 2] = np.max(coldata, axis=1)
     maxiter = ny
-    for i in range(nx):
-        nobadpixels = False
-        iternum = 0
-        # Do not want to alter original data
-        dataslice = np.copy(subdata[:, i])
-        # Set initial guess if none given
-        guess = [ny/10., np.argmax(dataslice), dataslice.max()]
-        while not nobadpixels and iternum < maxiter:
-            # Fit Gaussian to each column
-            if sum(submask[:, i]) >= 3:
-                params, err = g.fitgaussian(dataslice, np.arange(ny),
-                                            mask=submask[:, i], fitbg=0,
-                                            guess=guess)
-            else:
-                params = guess
-                err = None
-            # Create model
-            model = g.gaussian(np.arange(ny), params[0], params[1], params[2])
-            if isplots == 7:
+    iternum = 0
+    active = np.arange(ncol)
+    while len(active) > 0 and iternum < maxiter:
+        # Fit Gaussian to each column with enough good pixels
+        params = np.copy(guess[active])
+        isfit = np.sum(colmask[active], axis=1) >= 3
+        # Columns which are not fit are treated as failed fits
+        failed = ~isfit
+        if np.any(isfit):
+            fitind = active[isfit]
+            # The fits hold the background fixed at the median good value
+            bg = np.nanmedian(np.where(colmask[fitind] != 0, coldata[fitind],
+                                       np.nan), axis=1)
+            params[isfit], failed[isfit] = g.fitgaussian_batch(
+                coldata[fitind], yvals, colmask[fitind], guess[fitind],
+                bg=bg)
+        # Create model
+        model = params[:, 2:3]*np.exp(-0.5*((yvals-params[:, 1:2]) /
+                                            params[:, 0:1])**2)
+        profile[active] = model
+        if isplots == 7:
+            for k, j in enumerate(active):
                 plt.figure(3703)
                 plt.clf()
-                plt.suptitle(str(i) + "," + str(iternum))
-                plt.plot(dataslice, 'ro')
-                plt.plot(dataslice*submask[:, i], 'bo')
-                plt.plot(model, 'g-')
+                plt.suptitle(str(j % nx) + "," + str(iternum))
+                plt.plot(coldata[j], 'ro')
+                plt.plot(coldata[j]*colmask[j], 'bo')
+                plt.plot(model[k], 'g-')
                 plt.pause(0.1)
 
-            # Calculate residuals and number of sigma from the model
-            residuals = submask[:, i]*(dataslice - model)
-            if np.std(residuals) == 0:
-                stdevs = np.zeros(residuals.shape)
-            else:
-                stdevs = np.abs(residuals) / np.std(residuals)
-            # Find worst data point
-            loc = np.argmax(stdevs)
-            # Mask data point if > threshold
-            if stdevs[loc] > threshold:
-                # Check for bad fit, possibly due to a bad pixel
-                if i > 0 and (err is None or
-                              np.abs(params[0]) < np.abs(0.2*guess[0])):
-                    # print(i, params)
-                    # Remove brightest pixel within region of fit
-                    loc = (params[1]-3 +
-                           np.argmax(dataslice[params[1]-3:params[1]+4]))
-                    # print(loc)
-                else:
-                    guess = np.abs(params)
-                submask[loc, i] = 0
-            else:
-                nobadpixels = True  # exit while loop
-                guess = np.abs(params)
-            iternum += 1
-
-        profile[:, i] = model
+        # Calculate residuals and number of sigma from the model
+        residuals = colmask[active]*(coldata[active] - model)
+        std = np.std(residuals, axis=1)
+        stdevs = np.zeros(residuals.shape)
+        good = std != 0
+        stdevs[good] = np.abs(residuals[good]) / std[good, np.newaxis]
+        # Find worst data point
+        loc = np.argmax(stdevs, axis=1)
+        # Mask data point if > threshold
+        isbad = stdevs[np.arange(len(active)), loc] > threshold
+        # Check for bad fit, possibly due to a bad pixel
+        badfit = (isbad & (active % nx > 0) &
+                  (failed | (np.abs(params[:, 0]) <
+                             np.abs(0.2*guess[active, 0]))))
+        for k in np.where(badfit)[0]:
+            # Remove brightest pixel within region of fit
+            center = int(np.round(params[k, 1]))
+            lo, hi = max(center-3, 0), min(center+4, ny)
+            if lo < hi:
+                loc[k] = lo + np.argmax(coldata[active[k], lo:hi])
+        guess[active[~badfit]] = np.abs(params[~badfit])
+        colmask[active[isbad], loc[isbad]] = 0
+        iternum += 1
         if iternum == maxiter:
-            print('WARNING: Max number of iterations reached for dataslice ' +
-                  str(i))
+            for j in active:
+                print('WARNING: Max number of iterations reached for '
+                      'dataslice ' + str(j % nx))
+        active = active[isbad]
 
+    profile = np.swapaxes(profile.reshape(shape[:-2]+(nx, ny)), -1, -2)
     # Enforce positivity
     profile[np.where(profile < 0)] = 0
     # Normalize along spatial direction
-    profile /= np.sum(profile, axis=0)
+    profile /= np.sum(profile, axis=-2, keepdims=True)
 
     return profile
 
@@ -595,3 +668,225 @@ def optimize(meta, subdata, mask, bg, spectrum, Q, v0, p5thresh=10,
 
     # Return spectrum and uncertainties
     return spectrum, np.sqrt(specvar), submask
+
+
+def profile_batch(subdata, mask, fittype='smooth', p5thresh=10,
+                  window_len=21, deg=3, windowtype='hanning', meddata=None,
+                  isplots=0):
+    '''Construct normalized spatial profiles for a stack of integrations.
+
+    Parameters
+    ----------
+    subdata : ndarray (3D)
+        Background subtracted data with shape (n_int, ny, nx).
+    mask : ndarray (3D)
+        Outlier mask with the same shape as subdata.
+    fittype : str; optional
+        One of {'smooth', 'meddata', 'wavelet2D', 'wavelet',
+        'gauss', 'poly'}. The type of profile fitting
+        you want to do. Defaults to 'smooth'.
+    p5thresh : float; optional
+        Sigma threshold for outlier rejection while constructing
+        spatial profile. Defaults to 10.
+    window_len : int; optional
+        The dimension of the smoothing window. Defaults to 21.
+    deg : int; optional
+        Polynomial degree. Defaults to 3.
+    windowtype : str; optional
+        UNUSED. The type of window. Defaults to 'hanning'.
+    meddata : ndarray; optional
+        The median of all data frames. Defaults to None.
+    isplots : int; optional
+        The plotting verbosity. Defaults to 0.
+
+    Returns
+    -------
+    profile : ndarray (3D)
+        Fitted profiles in the same shape as the input data array, or None
+        if fittype is unknown.
+    '''
+    n_int, ny, nx = subdata.shape
+    profile = np.zeros(subdata.shape)
+    if fittype == 'meddata':
+        # The median frame does not depend on the mask, so only build it once
+        profile[:] = profile_meddata(subdata[0], mask[0], meddata,
+                                     threshold=p5thresh, isplots=isplots)
+        return profile
+    elif fittype in ['smooth', 'poly', 'gauss']:
+        # These profiles are built for many integrations at once, but in
+        # chunks to limit the size of the temporary arrays
+        chunk = max(1, 2**20//max(1, ny*nx))
+        for k in range(0, n_int, chunk):
+            if fittype == 'smooth':
+                profile[k:k+chunk] = profile_smooth(subdata[k:k+chunk],
+                                                    mask[k:k+chunk],
+                                                    threshold=p5thresh,
+                                                    window_len=window_len,
+                                                    windowtype=windowtype,
+                                                    isplots=isplots)
+            elif fittype == 'poly':
+                profile[k:k+chunk] = profile_poly(subdata[k:k+chunk],
+                                                  mask[k:k+chunk], deg=deg,
+                                                  threshold=p5thresh)
+            else:
+                profile[k:k+chunk] = profile_gauss(subdata[k:k+chunk],
+                                                   mask[k:k+chunk],
+                                                   threshold=p5thresh,
+                                                   isplots=isplots)
+        return profile
+
+    for k in range(n_int):
+        if fittype == 'wavelet2D':
+            profile[k] = profile_wavelet2D(subdata[k], mask[k],
+                                           wavelet='bior5.5', numlvls=3,
+                                           isplots=isplots)
+        elif fittype == 'wavelet':
+            profile[k] = profile_wavelet(subdata[k], mask[k],
+                                         wavelet='bior5.5', numlvls=3,
+                                         isplots=isplots)
+        else:
+            print("Unknown normalized spatial profile method.")
+            return
+
+    return profile
+
+
+def optimize_batch(meta, subdata, mask, bg, spectrum, Q, v0, p5thresh=10,
+                   p7thresh=10, fittype='smooth', window_len=21, deg=3,
+                   windowtype='hanning', n=0, m=0, meddata=None,
+                   dtype=float):
+    '''Extract optimal spectra with uncertainties for many integrations.
+
+    This performs the same steps as optimize, but operates on the full
+    (n_int, ny, nx) aperture cube at once. Steps 6-8 are evaluated as
+    array operations over all integrations and only the integrations that
+    still have outliers are iterated upon.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    subdata : ndarray (3D)
+        Background subtracted data with shape (n_int, ny, nx).
+    mask : ndarray (3D)
+        Outlier mask.
+    bg : ndarray (3D)
+        Background array.
+    spectrum : ndarray (2D)
+        Standard spectra with shape (n_int, nx).
+    Q : float
+        The gain factor.
+    v0 : ndarray (3D)
+        Variance array for data.
+    p5thresh : float; optional
+        Sigma threshold for outlier rejection while constructing
+        spatial profile. Defaults to 10.
+    p7thresh : float; optional
+        Sigma threshold for outlier rejection during optimal
+        spectral extraction. Defaults to 10.
+    fittype : str; optional
+        One of {'smooth', 'meddata', 'wavelet2D', 'wavelet',
+        'gauss', 'poly'}. The type of profile fitting
+        you want to do. Defaults to 'smooth'.
+    window_len : int; optional
+        The dimension of the smoothing window. Defaults to 21.
+    deg : int; optional
+        Polynomial degree. Defaults to 3.
+    windowtype : str; optional
+        UNUSED. One of {'flat', 'hanning', 'hamming',
+        'bartlett', 'blackman'}.
+        The type of window. A flat window will produce a moving
+        average smoothing. Defaults to 'hanning'.
+    n : int; optional
+        Integration number of the first integration. Defaults to 0.
+    m : int; optional
+        File number. Defaults to 0.
+    meddata : ndarray; optional
+        The median of all data frames. Defaults to None.
+    dtype : numpy.dtype; optional
+        The type of the profile and variance cubes. The sums over each
+        column are always accumulated in double precision. Defaults to
+        float.
+
+    Returns
+    -------
+    spectrum : ndarray (2D)
+        The optimally extracted spectra.
+    specunc : ndarray (2D)
+        The standard deviation on the spectra.
+    submask : ndarray (3D)
+        The mask array.
+    '''
+    submask = np.copy(mask)
+    spectrum = np.array(spectrum, dtype=float)
+    n_int, ny, nx = subdata.shape
+    profile = np.zeros(subdata.shape, dtype=dtype)
+    variance = np.ones(subdata.shape, dtype=dtype)
+    denom = np.zeros((n_int, nx))
+    isnewprofile = np.ones(n_int, dtype=bool)
+    # Loop through steps 5-8 until no more bad pixels are uncovered
+    while np.any(isnewprofile):
+        inew = np.where(isnewprofile)[0]
+        # STEP 5: Construct normalized spatial profiles
+        newprofile = profile_batch(subdata[inew], submask[inew],
+                                   fittype=fittype, p5thresh=p5thresh,
+                                   window_len=window_len, deg=deg,
+                                   windowtype=windowtype, meddata=meddata,
+                                   isplots=meta.isplots_S3)
+        if newprofile is None:
+            return
+        profile[inew] = newprofile
+
+        if meta.isplots_S3 >= 3:
+            for k in inew:
+                plots_s3.profile(meta, profile[k], submask[k], n+k, m)
+
+        isnewprofile[:] = False
+        # Loop through steps 6-8 on the integrations that still have outliers
+        active = inew
+        while len(active) > 0:
+            subprofile = profile[active]
+            # STEP 6: Revise variance estimates
+            expected = subprofile*spectrum[active, np.newaxis].astype(dtype)
+            variance[active] = (np.abs(expected + bg[active]) / Q +
+                                v0[active])
+            # STEP 7: Mask cosmic ray hits
+            isoutliers = np.zeros(len(active), dtype=bool)
+            if ny > 0:
+                stdevs = (np.abs(subdata[active] - expected)*submask[active] /
+                          np.sqrt(variance[active]))
+                # Find worst data point in each column
+                loc = np.argmax(stdevs, axis=1)
+                worst = np.take_along_axis(stdevs, loc[:, np.newaxis],
+                                           axis=1)[:, 0]
+                # Mask data point if std is > p7thresh
+                ia, ix = np.where(worst > p7thresh)
+                ik = active[ia]
+                submask[ik, loc[ia, ix], ix] = 0
+                # Generate plots
+                if meta.isplots_S3 >= 5:
+                    for a, i in zip(ia, ix):
+                        plots_s3.subdata(meta, i, n+active[a], m,
+                                         subdata[active[a]],
+                                         submask[active[a]], expected[a],
+                                         loc[a])
+                # Check for insufficient number of good points
+                toofew = np.sum(submask[ik, :, ix], axis=1) < ny/2.
+                submask[ik[toofew], :, ix[toofew]] = 0
+                isoutliers[ia] = True
+                isnewprofile[ik] = True
+            # STEP 8: Extract optimal spectra
+            subdenom = np.sum(subprofile*subprofile*submask[active] /
+                              variance[active], axis=1, dtype=np.float64)
+            subdenom[np.where(subdenom == 0)] = np.inf
+            denom[active] = subdenom
+            spectrum[active] = np.sum(subprofile*submask[active] *
+                                      subdata[active]/variance[active],
+                                      axis=1, dtype=np.float64) / subdenom
+            active = active[isoutliers]
+
+    # Calculate variance of optimal spectra
+    specvar = np.sum(profile*submask, axis=1, dtype=np.float64) / denom
+
+    # Return spectra and uncertainties
+    return spectrum, np.sqrt(specvar), submask
@@ -3,6 +3,8 @@ import os
 import matplotlib.pyplot as plt
 from .source_pos import gauss
 from ..lib.plots import figure_filetype
+from ..lib import maskflags
+from ..lib import plotqueue
 
 
 def lc_nodriftcorr(meta, wave_1d, optspec):
@@ -45,7 +47,7 @@ def lc_nodriftcorr(meta, wave_1d, optspec):
         plt.pause(0.2)
 
 
-def image_and_background(data, meta, n, m):
+def image_and_background(data, meta, n, m, int_offset=0):
     '''Make image+background plot. (Figs 3301)
 
     Parameters
@@ -58,39 +60,51 @@ def image_and_background(data, meta, n, m):
         The integration number.
     m : int
         The file number.
+    int_offset : int; optional
+        The index within the segment of the first integration in data, if
+        data only holds a chunk of the segment. Defaults to 0.
 
     Returns
     -------
     None
     '''
-    intstart, subdata, submask, subbg = (data.attrs['intstart'],
-                                         data.flux.values, data.mask.values,
-                                         data.bg.values)
-    xmin, xmax = data.flux.x.min().values, data.flux.x.max().values
-    ymin, ymax = data.flux.y.min().values, data.flux.y.max().values
+    if (int_offset + n) % meta.plot_every != 0:
+        return
+    # Only send the arrays of this integration to the renderer
+    extent = [data.flux.x.min().values, data.flux.x.max().values,
+              data.flux.y.min().values, data.flux.y.max().values]
+    plotqueue.render(_image_and_background, meta, data.attrs['intstart'],
+                     data.flux.values[n],
+                     maskflags.good(data.mask.values[n]),
+                     data.bg.values[n], extent, n, m, int_offset)
 
+
+def _image_and_background(meta, intstart, subdata, submask, subbg, extent,
+                          n, m, int_offset):
+    # Draws Fig 3301 for image_and_background
     plt.figure(3301, figsize=(8, 8))
     plt.clf()
-    plt.suptitle(f'Integration {intstart + n}')
+    plt.suptitle(f'Integration {intstart + int_offset + n}')
     plt.subplot(211)
     plt.title('Background-Subtracted Flux')
-    max = np.max(subdata[n] * submask[n])
-    plt.imshow(subdata[n]*submask[n], origin='lower', aspect='auto',
-               vmin=0, vmax=max/10, extent=[xmin, xmax, ymin, ymax])
+    max = np.max(subdata * submask)
+    plt.imshow(subdata*submask, origin='lower', aspect='auto',
+               vmin=0, vmax=max/10, extent=extent)
     plt.colorbar()
     plt.ylabel('Detector Pixel Position')
     plt.subplot(212)
     plt.title('Subtracted Background')
-    median = np.median(subbg[n])
-    std = np.std(subbg[n])
-    plt.imshow(subbg[n], origin='lower', aspect='auto', vmin=median-3*std,
-               vmax=median+3*std, extent=[xmin, xmax, ymin, ymax])
+    median = np.median(subbg)
+    std = np.std(subbg)
+    plt.imshow(subbg, origin='lower', aspect='auto', vmin=median-3*std,
+               vmax=median+3*std, extent=extent)
     plt.colorbar()
     plt.ylabel('Detector Pixel Position')
     plt.xlabel('Detector Pixel Position')
     plt.tight_layout()
     file_number = str(m).zfill(int(np.floor(np.log10(meta.num_data_files))+1))
-    int_number = str(n).zfill(int(np.floor(np.log10(meta.n_int))+1))
+    int_number = str(int_offset + n).zfill(
+        int(np.floor(np.log10(meta.n_int))+1))
     fname = (f'figs{os.sep}fig3301_file{file_number}_int{int_number}' +
              '_ImageAndBackground'+figure_filetype)
     plt.savefig(meta.outputdir+fname, dpi=300)
@@ -116,17 +130,21 @@ def optimal_spectrum(data, meta, n, m):
     -------
     None
     '''
-    intstart, stdspec, optspec, opterr = (data.attrs['intstart'],
-                                          data.stdspec.values,
-                                          data.optspec.values,
-                                          data.opterr.values)
+    if n % meta.plot_every != 0:
+        return
+    # Only send the spectra of this integration to the renderer
+    plotqueue.render(_optimal_spectrum, meta, data.attrs['intstart'],
+                     data.stdspec.x.values, data.stdspec.values[n],
+                     data.optspec.values[n], data.opterr.values[n], n, m)
+
 
+def _optimal_spectrum(meta, intstart, x, stdspec, optspec, opterr, n, m):
+    # Draws Fig 3302 for optimal_spectrum
     plt.figure(3302)
     plt.clf()
     plt.suptitle(f'1D Spectrum - Integration {intstart + n}')
-    plt.semilogy(data.stdspec.x.values, stdspec[n], '-', color='C1',
-                 label='Standard Spec')
-    plt.errorbar(data.stdspec.x.values, optspec[n], yerr=opterr[n], fmt='-',
+    plt.semilogy(x, stdspec, '-', color='C1', label='Standard Spec')
+    plt.errorbar(x, optspec, yerr=opterr, fmt='-',
                  color='C2', ecolor='C2', label='Optimal Spec')
     plt.ylabel('Flux')
     plt.xlabel('Detector Pixel Position')
@@ -186,6 +204,14 @@ def source_position(meta, x_dim, pos_max, m,
     - Oct 15, 2021: Taylor Bell
         Tidied up the code a bit to reduce repeated code.
     '''
+    plotqueue.render(_source_position, meta, x_dim, pos_max, m,
+                     isgauss=isgauss, popt=popt, isFWM=isFWM,
+                     y_pixels=y_pixels, sum_row=sum_row, y_pos=y_pos)
+
+
+def _source_position(meta, x_dim, pos_max, m, isgauss=False, popt=None,
+                     isFWM=False, y_pixels=None, sum_row=None, y_pos=None):
+    # Draws Fig 3303 for source_position
     plt.figure(3303)
     plt.clf()
     plt.plot(y_pixels, sum_row, 'o', label='Data')
@@ -230,6 +256,13 @@ def profile(meta, profile, submask, n, m):
     -------
     None
     '''
+    if n % meta.plot_every != 0:
+        return
+    plotqueue.render(_profile, meta, profile, submask, n, m)
+
+
+def _profile(meta, profile, submask, n, m):
+    # Draws Fig 3304 for profile
     profile = np.ma.masked_invalid(profile)
     submask = np.ma.masked_invalid(submask)
     mask = np.logical_or(np.ma.getmaskarray(profile),
@@ -281,6 +314,14 @@ def subdata(meta, i, n, m, subdata, submask, expected, loc):
     -------
     None
     '''
+    if n % meta.plot_every != 0:
+        return
+    plotqueue.render(_subdata, meta, i, n, m, subdata, submask, expected,
+                     loc)
+
+
+def _subdata(meta, i, n, m, subdata, submask, expected, loc):
+    # Draws Fig 3501 for subdata
     ny, nx = subdata.shape
     plt.figure(3501)
     plt.clf()
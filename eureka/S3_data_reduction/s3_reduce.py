@@ -22,19 +22,29 @@
 # 16. Save Stage 3 data products
 # 17. Produce plots DONE
 
+import os
+import mmap
 import time as time_pkg
+import copy
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import astraeus.xarrayIO as xrio
 from astropy.io import fits
 from tqdm import tqdm
 from . import optspex
-from . import plots_s3, source_pos
+from . import plots_s3, source_pos, stepcache, checkpoint
 from . import background as bg
 from . import bright2flux as b2f
 from ..lib import logedit
 from ..lib import readECF
 from ..lib import manageevent as me
 from ..lib import util
+from ..lib import outputwriter
+from ..lib import maskflags
+from ..lib import medianframe
+from ..lib import plotqueue
 
 
 def reduce(eventlabel, ecf_path=None, s2_meta=None):
@@ -104,10 +114,99 @@ def reduce(eventlabel, ecf_path=None, s2_meta=None):
     else:
         meta.bg_hw_range = [meta.bg_hw]
 
+    if not hasattr(meta, 'batch_optspex'):
+        # The default value before this was added as an option
+        meta.batch_optspex = False
+
+    if not hasattr(meta, 'max_concurrent_segments'):
+        # The default value before this was added as an option
+        meta.max_concurrent_segments = 1
+
+    if not hasattr(meta, 'sweep_reuse'):
+        # The default value before this was added as an option
+        meta.sweep_reuse = False
+
+    if not hasattr(meta, 'int_chunk_size'):
+        # The default value before this was added as an option
+        meta.int_chunk_size = None
+
+    if not hasattr(meta, 'prefetch_depth'):
+        # The default value before this was added as an option
+        meta.prefetch_depth = 0
+
+    if not hasattr(meta, 'prefetch_max_size'):
+        # Bound the memory used by the read-ahead unless asked otherwise
+        meta.prefetch_max_size = 2
+
+    if not hasattr(meta, 'output_compression'):
+        # The default value before this was added as an option
+        meta.output_compression = None
+
+    if not hasattr(meta, 'output_chunk_nint'):
+        # The default value before this was added as an option
+        meta.output_chunk_nint = None
+
+    if not hasattr(meta, 'max_pending_writes'):
+        # The default value before this was added as an option
+        meta.max_pending_writes = 0
+
+    if not hasattr(meta, 'cache_dir'):
+        # The default value before this was added as an option
+        meta.cache_dir = None
+
+    if not hasattr(meta, 'cache_max_size'):
+        # The default value before this was added as an option
+        meta.cache_max_size = None
+
+    if not hasattr(meta, 'precision'):
+        # The default value before this was added as an option
+        meta.precision = 'float64'
+    elif meta.precision not in ['float64', 'float32']:
+        raise ValueError(f'Unknown precision {meta.precision}. Options are '
+                         f'\'float64\' or \'float32\'.')
+
+    if not hasattr(meta, 'median_method'):
+        # The default value before this was added as an option
+        meta.median_method = 'exact'
+    elif meta.median_method not in ['exact', 'p2']:
+        raise ValueError(f'Unknown median_method {meta.median_method}. '
+                         f'Options are \'exact\' or \'p2\'.')
+
+    if not hasattr(meta, 'ancil_dir'):
+        # The default value before this was added as an option
+        meta.ancil_dir = None
+
+    if not hasattr(meta, 'plot_ncpu'):
+        # The default value before this was added as an option
+        meta.plot_ncpu = 0
+
+    if not hasattr(meta, 'plot_every'):
+        # The default value before this was added as an option
+        meta.plot_every = 1
+
+    if not hasattr(meta, 'track_ypos'):
+        # The default value before this was added as an option
+        meta.track_ypos = False
+
+    if not hasattr(meta, 'resume'):
+        # The default value before this was added as an option
+        meta.resume = False
+
     # create directories to store data
     # run_s3 used to make sure we're always looking at the right run for
     # each aperture/annulus pair
     meta.run_s3 = None
+    checkpoints = None
+    if meta.resume:
+        if meta.sweep_reuse and (len(meta.spec_hw_range) > 1 or
+                                 len(meta.bg_hw_range) > 1):
+            raise ValueError('resume is not supported with sweep_reuse, '
+                             'please set one of them to False.')
+        # Continue the latest run made with the same settings, if any
+        config = checkpoint.config_key(meta)
+        previous = checkpoint.find_run(meta, config)
+        if previous is not None:
+            meta.datetime, meta.run_s3 = previous
     for spec_hw_val in meta.spec_hw_range:
 
         for bg_hw_val in meta.bg_hw_range:
@@ -117,72 +216,47 @@ def reduce(eventlabel, ecf_path=None, s2_meta=None):
             meta.run_s3 = util.makedirectory(meta, 'S3', meta.run_s3,
                                              ap=spec_hw_val, bg=bg_hw_val)
 
-    # begin process
-    for spec_hw_val in meta.spec_hw_range:
-        for bg_hw_val in meta.bg_hw_range:
+    if meta.resume:
+        checkpoints = checkpoint.Checkpoint(
+            util.pathdirectory(meta, 'S3', meta.run_s3), config)
 
-            t0 = time_pkg.time()
+    # Keep the same background subtraction workers for every segment and
+    # aperture/annulus pair
+    if meta.ncpu > 1:
+        bgpool = bg.BGPool(meta.ncpu)
+    else:
+        bgpool = None
 
-            meta.spec_hw = spec_hw_val
-            meta.bg_hw = bg_hw_val
+    # Write the FluxData files while the next segment is being reduced
+    if meta.max_pending_writes > 0:
+        writer = outputwriter.OutputWriter(meta.max_pending_writes)
+    else:
+        writer = None
 
-            meta.outputdir = util.pathdirectory(meta, 'S3', meta.run_s3,
-                                                ap=spec_hw_val, bg=bg_hw_val)
+    # Draw the figures on other processes while the reduction continues
+    plotter = plotqueue.start(meta.plot_ncpu)
 
-            event_ap_bg = (meta.eventlabel+"_ap"+str(spec_hw_val)+'_bg' +
-                           str(bg_hw_val))
+    # begin process
+    if meta.sweep_reuse and (len(meta.spec_hw_range) > 1 or
+                             len(meta.bg_hw_range) > 1):
+        # Share the aperture-independent work between all pairs
+        spec, meta = reduce_sweep(meta, s2_meta, bgpool, writer)
+        if bgpool is not None:
+            bgpool.close()
+        if writer is not None:
+            writer.close()
+        if plotter is not None:
+            plotter.close()
+        return spec, meta
 
-            # Open new log file
-            meta.s3_logname = meta.outputdir + 'S3_' + event_ap_bg + ".log"
-            if s2_meta is not None:
-                log = logedit.Logedit(meta.s3_logname, read=s2_meta.s2_logname)
-            else:
-                log = logedit.Logedit(meta.s3_logname)
-            log.writelog("\nStarting Stage 3 Reduction\n")
-            log.writelog(f"Input directory: {meta.inputdir}")
-            log.writelog(f"Output directory: {meta.outputdir}")
-            log.writelog(f"Using ap={spec_hw_val}, bg={bg_hw_val}")
-
-            # Copy ecf
-            log.writelog('Copying S3 control file', mute=(not meta.verbose))
-            meta.copy_ecf()
-
-            # Create list of file segments
-            meta = util.readfiles(meta)
-            meta.num_data_files = len(meta.segment_list)
-            if meta.num_data_files == 0:
-                log.writelog(f'Unable to find any "{meta.suffix}.fits" files '
-                             f'in the inputdir: \n"{meta.inputdir}"!',
-                             mute=True)
-                raise AssertionError(f'Unable to find any "{meta.suffix}.fits"'
-                                     f' files in the inputdir: \n'
-                                     f'"{meta.inputdir}"!')
-            else:
-                log.writelog(f'\nFound {meta.num_data_files} data file(s) '
-                             f'ending in {meta.suffix}.fits',
-                             mute=(not meta.verbose))
+    for spec_hw_val in meta.spec_hw_range:
+        for bg_hw_val in meta.bg_hw_range:
 
-            with fits.open(meta.segment_list[-1]) as hdulist:
-                # Figure out which instrument we are using
-                meta.inst = hdulist[0].header['INSTRUME'].lower()
-            # Load instrument module
-            if meta.inst == 'miri':
-                from . import miri as inst
-            elif meta.inst == 'nircam':
-                from . import nircam as inst
-            elif meta.inst == 'nirspec':
-                from . import nirspec as inst
-                log.writelog('WARNING: Are you using real JWST data? If so, '
-                             'you should edit the flag_bg() function in '
-                             'nirspec.py and look at Issue #193 on Github!')
-            elif meta.inst == 'niriss':
-                raise ValueError('NIRISS observations are currently '
-                                 'unsupported!')
-            elif meta.inst == 'wfc3':
-                from . import wfc3 as inst
-                meta, log = inst.preparation_step(meta, log)
-            else:
-                raise ValueError('Unknown instrument {}'.format(meta.inst))
+            t0 = time_pkg.time()
+
+            meta, log, inst, event_ap_bg = setup_ap_bg(
+                meta, s2_meta, spec_hw_val, bg_hw_val,
+                append=checkpoints is not None)
 
             datasets = []
             # Loop over each segment
@@ -192,239 +266,1463 @@ def reduce(eventlabel, ecf_path=None, s2_meta=None):
                 istart = meta.num_data_files - 1
             else:
                 istart = 0
-            for m in range(istart, meta.num_data_files):
+            segments = range(istart, meta.num_data_files)
+            if checkpoints is not None:
+                # Reuse the segments which the previous attempt finished
+                done = checkpoints.load(meta, event_ap_bg, segments)
+                for data, changes in done:
+                    datasets.append(data)
+                    meta = stepcache.apply_changes(meta, changes)
+                if len(done) > 0:
+                    log.writelog(f'  Resuming after {len(done)} finished '
+                                 f'segment(s)', mute=(not meta.verbose))
+                segments = segments[len(done):]
+            if meta.max_concurrent_segments > 1 and meta.inst == 'wfc3':
+                log.writelog('  WFC3 segments depend on the previous '
+                             'segments, so they will be reduced one at a '
+                             'time', mute=(not meta.verbose))
+            if meta.prefetch_depth > 0 and meta.inst == 'wfc3':
+                log.writelog('  WFC3 segments depend on the previous '
+                             'segments, so they will not be read ahead',
+                             mute=(not meta.verbose))
+            if meta.int_chunk_size and meta.inst == 'wfc3':
+                log.writelog('  WFC3 segments cannot be reduced in chunks of '
+                             'integrations, so int_chunk_size will be '
+                             'ignored', mute=(not meta.verbose))
+            if meta.max_concurrent_segments > 1 and meta.inst != 'wfc3':
+                # Only the first segment can change meta (e.g. the MIRI
+                # x and y windows), so reduce the rest in parallel
+                nserial = int(len(segments) > 0 and segments[0] == istart)
+            else:
+                nserial = len(segments)
+            prefetcher = None
+            for i, m in enumerate(segments[:nserial]):
                 # Initialize data object
-                data = xrio.makeDataset()
+                if prefetcher is not None:
+                    data = prefetcher.get(m)
+                else:
+                    data = xrio.makeDataset()
 
                 # Keep track if this is the first file - otherwise MIRI will
                 # keep swapping x and y windows
                 meta.firstFile = (m == istart and
                                   meta.spec_hw == meta.spec_hw_range[0] and
                                   meta.bg_hw == meta.bg_hw_range[0])
-                # Report progress
-                if meta.verbose:
-                    log.writelog(f'Reading file {m + 1} of '
-                                 f'{meta.num_data_files}')
-                else:
-                    log.writelog(f'Reading file {m + 1} of '
-                                 f'{meta.num_data_files}', end='\r')
+                if checkpoints is not None:
+                    before = stepcache.snapshot(meta)
+                data, meta = reduce_segment(data, meta, log, m,
+                                            event_ap_bg, bgpool, writer)
+                if checkpoints is not None:
+                    save_checkpoint(checkpoints, meta, event_ap_bg, m, data,
+                                    stepcache.get_changes(meta, before),
+                                    writer)
 
-                # Read in data frame and header
-                data, meta = inst.read(meta.segment_list[m], data, meta)
+                # Append results for future concatenation
+                datasets.append(data)
 
-                # Get number of integrations and frame dimensions
-                meta.n_int, meta.ny, meta.nx = data.flux.shape
-                if meta.testing_S3:
-                    # Only process the last 5 integrations when testing
-                    meta.int_start = np.max((0, meta.n_int-5))
-                else:
-                    meta.int_start = 0
-
-                # Trim data to subarray region of interest
-                # Dataset object no longer contains untrimmed data
-                data, meta = util.trim(data, meta)
-
-                # Locate source postion
-                meta.src_ypos = source_pos.source_pos(
-                    data, meta, m, header=('SRCYPOS' in data.attrs['shdr']))
-                log.writelog(f'  Source position on detector is row '
-                             f'{meta.src_ypos}.', mute=(not meta.verbose))
-
-                # Compute 1D wavelength solution
-                if 'wave_2d' in data:
-                    data['wave_1d'] = (['x'],
-                                       data.wave_2d[meta.src_ypos].values)
-                    data['wave_1d'].attrs['wave_units'] = \
-                        data.wave_2d.attrs['wave_units']
-
-                # Convert flux units to electrons
-                # (eg. MJy/sr -> DN -> Electrons)
-                data, meta = b2f.convert_to_e(data, meta, log)
-
-                # Compute median frame
-                data['medflux'] = (['y', 'x'], np.median(data.flux.values,
-                                                         axis=0))
-                data['medflux'].attrs['flux_units'] = \
-                    data.flux.attrs['flux_units']
-
-                # Create bad pixel mask (1 = good, 0 = bad)
-                # FINDME: Will want to use DQ array in the future
-                # to flag certain pixels
-                data['mask'] = (['time', 'y', 'x'], np.ones(data.flux.shape,
-                                                            dtype=bool))
-
-                # Check if arrays have NaNs
-                data['mask'] = util.check_nans(data['flux'], data['mask'],
-                                               log, name='FLUX')
-                data['mask'] = util.check_nans(data['err'], data['mask'],
-                                               log, name='ERR')
-                data['mask'] = util.check_nans(data['v0'], data['mask'],
-                                               log, name='V0')
-
-                # Manually mask regions [colstart, colend, rowstart, rowend]
-                if hasattr(meta, 'manmask'):
-                    log.writelog("  Masking manually identified bad pixels",
-                                 mute=(not meta.verbose))
-                    for i in range(len(meta.manmask)):
-                        colstart, colend, rowstart, rowend = meta.manmask[i]
-                        data['mask'][rowstart:rowend, colstart:colend] = 0
+                if (prefetcher is None and meta.prefetch_depth > 0 and
+                        meta.inst != 'wfc3' and i+1 < nserial):
+                    # Reading the first segment can change meta (e.g. the
+                    # MIRI x and y windows), so only read ahead after it
+                    prefetcher = SegmentPrefetcher(meta,
+                                                   segments[i+1:nserial],
+                                                   meta.prefetch_depth,
+                                                   meta.prefetch_max_size)
+            if prefetcher is not None:
+                prefetcher.close()
+
+            if nserial < len(segments):
+                meta.firstFile = False
+                if writer is not None:
+                    # Finish writing before the worker processes are
+                    # forked, so they do not inherit the HDF5 lock while
+                    # the writer thread holds it
+                    writer.flush()
+                parallel_datasets, meta = \
+                    reduce_segments_parallel(meta, log, segments[nserial:],
+                                             event_ap_bg, checkpoints)
+                datasets.extend(parallel_datasets)
+
+            if writer is not None:
+                # Make sure every FluxData file of this pair is complete
+                writer.flush()
+
+            spec, meta = finish_ap_bg(meta, log, inst, datasets, event_ap_bg,
+                                      t0)
+
+    if bgpool is not None:
+        bgpool.close()
+    if writer is not None:
+        writer.close()
+    if plotter is not None:
+        plotter.close()
+
+    return spec, meta
+
+
+def setup_ap_bg(meta, s2_meta, spec_hw_val, bg_hw_val, append=False):
+    '''Sets up the output directory, log, and file list for one
+    aperture/annulus pair.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    s2_meta : eureka.lib.readECF.MetaClass
+        The metadata object from Eureka!'s S2 step, or None.
+    spec_hw_val : int
+        The half-width of the spectral aperture.
+    bg_hw_val : int
+        The half-width of the background exclusion region.
+    append : bool; optional
+        If True, keep the lines of this pair's log from a previous attempt
+        of the same run. Defaults to False.
+
+    Returns
+    -------
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    log : logedit.Logedit
+        The newly opened log for this pair.
+    inst : module
+        The instrument module.
+    event_ap_bg : str
+        The event label including the aperture and annulus sizes.
+    '''
+    meta.spec_hw = spec_hw_val
+    meta.bg_hw = bg_hw_val
+
+    meta.outputdir = util.pathdirectory(meta, 'S3', meta.run_s3,
+                                        ap=spec_hw_val, bg=bg_hw_val)
+
+    event_ap_bg = (meta.eventlabel+"_ap"+str(spec_hw_val)+'_bg' +
+                   str(bg_hw_val))
+
+    # Open new log file
+    meta.s3_logname = meta.outputdir + 'S3_' + event_ap_bg + ".log"
+    if append and os.path.exists(meta.s3_logname):
+        log = logedit.Logedit(meta.s3_logname, read=meta.s3_logname)
+    elif s2_meta is not None:
+        log = logedit.Logedit(meta.s3_logname, read=s2_meta.s2_logname)
+    else:
+        log = logedit.Logedit(meta.s3_logname)
+    log.writelog("\nStarting Stage 3 Reduction\n")
+    log.writelog(f"Input directory: {meta.inputdir}")
+    log.writelog(f"Output directory: {meta.outputdir}")
+    log.writelog(f"Using ap={spec_hw_val}, bg={bg_hw_val}")
+
+    # Copy ecf
+    log.writelog('Copying S3 control file', mute=(not meta.verbose))
+    meta.copy_ecf()
+
+    # Create list of file segments
+    meta = util.readfiles(meta)
+    meta.num_data_files = len(meta.segment_list)
+    if meta.num_data_files == 0:
+        log.writelog(f'Unable to find any "{meta.suffix}.fits" files '
+                     f'in the inputdir: \n"{meta.inputdir}"!',
+                     mute=True)
+        raise AssertionError(f'Unable to find any "{meta.suffix}.fits"'
+                             f' files in the inputdir: \n'
+                             f'"{meta.inputdir}"!')
+    else:
+        log.writelog(f'\nFound {meta.num_data_files} data file(s) '
+                     f'ending in {meta.suffix}.fits',
+                     mute=(not meta.verbose))
+
+    with fits.open(meta.segment_list[-1]) as hdulist:
+        # Figure out which instrument we are using
+        meta.inst = hdulist[0].header['INSTRUME'].lower()
+    # Load instrument module
+    inst = load_inst(meta)
+    if meta.inst == 'nirspec':
+        log.writelog('WARNING: Are you using real JWST data? If so, '
+                     'you should edit the flag_bg() function in '
+                     'nirspec.py and look at Issue #193 on Github!')
+    elif meta.inst == 'wfc3':
+        meta, log = inst.preparation_step(meta, log)
+
+    return meta, log, inst, event_ap_bg
+
+
+def finish_ap_bg(meta, log, inst, datasets, event_ap_bg, t0):
+    '''Concatenates and saves the spectra of one aperture/annulus pair.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log for this pair, which is closed at the end.
+    inst : module
+        The instrument module.
+    datasets : list
+        The Dataset objects of each segment.
+    event_ap_bg : str
+        The event label including the aperture and annulus sizes.
+    t0 : float
+        The time at which the reduction of this pair started.
+
+    Returns
+    -------
+    spec : Xarray Dataset
+        The Dataset object containing the time-series of 1D spectra.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    '''
+    if meta.inst == 'wfc3':
+        # WFC3 needs a conclusion step to convert lists into
+        # arrays before saving
+        meta, log = inst.conclusion_step(meta, log)
+
+    # Concatenate results along time axis (default)
+    spec = xrio.concat(datasets)
+
+    # Calculate total time
+    total = (time_pkg.time() - t0) / 60.
+    log.writelog('\nTotal time (min): ' + str(np.round(total, 2)))
+
+    # Save Dataset object containing time-series of 1D spectra
+    meta.filename_S3_SpecData = (meta.outputdir+'S3_'+event_ap_bg +
+                                 "_SpecData.h5")
+    xrio.writeXR(meta.filename_S3_SpecData, spec, verbose=True)
+
+    # Compute MAD value
+    meta.mad_s3 = util.get_mad(meta, spec.wave_1d, spec.optspec)
+    log.writelog(f"Stage 3 MAD = "
+                 f"{np.round(meta.mad_s3, 2).astype(int)} ppm")
+
+    if meta.isplots_S3 >= 1:
+        log.writelog('Generating figure')
+        # 2D light curve without drift correction
+        plots_s3.lc_nodriftcorr(meta, spec.wave_1d, spec.optspec)
+
+    # Save results
+    if meta.save_output:
+        log.writelog('Saving Metadata')
+        fname = meta.outputdir + 'S3_' + event_ap_bg + "_Meta_Save"
+        me.saveevent(meta, fname, save=[])
 
-                # Perform outlier rejection of sky background along time axis
-                log.writelog('  Performing background outlier rejection',
+    log.closelog()
+
+    return spec, meta
+
+
+def reduce_sweep(meta, s2_meta, bgpool=None, writer=None):
+    '''Reduces all aperture/annulus pairs while sharing the work
+    which does not depend on them.
+
+    Each segment is read and calibrated only once, its background is
+    subtracted once per annulus size, and only the spectral extraction
+    is repeated for every aperture size. The outputs of every pair are
+    the same as when reducing each pair on its own.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    s2_meta : eureka.lib.readECF.MetaClass
+        The metadata object from Eureka!'s S2 step, or None.
+    bgpool : eureka.S3_data_reduction.background.BGPool; optional
+        A persistent pool of workers for background subtraction. Defaults
+        to None.
+    writer : eureka.lib.outputwriter.OutputWriter; optional
+        The background writer of the FluxData files. Defaults to None,
+        which writes them right away.
+
+    Returns
+    -------
+    spec : Xarray Dataset
+        The Dataset object containing the time-series of 1D spectra of the
+        last aperture/annulus pair.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object of the last aperture/annulus pair.
+    '''
+    t0 = time_pkg.time()
+    # The attributes which differ between each pair
+    pair_keys = ['spec_hw', 'bg_hw', 'outputdir', 's3_logname']
+
+    # Set up the outputs of every pair
+    pairs = []
+    for spec_hw_val in meta.spec_hw_range:
+        for bg_hw_val in meta.bg_hw_range:
+            pairmeta, log, inst, event_ap_bg = setup_ap_bg(
+                copy.deepcopy(meta), s2_meta, spec_hw_val, bg_hw_val)
+            pairs.append({'meta': pairmeta, 'log': log,
+                          'event_ap_bg': event_ap_bg, 'datasets': []})
+    if pairs[0]['meta'].inst == 'wfc3':
+        raise ValueError('sweep_reuse is not supported for WFC3 data, '
+                         'since each pair needs its own reference frames.')
+    for pair in pairs:
+        pair['log'].writelog('  Sharing the aperture-independent steps with '
+                             f'{len(pairs)-1} other aperture/annulus pairs',
                              mute=(not meta.verbose))
-                meta.bg_y2 = int(meta.src_ypos + bg_hw_val)
-                meta.bg_y1 = int(meta.src_ypos - bg_hw_val)
-                data = inst.flag_bg(data, meta)
-
-                data = bg.BGsubtraction(data, meta, log, meta.isplots_S3)
-
-                if meta.isplots_S3 >= 3:
-                    log.writelog('  Creating figures for background '
-                                 'subtraction', mute=(not meta.verbose))
-                    iterfn = range(meta.int_start, meta.n_int)
-                    if meta.verbose:
-                        iterfn = tqdm(iterfn)
-                    for n in iterfn:
-                        # make image+background plots
-                        plots_s3.image_and_background(data, meta, n, m)
-
-                # Calulate and correct for 2D drift
-                if hasattr(inst, 'correct_drift2D'):
-                    log.writelog('  Correcting for 2D drift',
+        if meta.int_chunk_size:
+            pair['log'].writelog('  int_chunk_size is ignored when '
+                                 'sweep_reuse is True',
                                  mute=(not meta.verbose))
-                    inst.correct_drift2D(data, meta, m)
-
-                # Select only aperture region
-                ap_y1 = int(meta.src_ypos-spec_hw_val)
-                ap_y2 = int(meta.src_ypos+spec_hw_val)
-                apdata = data.flux[:, ap_y1:ap_y2].values
-                aperr = data.err[:, ap_y1:ap_y2].values
-                apmask = data.mask[:, ap_y1:ap_y2].values
-                apbg = data.bg[:, ap_y1:ap_y2].values
-                apv0 = data.v0[:, ap_y1:ap_y2].values
-                # Compute median frame
-                medapdata = np.median(apdata, axis=0)
-
-                # Extract standard spectrum and its variance
-                data['stdspec'] = (['time', 'x'], np.sum(apdata, axis=1))
-                data['stdvar'] = (['time', 'x'], np.sum(aperr ** 2, axis=1))
-                data['stdspec'].attrs['flux_units'] = \
-                    data.flux.attrs['flux_units']
-                data['stdspec'].attrs['time_units'] = \
-                    data.flux.attrs['time_units']
-                data['stdvar'].attrs['flux_units'] = \
-                    data.flux.attrs['flux_units']
-                data['stdvar'].attrs['time_units'] = \
-                    data.flux.attrs['time_units']
-                # FINDME: stdvar >> stdspec, which is a problem
-
-                # Extract optimal spectrum with uncertainties
-                log.writelog("  Performing optimal spectral extraction",
-                             mute=(not meta.verbose))
-                data['optspec'] = (['time', 'x'], np.zeros(data.stdspec.shape))
-                data['opterr'] = (['time', 'x'], np.zeros(data.stdspec.shape))
-                data['optspec'].attrs['flux_units'] = \
-                    data.flux.attrs['flux_units']
-                data['optspec'].attrs['time_units'] = \
-                    data.flux.attrs['time_units']
-                data['opterr'].attrs['flux_units'] = \
-                    data.flux.attrs['flux_units']
-                data['opterr'].attrs['time_units'] = \
-                    data.flux.attrs['time_units']
-
-                # Already converted DN to electrons, so gain = 1 for optspex
-                gain = 1
-                intstart = data.attrs['intstart']
-                iterfn = range(meta.int_start, meta.n_int)
-                if meta.verbose:
-                    iterfn = tqdm(iterfn)
-                for n in iterfn:
-                    data['optspec'][n], data['opterr'][n], mask = \
-                        optspex.optimize(meta, apdata[n], apmask[n], apbg[n],
-                                         data.stdspec[n].values, gain, apv0[n],
+
+    def writelogs(buffer, pairs):
+        # Only print the messages once, but write them to every log
+        for i, pair in enumerate(pairs):
+            buffer.writeto(pair['log'], mute=(i > 0), clear=False)
+        buffer.messages = []
+
+    basemeta = copy.copy(pairs[0]['meta'])
+    if basemeta.testing_S3:
+        istart = basemeta.num_data_files - 1
+    else:
+        istart = 0
+    buffer = logedit.LogBuffer()
+    segments = range(istart, basemeta.num_data_files)
+    prefetcher = None
+    for i, m in enumerate(segments):
+        # Read and calibrate the segment once
+        basemeta.firstFile = (m == istart)
+        if prefetcher is not None:
+            caldata = prefetcher.get(m)
+        else:
+            caldata = xrio.makeDataset()
+        caldata, basemeta = calibrate_segment(caldata, basemeta, buffer, m)
+        writelogs(buffer, pairs)
+        if (prefetcher is None and basemeta.prefetch_depth > 0 and
+                i+1 < len(segments)):
+            # Reading the first segment can change meta (e.g. the MIRI x
+            # and y windows), so only read ahead after it
+            prefetcher = SegmentPrefetcher(basemeta, segments[i+1:],
+                                           basemeta.prefetch_depth,
+                                           basemeta.prefetch_max_size)
+
+        for bg_hw_val in meta.bg_hw_range:
+            bgpairs = [pair for pair in pairs
+                       if pair['meta'].bg_hw == bg_hw_val]
+            # Subtract the background once per annulus size
+            bgmeta = copy.copy(basemeta)
+            for key in pair_keys:
+                setattr(bgmeta, key, getattr(bgpairs[0]['meta'], key))
+            bgdata, bgmeta = subtract_background(caldata.copy(deep=True),
+                                                 bgmeta, buffer, m, bgpool)
+            writelogs(buffer, bgpairs)
+            # Each median frame row is only computed once for all apertures
+            medframe = medianframe.MedianFrame(bgdata.flux.values)
+
+            for pair in bgpairs:
+                # Only the extraction depends on the aperture size
+                segmeta = copy.copy(bgmeta)
+                for key in pair_keys:
+                    setattr(segmeta, key, getattr(pair['meta'], key))
+                data, segmeta = extract_segment(bgdata.copy(), segmeta,
+                                                pair['log'], m,
+                                                pair['event_ap_bg'], writer,
+                                                medframe)
+                pair['datasets'].append(data)
+                pair['segmeta'] = segmeta
+            del bgdata, medframe
+        del caldata
+    if prefetcher is not None:
+        prefetcher.close()
+    if writer is not None:
+        writer.flush()
+
+    for pair in pairs:
+        spec, meta = finish_ap_bg(pair['segmeta'], pair['log'], inst,
+                                  pair['datasets'], pair['event_ap_bg'], t0)
+
+    return spec, meta
+
+
+def load_inst(meta):
+    '''Loads the instrument module used to reduce these data.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+
+    Returns
+    -------
+    inst : module
+        The instrument module (e.g. eureka.S3_data_reduction.nircam).
+    '''
+    if meta.inst == 'miri':
+        from . import miri as inst
+    elif meta.inst == 'nircam':
+        from . import nircam as inst
+    elif meta.inst == 'nirspec':
+        from . import nirspec as inst
+    elif meta.inst == 'niriss':
+        raise ValueError('NIRISS observations are currently '
+                         'unsupported!')
+    elif meta.inst == 'wfc3':
+        from . import wfc3 as inst
+    else:
+        raise ValueError('Unknown instrument {}'.format(meta.inst))
+    return inst
+
+
+def reduce_segment(data, meta, log, m, event_ap_bg, bgpool=None,
+                   writer=None):
+    '''Reduces a single segment (file) of data and extracts its spectra.
+
+    Parameters
+    ----------
+    data : Xarray Dataset
+        An empty Dataset object which will be filled with the segment's data,
+        or the Dataset returned by prefetch_segment.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log in which notes from this step can be added.
+    m : int
+        The index of the segment in meta.segment_list.
+    event_ap_bg : str
+        The event label including the aperture and annulus sizes, used
+        in the names of the output files.
+    bgpool : eureka.S3_data_reduction.background.BGPool; optional
+        A persistent pool of workers for background subtraction. Defaults
+        to None.
+    writer : eureka.lib.outputwriter.OutputWriter; optional
+        The background writer of the FluxData files. Defaults to None,
+        which writes them right away.
+
+    Returns
+    -------
+    data : Xarray Dataset
+        The Dataset object for this segment, without the large 3D arrays.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    '''
+    if meta.int_chunk_size and meta.inst != 'wfc3':
+        return reduce_segment_chunked(data, meta, log, m, event_ap_bg,
+                                      bgpool, writer)
+    if meta.cache_dir is not None and meta.inst != 'wfc3':
+        # Reuse the steps before the extraction if their inputs are unchanged
+        cache = stepcache.StepCache(meta.cache_dir, meta.cache_max_size)
+        data, meta, key = run_cached(cache, 'calibrate', calibrate_segment,
+                                     data, meta, log, m)
+        data, meta, _ = run_cached(cache, 'background', subtract_background,
+                                   data, meta, log, m, key, bgpool)
+    else:
+        data, meta = calibrate_segment(data, meta, log, m)
+        data, meta = subtract_background(data, meta, log, m, bgpool)
+    data, meta = extract_segment(data, meta, log, m, event_ap_bg, writer)
+    return data, meta
+
+
+def run_cached(cache, step, func, data, meta, log, m, parent='', *args):
+    '''Runs one step of reduce_segment, or loads its result from the cache.
+
+    Parameters
+    ----------
+    cache : eureka.S3_data_reduction.stepcache.StepCache
+        The cache of the steps' results.
+    step : str
+        The name of the step ('calibrate' or 'background').
+    func : function
+        The function which runs the step (e.g. calibrate_segment).
+    data : Xarray Dataset
+        The Dataset object passed to func.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log in which notes from this step can be added.
+    m : int
+        The index of the segment in meta.segment_list.
+    parent : str; optional
+        The cache key of the step before this one. Defaults to ''.
+    *args
+        Any additional arguments of func.
+
+    Returns
+    -------
+    data : Xarray Dataset
+        The Dataset object made by the step.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    key : str
+        The cache key of this step.
+    '''
+    key = cache.key(step, meta, m, parent)
+    entry = cache.load(key)
+    if entry is not None:
+        log.writelog(f'  Reusing the cached {step} step of file {m+1}',
+                     mute=(not meta.verbose))
+        data, changes = entry
+        meta = stepcache.apply_changes(meta, changes)
+        return data, meta, key
+
+    before = stepcache.snapshot(meta)
+    data, meta = func(data, meta, log, m, *args)
+    cache.store(key, data, stepcache.get_changes(meta, before))
+    return data, meta, key
+
+
+def read_segment(data, meta, log, m):
+    '''Reads in a segment unless it was already read by prefetch_segment.
+
+    Parameters
+    ----------
+    data : Xarray Dataset
+        An empty Dataset object which will be filled with the segment's data,
+        or the Dataset returned by prefetch_segment.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log in which notes from this step can be added.
+    m : int
+        The index of the segment in meta.segment_list.
+
+    Returns
+    -------
+    data : Xarray Dataset
+        The Dataset object for this segment.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    '''
+    # Report progress
+    if meta.verbose:
+        log.writelog(f'Reading file {m + 1} of '
+                     f'{meta.num_data_files}')
+    else:
+        log.writelog(f'Reading file {m + 1} of '
+                     f'{meta.num_data_files}', end='\r')
+
+    if 'flux' not in data:
+        # Read in data frame and header
+        inst = load_inst(meta)
+        data, meta = inst.read(meta.segment_list[m], data, meta)
+
+    return data, meta
+
+
+def prefetch_segment(meta, m):
+    '''Reads in a segment and pages in its arrays ahead of its reduction.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object, which should not be changed by the
+        instrument's read function (i.e. meta.firstFile is False).
+    m : int
+        The index of the segment in meta.segment_list.
+
+    Returns
+    -------
+    data : Xarray Dataset
+        The Dataset object for this segment, to be passed to
+        reduce_segment.
+    '''
+    inst = load_inst(meta)
+    data, meta = inst.read(meta.segment_list[m], xrio.makeDataset(), meta)
+    for name in ['flux', 'err', 'dq', 'v0']:
+        touch_pages(data[name].values)
+    return data
+
+
+def touch_pages(values):
+    '''Pages a memory-mapped array into the file system cache.
+
+    Only one value per memory page is read, so nothing is copied.
+
+    Parameters
+    ----------
+    values : ndarray
+        The (possibly memory-mapped) array.
+    '''
+    # Touch one value per page along each row, which reaches the pages of
+    # every row even when the rows are shorter than a page
+    step = max(1, mmap.PAGESIZE//values.itemsize)
+    values[..., ::step].max(initial=0)
+
+
+class SegmentPrefetcher:
+    '''Reads the upcoming segments on a background thread.
+
+    The reads of the next meta.prefetch_depth segments overlap with the
+    reduction of the current one, and the segments are read one at a time
+    in the order they will be reduced. The size of a segment is estimated
+    by the size of its file, and no more segments are read ahead than fit
+    in max_size, apart from the next one, which is always read ahead.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    segments : iterable
+        The indices of the segments in meta.segment_list which will be
+        requested, in order.
+    depth : int
+        The maximum number of segments to read ahead.
+    max_size : float; optional
+        The maximum total size in GB of the segments read ahead. Defaults
+        to None (no limit).
+    '''
+    def __init__(self, meta, segments, depth, max_size=None):
+        self.meta = copy.copy(meta)
+        self.meta.firstFile = False
+        self.segments = list(segments)
+        self.depth = depth
+        self.max_size = max_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = {}
+        self.sizes = {}
+        self.nsubmitted = 0
+        self.fill()
+
+    def fill(self):
+        '''Starts reading segments until depth segments (or max_size GB,
+        but at least one segment) are read ahead.'''
+        while (len(self.futures) < self.depth and
+               self.nsubmitted < len(self.segments)):
+            m = self.segments[self.nsubmitted]
+            size = os.path.getsize(self.meta.segment_list[m])
+            # The next segment is always read ahead, so max_size only
+            # limits the segments read ahead on top of it
+            if (self.max_size is not None and len(self.futures) > 0 and
+                    sum(self.sizes.values())+size > self.max_size*1e9):
+                break
+            self.sizes[m] = size
+            self.futures[m] = self.executor.submit(prefetch_segment,
+                                                   self.meta, m)
+            self.nsubmitted += 1
+
+    def get(self, m):
+        '''Returns the Dataset of a segment, waiting until it has been read.
+
+        Parameters
+        ----------
+        m : int
+            The index of the segment in meta.segment_list.
+
+        Returns
+        -------
+        data : Xarray Dataset
+            The Dataset object for this segment, to be passed to
+            reduce_segment.
+        '''
+        data = self.futures.pop(m).result()
+        del self.sizes[m]
+        self.fill()
+        return data
+
+    def close(self):
+        '''Stops the background thread, dropping any unused segments.'''
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.futures = {}
+        self.sizes = {}
+
+
+def calibrate_segment(data, meta, log, m):
+    '''Reads, trims, and calibrates a segment before background subtraction.
+
+    None of these steps depend on the aperture or annulus sizes.
+
+    Parameters
+    ----------
+    data : Xarray Dataset
+        An empty Dataset object which will be filled with the segment's data,
+        or the Dataset returned by prefetch_segment.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log in which notes from this step can be added.
+    m : int
+        The index of the segment in meta.segment_list.
+
+    Returns
+    -------
+    data : Xarray Dataset
+        The Dataset object for this segment.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    '''
+    data, meta = read_segment(data, meta, log, m)
+
+    # Get number of integrations and frame dimensions
+    meta.n_int, meta.ny, meta.nx = data.flux.shape
+    if meta.testing_S3:
+        # Only process the last 5 integrations when testing
+        meta.int_start = np.max((0, meta.n_int-5))
+    else:
+        meta.int_start = 0
+
+    # Trim data to subarray region of interest
+    # Dataset object no longer contains untrimmed data
+    data, meta = util.trim(data, meta)
+
+    if meta.precision == 'float32':
+        # Keep the frames in single precision from here on
+        for name in ['flux', 'err', 'v0']:
+            data[name] = data[name].astype(np.float32)
+
+    # Locate source postion
+    meta.src_ypos = source_pos.source_pos(
+        data, meta, m, header=('SRCYPOS' in data.attrs['shdr']))
+    log.writelog(f'  Source position on detector is row '
+                 f'{meta.src_ypos}.', mute=(not meta.verbose))
+    if meta.track_ypos:
+        # Follow the source position through the segment
+        centroid_y, centroid_sy = source_pos.source_pos_ints(
+            data.flux.values, meta, meta.src_ypos)
+        data['centroid_y'] = (['time'], centroid_y)
+        data['centroid_sy'] = (['time'], centroid_sy)
+
+    # Compute 1D wavelength solution
+    if 'wave_2d' in data:
+        data['wave_1d'] = (['x'],
+                           data.wave_2d[meta.src_ypos].values)
+        data['wave_1d'].attrs['wave_units'] = \
+            data.wave_2d.attrs['wave_units']
+
+    # Convert flux units to electrons
+    # (eg. MJy/sr -> DN -> Electrons)
+    data, meta = b2f.convert_to_e(data, meta, log)
+
+    # Compute median frame
+    data['medflux'] = (['y', 'x'], np.median(data.flux.values,
+                                             axis=0))
+    data['medflux'].attrs['flux_units'] = \
+        data.flux.attrs['flux_units']
+
+    # Create bad pixel mask (0 = good, otherwise the flags set by each step,
+    # see eureka.lib.maskflags)
+    # FINDME: Will want to use DQ array in the future
+    # to flag certain pixels
+    data['mask'] = (['time', 'y', 'x'], np.zeros(data.flux.shape,
+                                                 dtype=maskflags.DTYPE))
+
+    # Check if arrays have NaNs
+    data['mask'] = util.check_nans(data['flux'], data['mask'],
+                                   log, name='FLUX')
+    data['mask'] = util.check_nans(data['err'], data['mask'],
+                                   log, name='ERR')
+    data['mask'] = util.check_nans(data['v0'], data['mask'],
+                                   log, name='V0')
+
+    # Manually mask regions [colstart, colend, rowstart, rowend]
+    if hasattr(meta, 'manmask'):
+        log.writelog("  Masking manually identified bad pixels",
+                     mute=(not meta.verbose))
+        util.mask_manual(data['mask'].values, meta.manmask)
+
+    return data, meta
+
+
+def subtract_background(data, meta, log, m, bgpool=None):
+    '''Flags outliers in and subtracts the background of a segment.
+
+    These steps only depend on the annulus size, meta.bg_hw.
+
+    Parameters
+    ----------
+    data : Xarray Dataset
+        The calibrated Dataset object for this segment.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log in which notes from this step can be added.
+    m : int
+        The index of the segment in meta.segment_list.
+    bgpool : eureka.S3_data_reduction.background.BGPool; optional
+        A persistent pool of workers for background subtraction. Defaults
+        to None.
+
+    Returns
+    -------
+    data : Xarray Dataset
+        The background subtracted Dataset object for this segment.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    '''
+    inst = load_inst(meta)
+
+    # Perform outlier rejection of sky background along time axis
+    log.writelog('  Performing background outlier rejection',
+                 mute=(not meta.verbose))
+    meta.bg_y2 = int(meta.src_ypos + meta.bg_hw)
+    meta.bg_y1 = int(meta.src_ypos - meta.bg_hw)
+    data = inst.flag_bg(data, meta)
+
+    data = bg.BGsubtraction(data, meta, log, meta.isplots_S3,
+                            pool=bgpool)
+
+    if meta.isplots_S3 >= 3:
+        log.writelog('  Creating figures for background '
+                     'subtraction', mute=(not meta.verbose))
+        iterfn = range(meta.int_start, meta.n_int)
+        if meta.verbose:
+            iterfn = tqdm(iterfn)
+        for n in iterfn:
+            # make image+background plots
+            plots_s3.image_and_background(data, meta, n, m)
+
+    # Calulate and correct for 2D drift
+    if hasattr(inst, 'correct_drift2D'):
+        log.writelog('  Correcting for 2D drift',
+                     mute=(not meta.verbose))
+        inst.correct_drift2D(data, meta, m)
+
+    return data, meta
+
+
+def extract_segment(data, meta, log, m, event_ap_bg, writer=None,
+                    medframe=None):
+    '''Extracts the standard and optimal spectra of a segment.
+
+    These steps depend on the aperture size, meta.spec_hw. The output
+    file for this segment is saved here if meta.save_output is True.
+
+    Parameters
+    ----------
+    data : Xarray Dataset
+        The background subtracted Dataset object for this segment.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log in which notes from this step can be added.
+    m : int
+        The index of the segment in meta.segment_list.
+    event_ap_bg : str
+        The event label including the aperture and annulus sizes, used
+        in the names of the output files.
+    writer : eureka.lib.outputwriter.OutputWriter; optional
+        The background writer of the FluxData files. Defaults to None,
+        which writes them right away.
+    medframe : eureka.lib.medianframe.MedianFrame; optional
+        The median frame of the background subtracted flux, shared by the
+        apertures which use the same background. Defaults to None, which
+        computes the median frame of this aperture if it is needed.
+
+    Returns
+    -------
+    data : Xarray Dataset
+        The Dataset object for this segment, without the large 3D arrays.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    '''
+    # Select only aperture region
+    ap_y1 = int(meta.src_ypos-meta.spec_hw)
+    ap_y2 = int(meta.src_ypos+meta.spec_hw)
+    apdata = data.flux[:, ap_y1:ap_y2].values
+    aperr = data.err[:, ap_y1:ap_y2].values
+    apmask = maskflags.good(data.mask[:, ap_y1:ap_y2].values)
+    apbg = data.bg[:, ap_y1:ap_y2].values
+    apv0 = data.v0[:, ap_y1:ap_y2].values
+    # Compute median frame, which is only used by the meddata profile
+    if meta.fittype == 'meddata':
+        if medframe is None:
+            medframe = medianframe.MedianFrame(data.flux.values)
+        medapdata = medframe.rows(ap_y1, ap_y2)
+    else:
+        medapdata = None
+
+    # Extract standard spectrum and its variance
+    data['stdspec'] = (['time', 'x'], sum_aperture(apdata, meta))
+    data['stdvar'] = (['time', 'x'], sum_aperture(aperr ** 2, meta))
+    data['stdspec'].attrs['flux_units'] = \
+        data.flux.attrs['flux_units']
+    data['stdspec'].attrs['time_units'] = \
+        data.flux.attrs['time_units']
+    data['stdvar'].attrs['flux_units'] = \
+        data.flux.attrs['flux_units']
+    data['stdvar'].attrs['time_units'] = \
+        data.flux.attrs['time_units']
+    # FINDME: stdvar >> stdspec, which is a problem
+
+    # Extract optimal spectrum with uncertainties
+    log.writelog("  Performing optimal spectral extraction",
+                 mute=(not meta.verbose))
+    data['optspec'] = (['time', 'x'], np.zeros(data.stdspec.shape,
+                                               dtype=meta.precision))
+    data['opterr'] = (['time', 'x'], np.zeros(data.stdspec.shape,
+                                              dtype=meta.precision))
+    data['optspec'].attrs['flux_units'] = \
+        data.flux.attrs['flux_units']
+    data['optspec'].attrs['time_units'] = \
+        data.flux.attrs['time_units']
+    data['opterr'].attrs['flux_units'] = \
+        data.flux.attrs['flux_units']
+    data['opterr'].attrs['time_units'] = \
+        data.flux.attrs['time_units']
+
+    # Already converted DN to electrons, so gain = 1 for optspex
+    gain = 1
+    intstart = data.attrs['intstart']
+    if meta.batch_optspex:
+        # Extract all integrations at once
+        i0 = meta.int_start
+        optspec, opterr, mask = \
+            optspex.optimize_batch(meta, apdata[i0:],
+                                   apmask[i0:], apbg[i0:],
+                                   data.stdspec[i0:].values,
+                                   gain, apv0[i0:],
+                                   p5thresh=meta.p5thresh,
+                                   p7thresh=meta.p7thresh,
+                                   fittype=meta.fittype,
+                                   window_len=meta.window_len,
+                                   deg=meta.prof_deg,
+                                   n=intstart+i0,
+                                   meddata=medapdata,
+                                   dtype=meta.precision)
+        maskflags.update(data.mask.values[i0:, ap_y1:ap_y2], mask,
+                         maskflags.OPTSPEX)
+        data['optspec'][i0:] = optspec
+        data['opterr'][i0:] = opterr
+    else:
+        iterfn = range(meta.int_start, meta.n_int)
+        if meta.verbose:
+            iterfn = tqdm(iterfn)
+        for n in iterfn:
+            data['optspec'][n], data['opterr'][n], mask = \
+                optspex.optimize(meta, apdata[n], apmask[n],
+                                 apbg[n], data.stdspec[n].values,
+                                 gain, apv0[n],
+                                 p5thresh=meta.p5thresh,
+                                 p7thresh=meta.p7thresh,
+                                 fittype=meta.fittype,
+                                 window_len=meta.window_len,
+                                 deg=meta.prof_deg, n=intstart+n,
+                                 meddata=medapdata)
+            maskflags.update(data.mask.values[n, ap_y1:ap_y2], mask,
+                             maskflags.OPTSPEX)
+
+    # Mask out NaNs and Infs
+    optspec_ma = np.ma.masked_invalid(data.optspec.values)
+    opterr_ma = np.ma.masked_invalid(data.opterr.values)
+    optmask = np.logical_or(np.ma.getmaskarray(optspec_ma),
+                            np.ma.getmaskarray(opterr_ma))
+    data['optmask'] = (['time', 'x'], optmask)
+    # data['optspec'] = np.ma.masked_where(mask, data.optspec)
+    # data['opterr'] = np.ma.masked_where(mask, data.opterr)
+
+    # Plot results
+    if meta.isplots_S3 >= 3:
+        log.writelog('  Creating figures for optimal spectral '
+                     'extraction', mute=(not meta.verbose))
+        iterfn = range(meta.int_start, meta.n_int)
+        if meta.verbose:
+            iterfn = tqdm(iterfn)
+        for n in iterfn:
+            # make optimal spectrum plot
+            plots_s3.optimal_spectrum(data, meta, n, m)
+
+    if meta.save_output:
+        # Save flux data from current segment
+        filename_xr = (meta.outputdir+'S3_'+event_ap_bg +
+                       "_FluxData_seg"+str(m+1).zfill(4)+".h5")
+        write_fluxdata(filename_xr, data, meta, writer)
+
+    # Remove large 3D arrays from Dataset
+    del(data['flux'], data['err'], data['dq'], data['v0'],
+        data['bg'], data['mask'], data.attrs['intstart'],
+        data.attrs['intend'])
+
+    return data, meta
+
+
+def sum_aperture(values, meta):
+    '''Sums an aperture cube over its rows (axis 1).
+
+    Parameters
+    ----------
+    values : ndarray (3D)
+        The values in the aperture region with shape (n_int, ny, nx).
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+
+    Returns
+    -------
+    ndarray (2D)
+        The sums with shape (n_int, nx). If meta.precision is 'float32',
+        the sums are accumulated in double precision before being
+        rounded to single precision.
+    '''
+    if meta.precision == 'float32':
+        return np.sum(values, axis=1, dtype=np.float64).astype(np.float32)
+    return np.sum(values, axis=1)
+
+
+def write_fluxdata(filename_xr, data, meta, writer=None):
+    '''Saves the flux data of a segment, dropping the FITS headers if
+    they cannot be saved.
+
+    Parameters
+    ----------
+    filename_xr : str
+        The name of the output file.
+    data : Xarray Dataset
+        The Dataset object to save.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    writer : eureka.lib.outputwriter.OutputWriter; optional
+        If given, the file is written on the writer's background thread
+        and this function returns right away. Defaults to None.
+    '''
+    if writer is not None:
+        if any(isinstance(data.attrs.get(key), fits.Header)
+               for key in ['mhdr', 'shdr']):
+            # The headers cannot be saved, so drop them now like below
+            del(data.attrs['filename'])
+            del(data.attrs['mhdr'])
+            del(data.attrs['shdr'])
+        # The arrays are not modified after this, but some are removed
+        # from data, so give the writer its own (shallow) copy
+        writer.submit(write_fluxdata, filename_xr, data.copy(), meta)
+        return
+
+    success = outputwriter.writeXR(filename_xr, data, verbose=False,
+                                   append=False,
+                                   compression=meta.output_compression,
+                                   chunk_nint=meta.output_chunk_nint)
+    if success == 0:
+        del(data.attrs['filename'])
+        del(data.attrs['mhdr'])
+        del(data.attrs['shdr'])
+        outputwriter.writeXR(filename_xr, data, verbose=meta.verbose,
+                             append=False,
+                             compression=meta.output_compression,
+                             chunk_nint=meta.output_chunk_nint)
+
+
+def save_checkpoint(checkpoints, meta, event_ap_bg, m, data, changes,
+                    writer=None):
+    '''Records that a segment is done so that the run can be resumed.
+
+    Parameters
+    ----------
+    checkpoints : eureka.S3_data_reduction.checkpoint.Checkpoint
+        The checkpoints of this run.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    event_ap_bg : str
+        The event label including the aperture and annulus sizes.
+    m : int
+        The index of the segment in meta.segment_list.
+    data : Xarray Dataset
+        The Dataset object returned by reduce_segment.
+    changes : dict
+        The metadata attributes which reduce_segment changed.
+    writer : eureka.lib.outputwriter.OutputWriter; optional
+        If given, the checkpoint is saved on the writer's background thread
+        once the segment's FluxData file has been written. Defaults to None.
+    '''
+    if writer is not None:
+        writer.submit(checkpoints.save, meta, event_ap_bg, m, data, changes)
+    else:
+        checkpoints.save(meta, event_ap_bg, m, data, changes)
+
+
+def reduce_segment_chunked(data, meta, log, m, event_ap_bg, bgpool=None,
+                           writer=None):
+    '''Reduces a single segment a chunk of integrations at a time.
+
+    This gives the same spectra as calibrate_segment, subtract_background,
+    and extract_segment, but at most meta.int_chunk_size integrations of
+    the full frames are held in memory at once. The FITS file is
+    memory-mapped, the steps which need every integration (the median
+    frame and the outlier rejection along time) are done on blocks of
+    rows instead, and the pixel mask and the aperture region are kept in
+    temporary files in meta.outputdir between passes.
+
+    Parameters
+    ----------
+    data : Xarray Dataset
+        An empty Dataset object which will be filled with the segment's data,
+        or the Dataset returned by prefetch_segment.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log in which notes from this step can be added.
+    m : int
+        The index of the segment in meta.segment_list.
+    event_ap_bg : str
+        The event label including the aperture and annulus sizes, used
+        in the names of the output files.
+    bgpool : eureka.S3_data_reduction.background.BGPool; optional
+        A persistent pool of workers for background subtraction. Defaults
+        to None.
+    writer : eureka.lib.outputwriter.OutputWriter; optional
+        The background writer of the FluxData files. Defaults to None,
+        which writes them right away.
+
+    Returns
+    -------
+    data : Xarray Dataset
+        The Dataset object for this segment, without the large 3D arrays.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+
+    Notes
+    -----
+    If meta.save_output is True, the 3D arrays are saved in one
+    FluxData file per chunk (ending in _chunk####.h5) while the segment's
+    FluxData file only holds the 1D and 2D arrays.
+    '''
+    # The arrays are memory-mapped, so only the parts used below are loaded
+    data, meta = read_segment(data, meta, log, m)
+
+    # Get number of integrations and frame dimensions
+    meta.n_int, meta.ny, meta.nx = data.flux.shape
+    if meta.testing_S3:
+        # Only process the last 5 integrations when testing
+        meta.int_start = np.max((0, meta.n_int-5))
+    else:
+        meta.int_start = 0
+
+    nchunk = int(meta.int_chunk_size)
+    chunks = [slice(n, min(n+nchunk, meta.n_int))
+              for n in range(0, meta.n_int, nchunk)]
+    log.writelog(f'  Reducing {meta.n_int} integrations in {len(chunks)} '
+                 f'chunks', mute=(not meta.verbose))
+
+    # The instrument modules only read in the region of interest, so this
+    # does not load anything
+    trimmed, meta = util.trim(data, meta)
+    # Use the first integration to get the source position and the unit
+    # conversion
+    first = trimmed.isel(time=slice(0, 1))
+
+    # Locate source postion
+    meta.src_ypos = source_pos.source_pos(
+        first, meta, m, header=('SRCYPOS' in first.attrs['shdr']))
+    log.writelog(f'  Source position on detector is row '
+                 f'{meta.src_ypos}.', mute=(not meta.verbose))
+    if meta.track_ypos:
+        # Follow the source position through the segment, only loading the
+        # rows around the source
+        centroids = [source_pos.source_pos_ints(
+            trimmed.flux.values[ints], meta, meta.src_ypos)
+            for ints in chunks]
+        centroid_y = np.concatenate([c[0] for c in centroids])
+        centroid_sy = np.concatenate([c[1] for c in centroids])
+
+    # Compute 1D wavelength solution
+    if 'wave_2d' in first:
+        first['wave_1d'] = (['x'],
+                            first.wave_2d[meta.src_ypos].values)
+        first['wave_1d'].attrs['wave_units'] = \
+            first.wave_2d.attrs['wave_units']
+
+    # Each unit conversion scales every pixel by a constant factor, so get
+    # the factors once by converting an integration filled with ones
+    names = ['flux', 'err', 'v0']
+    factors = first.copy()
+    for name in names:
+        factors[name] = first[name].copy(data=np.ones(first[name].shape))
+    factors, meta = b2f.convert_to_e(factors, meta, log)
+    flux_units = factors.flux.attrs['flux_units']
+    scale = {name: factors[name].values[0] for name in names}
+
+    def load(name, ints=slice(None), rows=slice(None)):
+        # Load part of a trimmed array and convert it to electrons
+        if name in scale and meta.precision == 'float32':
+            dtype = np.float32
+        else:
+            dtype = None
+        values = np.array(trimmed[name].values[ints, rows], dtype=dtype)
+        if name in scale:
+            values *= scale[name][rows]
+        return values
+
+    meta.bg_y2 = int(meta.src_ypos + meta.bg_hw)
+    meta.bg_y1 = int(meta.src_ypos - meta.bg_hw)
+    ny, nx = meta.subny, meta.subnx
+    inst = load_inst(meta)
+    if hasattr(meta, 'manmask'):
+        log.writelog("  Masking manually identified bad pixels",
+                     mute=(not meta.verbose))
+
+    with tempfile.TemporaryDirectory(dir=meta.outputdir) as tmpdir:
+        # Build the mask and the median frame one block of rows at a time,
+        # using every integration (0 = good, see eureka.lib.maskflags)
+        log.writelog('  Performing background outlier rejection',
+                     mute=(not meta.verbose))
+        mask = np.lib.format.open_memmap(
+            os.path.join(tmpdir, 'mask.npy'), mode='w+',
+            dtype=maskflags.DTYPE, shape=(meta.n_int, ny, nx))
+        medflux = []
+        num_nans = {'FLUX': 0, 'ERR': 0, 'V0': 0}
+        nrows = max(1, nchunk*ny//meta.n_int)
+        for y0 in range(0, ny, nrows):
+            rows = slice(y0, min(y0+nrows, ny))
+            block = trimmed.isel(y=rows)
+            block['flux'] = block.flux.copy(data=load('flux', rows=rows))
+            medflux.append(np.median(block.flux.values, axis=0))
+            block['mask'] = (['time', 'y', 'x'],
+                             np.zeros(block.flux.shape,
+                                      dtype=maskflags.DTYPE))
+            for name in num_nans:
+                values = (block.flux if name == 'FLUX'
+                          else load(name.lower(), rows=rows))
+                num_nans[name] += util.flag_nans(values, block.mask)
+            if hasattr(meta, 'manmask'):
+                util.mask_manual(block.mask.values, meta.manmask, y0, ny)
+            # Outlier rejection of sky background along time axis, with
+            # the background regions relative to this block
+            blockmeta = copy.copy(meta)
+            blockmeta.bg_y1 = min(max(meta.bg_y1-y0, 0), block.y.size)
+            blockmeta.bg_y2 = min(max(meta.bg_y2-y0, 0), block.y.size)
+            block = inst.flag_bg(block, blockmeta)
+            mask[:, rows] = block.mask.values
+            del block
+        for name, num in num_nans.items():
+            util.warn_nans(log, name, num)
+
+        # Subtract the background one chunk of integrations at a time,
+        # keeping only the aperture region
+        ap = slice(int(meta.src_ypos-meta.spec_hw),
+                   int(meta.src_ypos+meta.spec_hw))
+        apcube = {}
+        chunkfiles = []
+        stdspec, stdvar = [], []
+        # Estimate the median frame of the aperture region while the chunks
+        # are in memory instead of reading the aperture region again
+        # afterwards
+        stream_median = (meta.fittype == 'meddata' and
+                         meta.median_method == 'p2')
+        apmedian = None
+        for c, ints in enumerate(chunks):
+            log.writelog(f'  Integrations {ints.start} to {ints.stop-1}',
+                         mute=(not meta.verbose))
+            chunk = trimmed.isel(time=ints)
+            for name in names+['dq']:
+                chunk[name] = chunk[name].copy(data=load(name, ints))
+                if name in scale:
+                    chunk[name].attrs['flux_units'] = flux_units
+            chunk['mask'] = (['time', 'y', 'x'], np.array(mask[ints]))
+            chunkmeta = copy.copy(meta)
+            chunkmeta.n_int = ints.stop - ints.start
+            chunkmeta.int_start = min(max(0, meta.int_start-ints.start),
+                                      chunkmeta.n_int)
+            chunk = bg.BGsubtraction(chunk, chunkmeta, log,
+                                     meta.isplots_S3, pool=bgpool)
+
+            if meta.isplots_S3 >= 3:
+                for n in range(chunkmeta.int_start, chunkmeta.n_int):
+                    # make image+background plots
+                    plots_s3.image_and_background(chunk, meta, n, m,
+                                                  int_offset=ints.start)
+
+            for name in ['flux', 'err', 'mask', 'bg', 'v0']:
+                values = chunk[name][:, ap].values
+                if name not in apcube:
+                    apcube[name] = np.lib.format.open_memmap(
+                        os.path.join(tmpdir, f'ap{name}.npy'), mode='w+',
+                        dtype=values.dtype,
+                        shape=(meta.n_int,)+values.shape[1:])
+                apcube[name][ints] = values
+                if name == 'flux' and stream_median:
+                    if apmedian is None:
+                        apmedian = medianframe.StreamingMedian(
+                            values.shape[1:])
+                    apmedian.update(values)
+            # Extract standard spectrum and its variance
+            stdspec.append(sum_aperture(chunk.flux[:, ap].values, meta))
+            stdvar.append(sum_aperture(chunk.err[:, ap].values ** 2, meta))
+
+            if meta.save_output:
+                # Save flux data from current chunk
+                filename_xr = (meta.outputdir+'S3_'+event_ap_bg +
+                               "_FluxData_seg"+str(m+1).zfill(4) +
+                               "_chunk"+str(c+1).zfill(4)+".h5")
+                write_fluxdata(filename_xr, chunk, meta, writer)
+                chunkfiles.append((filename_xr, ints))
+            del chunk
+
+        # Keep everything except the large 3D arrays
+        data = first.drop_vars(names+['dq', 'time'])
+        data = data.assign_coords(time=trimmed.time)
+        data['medflux'] = (['y', 'x'], np.concatenate(medflux))
+        if meta.track_ypos:
+            data['centroid_y'] = (['time'], centroid_y)
+            data['centroid_sy'] = (['time'], centroid_sy)
+        stdspec = np.concatenate(stdspec)
+        stdvar = np.concatenate(stdvar)
+        data['medflux'].attrs['flux_units'] = flux_units
+        data['stdspec'] = (['time', 'x'], stdspec)
+        data['stdvar'] = (['time', 'x'], stdvar)
+        data['optspec'] = (['time', 'x'], np.zeros(stdspec.shape,
+                                                   dtype=meta.precision))
+        data['opterr'] = (['time', 'x'], np.zeros(stdspec.shape,
+                                                  dtype=meta.precision))
+        for name in ['stdspec', 'stdvar', 'optspec', 'opterr']:
+            data[name].attrs['flux_units'] = flux_units
+            data[name].attrs['time_units'] = \
+                trimmed.flux.attrs['time_units']
+
+        # Compute median frame of the aperture region
+        if apmedian is not None:
+            medapdata = apmedian.result().astype(apcube['flux'].dtype)
+        elif meta.fittype == 'meddata':
+            medapdata = np.concatenate([
+                np.median(apcube['flux'][:, i:i+nrows], axis=0)
+                for i in range(0, apcube['flux'].shape[1], nrows)])
+        else:
+            medapdata = None
+
+        # Extract optimal spectrum with uncertainties
+        log.writelog("  Performing optimal spectral extraction",
+                     mute=(not meta.verbose))
+        # Already converted DN to electrons, so gain = 1 for optspex
+        gain = 1
+        intstart = data.attrs['intstart']
+        for ints in chunks:
+            i0 = max(meta.int_start, ints.start)
+            if i0 >= ints.stop:
+                continue
+            ints = slice(i0, ints.stop)
+            apdata, apmask, apbg, apv0 = [
+                np.array(apcube[name][ints])
+                for name in ['flux', 'mask', 'bg', 'v0']]
+            apmask = maskflags.good(apmask)
+            if meta.batch_optspex:
+                optspec, opterr, good = \
+                    optspex.optimize_batch(meta, apdata, apmask, apbg,
+                                           stdspec[ints], gain, apv0,
+                                           p5thresh=meta.p5thresh,
+                                           p7thresh=meta.p7thresh,
+                                           fittype=meta.fittype,
+                                           window_len=meta.window_len,
+                                           deg=meta.prof_deg,
+                                           n=intstart+i0,
+                                           meddata=medapdata,
+                                           dtype=meta.precision)
+                maskflags.update(apcube['mask'][ints], good,
+                                 maskflags.OPTSPEX)
+                data['optspec'][ints] = optspec
+                data['opterr'][ints] = opterr
+            else:
+                for n in range(ints.start, ints.stop):
+                    data['optspec'][n], data['opterr'][n], good = \
+                        optspex.optimize(meta, apdata[n-i0], apmask[n-i0],
+                                         apbg[n-i0], stdspec[n], gain,
+                                         apv0[n-i0],
                                          p5thresh=meta.p5thresh,
                                          p7thresh=meta.p7thresh,
                                          fittype=meta.fittype,
                                          window_len=meta.window_len,
                                          deg=meta.prof_deg, n=intstart+n,
                                          meddata=medapdata)
+                    maskflags.update(apcube['mask'][n], good,
+                                     maskflags.OPTSPEX)
 
-                # Mask out NaNs and Infs
-                optspec_ma = np.ma.masked_invalid(data.optspec.values)
-                opterr_ma = np.ma.masked_invalid(data.opterr.values)
-                optmask = np.logical_or(np.ma.getmaskarray(optspec_ma),
-                                        np.ma.getmaskarray(opterr_ma))
-                data['optmask'] = (['time', 'x'], optmask)
-                # data['optspec'] = np.ma.masked_where(mask, data.optspec)
-                # data['opterr'] = np.ma.masked_where(mask, data.opterr)
-
-                # Plot results
-                if meta.isplots_S3 >= 3:
-                    log.writelog('  Creating figures for optimal spectral '
-                                 'extraction', mute=(not meta.verbose))
-                    iterfn = range(meta.int_start, meta.n_int)
-                    if meta.verbose:
-                        iterfn = tqdm(iterfn)
-                    for n in iterfn:
-                        # make optimal spectrum plot
-                        plots_s3.optimal_spectrum(data, meta, n, m)
-
-                if meta.save_output:
-                    # Save flux data from current segment
-                    filename_xr = (meta.outputdir+'S3_'+event_ap_bg +
-                                   "_FluxData_seg"+str(m+1).zfill(4)+".h5")
-                    success = xrio.writeXR(filename_xr, data, verbose=False,
-                                           append=False)
-                    if success == 0:
-                        del(data.attrs['filename'])
-                        del(data.attrs['mhdr'])
-                        del(data.attrs['shdr'])
-                        success = xrio.writeXR(filename_xr, data,
-                                               verbose=meta.verbose,
-                                               append=False)
-
-                # Remove large 3D arrays from Dataset
-                del(data['flux'], data['err'], data['dq'], data['v0'],
-                    data['bg'], data['mask'], data.attrs['intstart'],
-                    data.attrs['intend'])
+        if len(chunkfiles) > 0:
+            # The chunks were saved before the extraction, so add the
+            # pixels it rejected to their masks
+            if writer is not None:
+                writer.flush()
+            for filename_xr, ints in chunkfiles:
+                outputwriter.update_array(filename_xr, 'mask',
+                                          (slice(None), ap),
+                                          apcube['mask'][ints])
+        del apcube
 
-                # Append results for future concatenation
-                datasets.append(data)
+    # Mask out NaNs and Infs
+    optspec_ma = np.ma.masked_invalid(data.optspec.values)
+    opterr_ma = np.ma.masked_invalid(data.opterr.values)
+    optmask = np.logical_or(np.ma.getmaskarray(optspec_ma),
+                            np.ma.getmaskarray(opterr_ma))
+    data['optmask'] = (['time', 'x'], optmask)
 
-            if meta.inst == 'wfc3':
-                # WFC3 needs a conclusion step to convert lists into
-                # arrays before saving
-                meta, log = inst.conclusion_step(meta, log)
+    # Plot results
+    if meta.isplots_S3 >= 3:
+        log.writelog('  Creating figures for optimal spectral '
+                     'extraction', mute=(not meta.verbose))
+        iterfn = range(meta.int_start, meta.n_int)
+        if meta.verbose:
+            iterfn = tqdm(iterfn)
+        for n in iterfn:
+            # make optimal spectrum plot
+            plots_s3.optimal_spectrum(data, meta, n, m)
 
-            # Concatenate results along time axis (default)
-            spec = xrio.concat(datasets)
+    if meta.save_output:
+        # Save the remaining flux data from current segment
+        filename_xr = (meta.outputdir+'S3_'+event_ap_bg +
+                       "_FluxData_seg"+str(m+1).zfill(4)+".h5")
+        write_fluxdata(filename_xr, data, meta, writer)
 
-            # Calculate total time
-            total = (time_pkg.time() - t0) / 60.
-            log.writelog('\nTotal time (min): ' + str(np.round(total, 2)))
+    del(data.attrs['intstart'], data.attrs['intend'])
 
-            # Save Dataset object containing time-series of 1D spectra
-            meta.filename_S3_SpecData = (meta.outputdir+'S3_'+event_ap_bg +
-                                         "_SpecData.h5")
-            success = xrio.writeXR(meta.filename_S3_SpecData, spec,
-                                   verbose=True)
+    return data, meta
 
-            # Compute MAD value
-            meta.mad_s3 = util.get_mad(meta, spec.wave_1d, spec.optspec)
-            log.writelog(f"Stage 3 MAD = "
-                         f"{np.round(meta.mad_s3, 2).astype(int)} ppm")
 
-            if meta.isplots_S3 >= 1:
-                log.writelog('Generating figure')
-                # 2D light curve without drift correction
-                plots_s3.lc_nodriftcorr(meta, spec.wave_1d, spec.optspec)
+def reduce_segment_worker(args):
+    '''Reduces a single segment in a worker process.
 
-            # Save results
-            if meta.save_output:
-                log.writelog('Saving Metadata')
-                fname = meta.outputdir + 'S3_' + event_ap_bg + "_Meta_Save"
-                me.saveevent(meta, fname, save=[])
+    Parameters
+    ----------
+    args : tuple
+        The (meta, m, event_ap_bg) arguments for reduce_segment.
 
-            log.closelog()
+    Returns
+    -------
+    data : Xarray Dataset
+        The Dataset object for this segment, without the large 3D arrays.
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    log : logedit.LogBuffer
+        The messages logged while reducing this segment.
+    '''
+    meta, m, event_ap_bg = args
+    log = logedit.LogBuffer()
+    data, meta = reduce_segment(xrio.makeDataset(), meta, log, m,
+                                event_ap_bg)
+    return data, meta, log
 
-    return spec, meta
+
+def reduce_segments_parallel(meta, log, segments, event_ap_bg,
+                             checkpoints=None):
+    '''Reduces several segments at once in separate worker processes.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    log : logedit.Logedit
+        The open log in which notes from this step can be added.
+    segments : iterable
+        The indices of the segments in meta.segment_list to reduce.
+    event_ap_bg : str
+        The event label including the aperture and annulus sizes, used
+        in the names of the output files.
+    checkpoints : eureka.S3_data_reduction.checkpoint.Checkpoint; optional
+        If given, each segment is recorded as done as soon as its result
+        is received. Defaults to None.
+
+    Returns
+    -------
+    datasets : list
+        The Dataset objects of each segment, in the same order as segments.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object updated by the last segment.
+    '''
+    # Each worker handles the background subtraction of its segment itself
+    # since pool workers cannot start their own pools
+    ncpu = meta.ncpu
+    meta.ncpu = 1
+    nproc = min(meta.max_concurrent_segments, len(segments))
+    log.writelog(f'  Reducing {len(segments)} segments with {nproc} '
+                 f'parallel processes', mute=(not meta.verbose))
+
+    datasets = []
+    newmeta = meta
+    # imap returns the results in order, and only nproc segments are
+    # reduced (and held in memory as full 3D arrays) at once
+    args_list = [(meta, m, event_ap_bg) for m in segments]
+    if checkpoints is not None:
+        before = stepcache.snapshot(meta)
+    try:
+        with mp.Pool(nproc) as pool:
+            results = pool.imap(reduce_segment_worker, args_list)
+            for m, (data, newmeta, buffer) in zip(segments, results):
+                buffer.writeto(log)
+                datasets.append(data)
+                if checkpoints is not None:
+                    # Every worker started from the same meta
+                    save_checkpoint(checkpoints, meta, event_ap_bg, m, data,
+                                    stepcache.get_changes(newmeta, before))
+    finally:
+        meta.ncpu = ncpu
+
+    newmeta.ncpu = ncpu
+    return datasets, newmeta
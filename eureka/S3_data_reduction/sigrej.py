@@ -1,6 +1,9 @@
 import numpy as np
 from ..lib import medstddev as msd
 
+# The number of values sigrej_cube processes at once by default
+CHUNK_VALUES = 2**22
+
 
 def sigrej(data, sigma, mask=None,     estsig=None,   ival=False, axis=0,
            fmean=False, fstddev=False, fmedian=False, fmedstddev=False):
@@ -207,3 +210,102 @@ def sigrej(data, sigma, mask=None,     estsig=None,   ival=False, axis=0,
     if len(ret) == 1:
         return ret[0]
     return ret
+
+
+def sigrej_cube(data, sigma, mask=None, chunk_size=None):
+    '''Flags outlying points along the time axis of a data cube using
+    sigma rejection.
+
+    Each pixel is rejected on its own: a point is flagged when it is more
+    than sigma times the standard deviation with respect to the median
+    away from the median, where both are computed from the pixel's good
+    points along time. This gives the same mask as sigrej(data, sigma,
+    mask) with axis=0, but uses plain (rather than masked) arrays and
+    reuses the work arrays between iterations.
+
+    Parameters
+    ----------
+    data : ndarray
+        The data cube, with time as the first axis.
+    sigma : ndarray (1D)
+        1D array of sigma values for each iteration of sigma rejection.
+        Number of elements determines number of iterations.
+    mask : ndarray; optional
+        Same shape as data, where True indicates the corresponding element
+        in data is good and False indicates it is bad. Only good elements
+        are considered. This input mask is not modified. Defaults to None
+        (every element is good).
+    chunk_size : int; optional
+        The number of pixels processed at once, which bounds the memory
+        used by the work arrays. Since each pixel is independent, the
+        results do not depend on it. Defaults to None, which processes
+        about CHUNK_VALUES values at once.
+
+    Returns
+    -------
+    ndarray
+        A boolean array of the same shape as data, where True indicates
+        good data and False indicates an outlier (or a point which was
+        already bad).
+
+    Notes
+    -----
+    Points which are not finite are never good. Pixels with no good
+    points have a NaN median and standard deviation, and pixels with one
+    good point have a standard deviation of 0.
+    '''
+    data = np.asarray(data)
+    sigma = np.atleast_1d(sigma)
+    nt = data.shape[0]
+    # Put the pixels along the first axis so that each pixel's points are
+    # contiguous
+    flat = data.reshape(nt, -1)
+    if mask is None:
+        flatmask = np.ones(flat.shape, dtype=bool)
+    else:
+        flatmask = np.asarray(mask, dtype=bool).reshape(nt, -1)
+    npix = flat.shape[1]
+    if chunk_size is None:
+        chunk_size = max(1, CHUNK_VALUES//max(nt, 1))
+
+    good = np.empty((npix, nt), dtype=bool)
+    for start in range(0, npix, chunk_size):
+        stop = min(start+chunk_size, npix)
+        good[start:stop] = _sigrej_pixels(flat[:, start:stop].T,
+                                          flatmask[:, start:stop].T, sigma)
+    return good.T.reshape(data.shape)
+
+
+def _sigrej_pixels(values, good, sigma):
+    # values and good are (npix, nt), the result is a new (npix, nt) mask
+    work = np.array(values, dtype=np.float64)
+    good = good & np.isfinite(work)
+    buffer = np.empty_like(work)
+    compare = np.empty(work.shape, dtype=bool)
+    for sig in sigma:
+        # Bad points are NaN, which sort to the end of each pixel
+        work[~good] = np.nan
+        ngood = np.sum(good, axis=1)
+        buffer[:] = work
+        buffer.sort(axis=1)
+        lower = np.maximum((ngood-1)//2, 0)[:, np.newaxis]
+        upper = np.maximum(ngood//2, 0)[:, np.newaxis]
+        median = 0.5*(np.take_along_axis(buffer, lower, axis=1) +
+                      np.take_along_axis(buffer, upper, axis=1))
+
+        # Standard deviation with respect to the median
+        np.subtract(work, median, out=buffer)
+        np.square(buffer, out=buffer)
+        buffer[~good] = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(np.sum(buffer, axis=1, keepdims=True) /
+                          (ngood[:, np.newaxis]-1))
+        std[ngood == 1] = 0
+        std[ngood == 0] = np.nan
+
+        # NaNs (bad points or pixels) always fail the comparisons
+        np.greater_equal(work, median-sig*std, out=compare)
+        good &= compare
+        np.less_equal(work, median+sig*std, out=compare)
+        good &= compare
+    return good
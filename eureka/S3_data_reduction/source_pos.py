@@ -3,6 +3,7 @@
 import numpy as np
 from scipy.optimize import curve_fit
 from . import plots_s3
+from ..lib import gaussian as g
 
 
 def source_pos(data, meta, m, header=False):
@@ -215,3 +216,58 @@ def source_pos_gauss(flux, meta, m):
                                  popt=popt)
 
     return popt[1]
+
+
+def source_pos_ints(flux, meta, src_ypos):
+    '''Measures the source position in every integration at once.
+
+    The rows within meta.spec_hw of src_ypos are summed along the
+    dispersion direction in every integration, and the centre and width of
+    each of these spatial profiles are measured with the method set by
+    meta.src_pos_type: a Gaussian fit with a constant background
+    ('gaussian', using gaussian.fitgaussian_batch, which gives NaN for the
+    fits which fail) or the flux-weighted mean and standard deviation (any
+    other value).
+
+    Parameters
+    ----------
+    flux : ndarray
+        The 3D array of flux values.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    src_ypos : int
+        The source position of the segment (e.g. from source_pos), around
+        which the profiles are measured.
+
+    Returns
+    -------
+    y_pos : ndarray
+        The centre of the source in each integration.
+    y_width : ndarray
+        The width (standard deviation) of the source in each integration.
+    '''
+    y1 = max(src_ypos-meta.spec_hw, 0)
+    y2 = src_ypos+meta.spec_hw
+    sum_rows = np.nansum(flux[:, y1:y2], axis=2, dtype=np.float64)
+    y_pixels = np.arange(y1, y1+sum_rows.shape[1], dtype=np.float64)
+
+    # Flux-weighted mean and standard deviation, relative to the mean of
+    # the edges of each profile as in source_pos_FWM
+    weights = sum_rows - (sum_rows[:, :1]+sum_rows[:, -1:])/2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm = np.sum(weights, axis=1)
+        y_pos = np.sum(weights*y_pixels, axis=1)/norm
+        y_width = np.sqrt(np.abs(np.sum(
+            weights*(y_pixels-y_pos[:, np.newaxis])**2, axis=1)/norm))
+
+    if getattr(meta, 'src_pos_type', None) == 'gaussian':
+        off = np.min(sum_rows, axis=1)
+        guess = np.stack([y_width, y_pos, np.max(sum_rows, axis=1)-off,
+                          off], axis=1)
+        params, failed = g.fitgaussian_batch(
+            sum_rows, y_pixels, np.isfinite(sum_rows), guess, fitbg=1,
+            ftol=1e-10)
+        params[failed] = np.nan
+        y_pos, y_width = params[:, 1], np.abs(params[:, 0])
+
+    return y_pos, y_width
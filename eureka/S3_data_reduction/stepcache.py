@@ -0,0 +1,258 @@
+import os
+import glob
+import copy
+import pickle
+import hashlib
+from ..version import __version__
+
+# The version of the cached step outputs, which is part of every key. Bump
+# it whenever a code change alters the result of a cached step, since the
+# package version does not change between releases.
+CACHE_VERSION = 3
+
+# Settings which never change the result of a step, such as where the
+# outputs go, what is printed or plotted, and how the work is split up
+IGNORED_KEYS = ['lines', 'params', 'folder', 'filename', 'eventlabel',
+                'topdir', 'inputdir', 'inputdir_raw', 'outputdir',
+                'outputdir_raw', 'run_s3', 's3_logname', 'segment_list',
+                'num_data_files', 'spec_hw_range', 'bg_hw_range',
+                'isplots_S3', 'hide_plots', 'verbose', 'save_output',
+                'ncpu', 'max_concurrent_segments', 'prefetch_depth',
+                'prefetch_max_size',
+                'sweep_reuse', 'int_chunk_size', 'max_pending_writes',
+                'output_compression', 'output_chunk_nint', 'cache_dir',
+                'cache_max_size', 'plot_ncpu', 'plot_every', 'resume',
+                'datetime', 'mad_s3', 'filename_S3_SpecData']
+# Values which each segment sets for itself, so the ones left over from the
+# previous segment do not matter
+SEGMENT_KEYS = ['n_int', 'ny', 'nx', 'int_start', 'subny', 'subnx',
+                'src_ypos', 'bg_y1', 'bg_y2']
+# Settings which are only used by the background subtraction
+BACKGROUND_KEYS = ['bg_hw', 'bg_thresh', 'bg_deg', 'p3thresh', 'save_bgsub']
+# Settings which are only used by the spectral extraction
+EXTRACTION_KEYS = ['spec_hw', 'fittype', 'window_len', 'prof_deg',
+                   'p5thresh', 'p7thresh', 'batch_optspex', 'median_method']
+# The settings which do not affect each step, on top of IGNORED_KEYS
+STEP_IGNORED_KEYS = {'calibrate': BACKGROUND_KEYS+EXTRACTION_KEYS,
+                     'background': EXTRACTION_KEYS}
+
+
+class StepCache:
+    '''An on-disk cache of the Dataset objects made by the steps of
+    Stage 3 which come before the spectral extraction.
+
+    Each entry is named by a hash of the code version (CACHE_VERSION), the
+    input file (its path, size, and modification time), the settings which
+    can change the step's result, and the key of the step before it, so
+    changing a setting only invalidates the steps which use it and the
+    steps after them. The least recently used entries are removed once the
+    cache is larger than max_size.
+
+    Parameters
+    ----------
+    cachedir : str
+        The directory holding the cache, which is created if needed.
+    max_size : float; optional
+        The maximum size of the cache in GB. Defaults to None (no limit).
+    '''
+    def __init__(self, cachedir, max_size=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, step, meta, m, parent=''):
+        '''Gets the key of a step for one segment.
+
+        Parameters
+        ----------
+        step : str
+            The name of the step ('calibrate' or 'background').
+        meta : eureka.lib.readECF.MetaClass
+            The metadata object at the start of the step.
+        m : int
+            The index of the segment in meta.segment_list.
+        parent : str; optional
+            The key of the step before this one. Defaults to ''.
+
+        Returns
+        -------
+        str
+            The key of this step.
+        '''
+        filename = os.path.abspath(meta.segment_list[m])
+        stat = os.stat(filename)
+        ignored = IGNORED_KEYS+SEGMENT_KEYS+STEP_IGNORED_KEYS[step]
+        sha = hashlib.sha256()
+        sha.update(pickle.dumps((__version__, CACHE_VERSION, step, parent,
+                                 filename, stat.st_size, stat.st_mtime_ns)))
+        hash_params(sha, meta, ignored)
+        return f'{step}_{sha.hexdigest()}'
+
+    def path(self, key):
+        '''Gets the file name of an entry.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry.
+
+        Returns
+        -------
+        str
+            The file name of the entry.
+        '''
+        return os.path.join(self.cachedir, key+'.pkl')
+
+    def load(self, key):
+        '''Loads an entry if it is in the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry.
+
+        Returns
+        -------
+        tuple or None
+            The (data, changes) of the entry, or None if it is not cached.
+        '''
+        try:
+            with open(self.path(key), 'rb') as f:
+                entry = pickle.load(f)
+            # Mark the entry as recently used
+            os.utime(self.path(key))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def store(self, key, data, changes):
+        '''Saves an entry, and then removes the least recently used entries
+        if the cache is too large.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry.
+        data : Xarray Dataset
+            The Dataset object made by the step.
+        changes : dict
+            The metadata attributes which the step changed.
+        '''
+        filename = self.path(key)
+        # Write to a temporary file first, so other processes never see
+        # partly written entries
+        tmpname = f'{filename}.{os.getpid()}.tmp'
+        with open(tmpname, 'wb') as f:
+            pickle.dump((data, changes), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, filename)
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache is no
+        larger than max_size.'''
+        if self.max_size is None:
+            return
+        entries = []
+        for filename in glob.glob(os.path.join(self.cachedir, '*.pkl')):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                # Another process removed it
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_size*1e9:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def hash_params(sha, meta, ignored=[]):
+    '''Adds the metadata attributes to a hash.
+
+    Parameters
+    ----------
+    sha : hashlib hash object
+        The hash, which is updated in place.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+    ignored : list; optional
+        The names of the attributes to leave out. Defaults to [].
+
+    Returns
+    -------
+    sha : hashlib hash object
+        The updated hash.
+    '''
+    for name in sorted(meta.params):
+        if name in ignored:
+            continue
+        try:
+            value = pickle.dumps(meta.params[name])
+        except Exception:
+            value = repr(meta.params[name]).encode()
+        sha.update(name.encode()+value)
+    return sha
+
+
+def snapshot(meta):
+    '''Copies the metadata attributes before a step.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object.
+
+    Returns
+    -------
+    dict
+        A copy of meta.params.
+    '''
+    return copy.deepcopy(meta.params)
+
+
+def get_changes(meta, before):
+    '''Finds the metadata attributes which a step changed.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object after the step.
+    before : dict
+        The attributes returned by snapshot before the step.
+
+    Returns
+    -------
+    dict
+        The new values of the attributes which were added or changed.
+    '''
+    changes = {}
+    for name, value in meta.params.items():
+        if (name not in before or
+                pickle.dumps(before[name]) != pickle.dumps(value)):
+            changes[name] = value
+    return changes
+
+
+def apply_changes(meta, changes):
+    '''Applies the metadata changes of a cached step.
+
+    Parameters
+    ----------
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object, which is updated in place.
+    changes : dict
+        The attributes returned by get_changes.
+
+    Returns
+    -------
+    meta : eureka.lib.readECF.MetaClass
+        The updated metadata object.
+    '''
+    for name, value in changes.items():
+        setattr(meta, name, value)
+    return meta
@@ -1,14 +1,19 @@
 
 # WFC3 specific rountines go here
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import multiprocessing as mp
 from astropy.io import fits
 import scipy.interpolate as spi
 import scipy.ndimage as spni
 import astraeus.xarrayIO as xrio
 from . import nircam
 from . import hst_scan as hst
-from ..lib import suntimecorr, utc_tt
+from ..lib import suntimecorr, utc_tt, maskflags
+
+# The Drift2D engine of each scan direction, along with the reference frames
+# it was made from
+_drift_engines = {}
 
 
 def preparation_step(meta, log):
@@ -33,14 +38,22 @@ def preparation_step(meta, log):
     """
     meta.gain = 1
 
+    # Read the headers of all the files once
+    headers = read_headers(meta.segment_list)
+
     obstimes, CRPIX1, CRPIX2, postarg1, postarg2, ny, meta, log = \
-        separate_direct(meta, log)
+        separate_direct(meta, log, headers)
     meta, log = separate_scan_direction(obstimes, postarg2, meta, log)
 
     # Calculate centroid of direct image(s)
+    if meta.cache_dir is not None:
+        cachedir = os.path.join(meta.cache_dir, 'wfc3_centroids')
+    else:
+        cachedir = None
     meta.centroid = hst.imageCentroid(meta.direct_list, meta.centroidguess,
                                       meta.centroidtrim, ny, CRPIX1, CRPIX2,
-                                      postarg1, postarg2)
+                                      postarg1, postarg2, headers=headers,
+                                      ncpu=meta.ncpu, cachedir=cachedir)
 
     # Initialize listto hold centroid positions from later steps in this stage
     meta.centroids = []
@@ -88,8 +101,38 @@ def conclusion_step(meta, log):
     return meta, log
 
 
-def separate_direct(meta, log):
-    """_summary_
+def read_headers(filenames):
+    """Read the header values used to prepare the data from every file.
+
+    The files are read in parallel threads, since this is limited by the
+    time spent opening the files.
+
+    Parameters
+    ----------
+    filenames : list
+        The names of the FITS files.
+
+    Returns
+    -------
+    headers : dict
+        The OBSTYPE, EXPSTART, POSTARG1, and POSTARG2 values of the main
+        header and the CRPIX1, CRPIX2, and NAXIS2 values of the science
+        header of each file, keyed by its name.
+    """
+    def read_header(filename):
+        with fits.open(filename) as file:
+            header = {key: file[0].header[key] for key in
+                      ['OBSTYPE', 'EXPSTART', 'POSTARG1', 'POSTARG2']}
+            header.update({key: file[1].header[key] for key in
+                           ['CRPIX1', 'CRPIX2', 'NAXIS2']})
+        return header
+
+    with ThreadPoolExecutor() as executor:
+        return dict(zip(filenames, executor.map(read_header, filenames)))
+
+
+def separate_direct(meta, log, headers=None):
+    """Separate the direct images from the spectroscopic observations.
 
     Parameters
     ----------
@@ -97,6 +140,9 @@ def separate_direct(meta, log):
         The current metadata object.
     log : logedit.Logedit
         The current log.
+    headers : dict; optional
+        The header values of each file returned by read_headers. Defaults
+        to None, which reads them.
 
     Returns
     -------
@@ -133,17 +179,19 @@ def separate_direct(meta, log):
     postarg2 = []
     CRPIX1 = []
     CRPIX2 = []
+    if headers is None:
+        headers = read_headers(meta.segment_list)
     for fname in meta.segment_list:
-        with fits.open(fname) as file:
-            obstypes.append(file[0].header['OBSTYPE'])
-            obstimes.append(file[0].header['EXPSTART'])
-            # Get the POSTARG2 parameter so we can
-            # later separate scan directions
-            postarg1.append(file[0].header['POSTARG1'])
-            postarg2.append(file[0].header['POSTARG2'])
-            CRPIX1.append(file[1].header['CRPIX1'])
-            CRPIX2.append(file[1].header['CRPIX2'])
-            ny = file[1].header['NAXIS2']
+        header = headers[fname]
+        obstypes.append(header['OBSTYPE'])
+        obstimes.append(header['EXPSTART'])
+        # Get the POSTARG2 parameter so we can
+        # later separate scan directions
+        postarg1.append(header['POSTARG1'])
+        postarg2.append(header['POSTARG2'])
+        CRPIX1.append(header['CRPIX1'])
+        CRPIX2.append(header['CRPIX2'])
+        ny = header['NAXIS2']
     obstypes = np.array(obstypes)
     obstimes = np.array(obstimes)
     postarg1 = np.array(postarg1)
@@ -445,13 +493,18 @@ def flatfield(data, meta):
 
     print('Loading flat frames...')
     print(meta.flatfile)
+    if meta.cache_dir is not None:
+        cachedir = os.path.join(meta.cache_dir, 'wfc3_flats')
+    else:
+        cachedir = None
     tempflat, tempmask = hst.makeflats(meta.flatfile,
                                        [np.mean(data.wave_2d.values,
                                                 axis=0), ],
                                        [[0, meta.nx], ], [[0, meta.ny], ],
                                        meta.flatoffset, 1, meta.ny, meta.nx,
                                        sigma=meta.flatsigma,
-                                       isplots=meta.isplots_S3)
+                                       isplots=meta.isplots_S3,
+                                       cachedir=cachedir)
     subflat = tempflat[0]
     flatmask = tempmask[0]
 
@@ -483,33 +536,50 @@ def difference_frames(data, meta):
     meta : eureka.lib.readECF.MetaClass
         The metadata object.
     '''
+    nframes = meta.nreads-1
+    flux = data.flux.values
+    err = data.err.values
+    # Scratch space which is reused for each intermediate cube
+    buffer = np.empty((nframes, meta.ny, meta.nx))
     if meta.nreads > 1:
         # Subtract pairs of subframes
-        diffflux = np.zeros((meta.nreads-1, meta.ny, meta.nx))
-        differr = np.zeros((meta.nreads-1, meta.ny, meta.nx))
-        for n in range(meta.nreads-1):
-            diffflux[n] = data.flux[n+1]-data.flux[n]
-            differr[n-1] = np.sqrt(data.err[n]**2+data.err[n-1]**2)
+        diffflux = np.empty((nframes, meta.ny, meta.nx))
+        differr = np.empty((nframes, meta.ny, meta.nx))
+        np.subtract(flux[1:], flux[:-1], out=diffflux)
+        # Add the uncertainties of each pair of subframes in quadrature
+        np.square(err[1:], out=differr)
+        np.square(err[:-1], out=buffer)
+        differr += buffer
+        np.sqrt(differr, out=differr)
     else:
         # FLT data has already been differenced
-        diffflux = data.flux
-        differr = data.err
+        diffflux = flux
+        differr = err
 
-    diffmask = np.zeros((meta.nreads-1, meta.ny, meta.nx))
-    guess = np.zeros((meta.nreads-1), dtype=int)
-    for n in range(meta.nreads-1):
-        diffmask[n] = np.copy(meta.flatmask[-1][0])
-        try:
-            diffmask[n][np.where(differr[n] > meta.diffthresh *
-                        np.median(differr[n], axis=1)[:, np.newaxis])] = 0
-        except:
-            # FINDME: Need to only catch the expected exception
-            # May fail for FLT files
-            print("Diffthresh failed - this may happen for FLT files.")
-
-        masked_data = diffflux[n]*diffmask[n]
-        guess[n] = np.median(np.where(masked_data > np.mean(masked_data)
-                                      )[0]).astype(int)
+    diffmask = np.empty((nframes, meta.ny, meta.nx))
+    diffmask[:] = meta.flatmask[-1][0]
+    try:
+        # Mask pixels with uncertainties well above the median of their row
+        thresh = meta.diffthresh*np.median(differr, axis=2, keepdims=True)
+        diffmask[differr > thresh] = 0
+    except:
+        # FINDME: Need to only catch the expected exception
+        # May fail for FLT files
+        print("Diffthresh failed - this may happen for FLT files.")
+
+    # Guess the position of the scan in each frame from the median row of
+    # the pixels which are brighter than the mean of the masked frame
+    masked_data = np.multiply(diffflux, diffmask, out=buffer)
+    mean = np.mean(masked_data, axis=(1, 2))
+    counts = np.count_nonzero(masked_data > mean[:, np.newaxis, np.newaxis],
+                              axis=2)
+    cumsum = np.cumsum(counts, axis=1)
+    total = cumsum[:, -1]
+    # The rows of the middle two pixels (the same if the total is odd)
+    lower = np.sum(cumsum <= ((total-1)//2)[:, np.newaxis], axis=1)
+    upper = np.sum(cumsum <= (total//2)[:, np.newaxis], axis=1)
+    # Frames with no pixels above the mean get a negative guess
+    guess = np.where(total > 0, (0.5*(lower+upper)).astype(int), -1)
     # Guess may be skewed if first read is zeros
     if guess[0] < 0 or guess[0] > meta.ny:
         guess[0] = guess[1]
@@ -645,12 +715,6 @@ def correct_drift2D(data, meta, m):
     meta : eureka.lib.readECF.MetaClass
         The updated metadata object.
     """
-    def writeDrift2D(arg):
-        drift2D, m, n = arg
-        # Assign to array of spectra and uncertainties
-        meta.drift2D[-1][n] = drift2D
-        return
-
     # Save the reference frame for each scan direction if not yet done
     if m < 2:
         # FINDME: This requires that the reference files be the first
@@ -664,36 +728,19 @@ def correct_drift2D(data, meta, m):
     print("Calculating 2D drift...")
     # FINDME: instead of calculating scanHeight, consider fitting
     # stretch factor
-    drift2D = np.zeros((meta.nreads-1, 2))
-    meta.drift2D.append(drift2D)
-    if meta.ncpu == 1:
-        # Only 1 CPU
-        # Get index of reference frame
-        # (0 = forward scan, 1 = reverse scan)
-        p = meta.scandir[m]
-        for n in range(meta.nreads-1):
-            writeDrift2D(hst.calcDrift2D((meta.subdata_ref[p][0] *
-                                          meta.subdiffmask[p][0]),
-                                         (data.flux[n] *
-                                          meta.subdiffmask[-1][n]),
-                                         m, n))
-    else:
-        # Multiple CPUs
-        pool = mp.Pool(meta.ncpu)
-        # Get index of reference frame
-        # (0 = forward scan, 1 = reverse scan)
-        p = meta.scandir[m]
-        for n in range(meta.nreads-1):
-            res = pool.apply_async(hst.calcDrift2D,
-                                   args=((meta.subdata_ref[p][0] *
-                                          meta.subdiffmask[p][0]),
-                                         (data.flux[n] *
-                                          meta.subdiffmask[-1][n]),
-                                         m, n),
-                                   callback=writeDrift2D)
-        pool.close()
-        pool.join()
-        res.wait()
+    # Get index of reference frame
+    # (0 = forward scan, 1 = reverse scan)
+    p = meta.scandir[m]
+    ref, engine = _drift_engines.get(p, (None, None))
+    if ref is not meta.subdata_ref[p]:
+        # Only transform each reference frame once
+        engine = hst.Drift2D(meta.subdata_ref[p][0].values *
+                             meta.subdiffmask[p][0])
+        _drift_engines[p] = (meta.subdata_ref[p], engine)
+    nreads = meta.nreads-1
+    meta.drift2D.append(engine.measure(
+        data.flux.values[:nreads] *
+        np.asarray(meta.subdiffmask[-1][:nreads])))
 
     print("Performing rough, pixel-scale drift correction...")
     meta.drift2D_int.append(np.round(meta.drift2D[-1], 0))
@@ -704,7 +751,7 @@ def correct_drift2D(data, meta, m):
                                   mode='constant', cval=0)
         data.mask[n] = spni.shift(data.mask[n],
                                   -1*meta.drift2D_int[-1][n, ::-1], order=0,
-                                  mode='constant', cval=0)
+                                  mode='constant', cval=maskflags.DRIFT)
         data.variance[n] = spni.shift(data.variance[n],
                                       -1*meta.drift2D_int[-1][n, ::-1],
                                       order=0, mode='constant', cval=0)
@@ -751,12 +798,18 @@ def correct_drift2D(data, meta, m):
                                meta.drift2D_int[-1][n, 1]).flatten(),
                               (ix-meta.drift2D[-1][n, 0] +
                                meta.drift2D_int[-1][n, 0]).flatten())
-        spline = spi.RectBivariateSpline(iy, ix, data.mask[n], kx=kx,
-                                         ky=ky, s=0)
-        data.mask[n] = spline((iy-meta.drift2D[-1][n, 1] +
-                               meta.drift2D_int[-1][n, 1]).flatten(),
-                              (ix-meta.drift2D[-1][n, 0] +
-                               meta.drift2D_int[-1][n, 0]).flatten())
+        spline = spi.RectBivariateSpline(iy, ix,
+                                         maskflags.good(data.mask[n].values),
+                                         kx=kx, ky=ky, s=0)
+        isgood = spline((iy-meta.drift2D[-1][n, 1] +
+                         meta.drift2D_int[-1][n, 1]).flatten(),
+                        (ix-meta.drift2D[-1][n, 0] +
+                         meta.drift2D_int[-1][n, 0]).flatten()) != 0
+        # Keep the flags of pixels which stay bad, and flag the pixels which
+        # only became bad due to the interpolation
+        data.mask[n] = np.where(isgood, 0,
+                                np.where(data.mask[n] == 0, maskflags.DRIFT,
+                                         data.mask[n]))
         spline = spi.RectBivariateSpline(iy, ix, data.variance[n], kx=kx,
                                          ky=ky, s=0)
         data.variance[n] = spline((iy-meta.drift2D[-1][n, 1] +
@@ -2,6 +2,7 @@ import numpy as np
 import os
 import matplotlib.pyplot as plt
 from ..lib import util
+from ..lib import plotqueue
 from ..lib.plots import figure_filetype
 
 
@@ -21,22 +22,30 @@ def binned_lightcurve(meta, lc, i):
     -------
     None
     '''
+    # Only send the light curve of this bandpass to the renderer
+    plotqueue.render(_binned_lightcurve, meta, lc.time.values,
+                     lc['data'][i].values, lc['err'][i].values,
+                     lc.wave_low.values[i], lc.wave_hi.values[i],
+                     lc.data.attrs['time_units'], i)
+
+
+def _binned_lightcurve(meta, time, lcdata, lcerr, wave_low, wave_hi,
+                       time_units, i):
+    # Draws Fig 4102 for binned_lightcurve
     plt.figure(4102, figsize=(8, 6))
     plt.clf()
-    plt.suptitle(f'Bandpass {i}: {lc.wave_low.values[i]:.3f} - '
-                 f'{lc.wave_hi.values[i]:.3f}')
+    plt.suptitle(f'Bandpass {i}: {wave_low:.3f} - {wave_hi:.3f}')
     ax = plt.subplot(111)
-    time_modifier = np.floor(lc.time.values[0])
+    time_modifier = np.floor(time[0])
     # Normalized light curve
-    norm_lcdata = lc['data'][i]/np.nanmedian(lc['data'][i].values)
-    norm_lcerr = lc['err'][i]/np.nanmedian(lc['data'][i].values)
-    plt.errorbar(lc.time-time_modifier, norm_lcdata, norm_lcerr, fmt='o',
+    norm_lcdata = lcdata/np.nanmedian(lcdata)
+    norm_lcerr = lcerr/np.nanmedian(lcdata)
+    plt.errorbar(time-time_modifier, norm_lcdata, norm_lcerr, fmt='o',
                  color=f'C{i}', mec=f'C{i}', alpha=0.2)
     mad = util.get_mad_1d(norm_lcdata)
     plt.text(0.05, 0.1, f"MAD = {np.round(mad).astype(int)} ppm",
              transform=ax.transAxes, color='k')
     plt.ylabel('Normalized Flux')
-    time_units = lc.data.attrs['time_units']
     plt.xlabel(f'Time [{time_units} - {time_modifier}]')
 
     plt.subplots_adjust(left=0.10, right=0.95, bottom=0.10, top=0.90,
@@ -148,6 +157,13 @@ def cc_spec(meta, ref_spec, fit_spec, n):
     -------
     None
     '''
+    if n % meta.plot_every != 0:
+        return
+    plotqueue.render(_cc_spec, meta, ref_spec, fit_spec, n)
+
+
+def _cc_spec(meta, ref_spec, fit_spec, n):
+    # Draws Fig 4301 for cc_spec
     plt.figure(4301, figsize=(8, 8))
     plt.clf()
     plt.title(f'Cross Correlation - Spectrum {n}')
@@ -180,6 +196,13 @@ def cc_vals(meta, vals, n):
     -------
     None
     '''
+    if n % meta.plot_every != 0:
+        return
+    plotqueue.render(_cc_vals, meta, vals, n)
+
+
+def _cc_vals(meta, vals, n):
+    # Draws Fig 4302 for cc_vals
     plt.figure(4302, figsize=(8, 8))
     plt.clf()
     plt.title(f'Cross Correlation - Values {n}')
@@ -26,6 +26,7 @@ from ..lib import readECF
 from ..lib import manageevent as me
 from ..lib import util
 from ..lib import clipping
+from ..lib import plotqueue
 
 
 def genlc(eventlabel, ecf_path=None, s3_meta=None):
@@ -182,10 +183,27 @@ def genlc(eventlabel, ecf_path=None, s3_meta=None):
             lc.wave_hi.attrs['wave_units'] = spec.wave_1d.attrs['wave_units']
             lc.wave_err.attrs['wave_units'] = spec.wave_1d.attrs['wave_units']
 
+            # Keep the source position of each integration measured in S3
+            for name in ['centroid_y', 'centroid_sy']:
+                if name in spec:
+                    lc[name] = (['time'], spec[name].values)
+
             if not hasattr(meta, 'boundary'):
                 # The default value before this was added as an option
                 meta.boundary = 'extend'
 
+            if not hasattr(meta, 'plot_ncpu'):
+                # The default value before this was added as an option
+                meta.plot_ncpu = 0
+
+            if not hasattr(meta, 'plot_every'):
+                # The default value before this was added as an option
+                meta.plot_every = 1
+
+            # Draw the figures on other processes while the light curves
+            # are made
+            plotter = plotqueue.start(meta.plot_ncpu)
+
             # FINDME: The current implementation needs improvement,
             # consider using optmask instead of masked arrays
             # Create masked array for steps below
@@ -297,6 +315,10 @@ def genlc(eventlabel, ecf_path=None, s3_meta=None):
                 if meta.isplots_S4 >= 3:
                     plots_s4.binned_lightcurve(meta, lc, i)
 
+            if plotter is not None:
+                # Make sure every figure has been saved
+                plotter.close()
+
             # Calculate total time
             total = (time_pkg.time() - t0) / 60.
             log.writelog('\nTotal time (min): ' + str(np.round(total, 2)))
@@ -631,3 +631,120 @@ def resids(param, x, ngauss, y):
         gss = np.append(gss, gauss)
     p = np.reshape(gss, (ngauss, len(gss)/ngauss))
     return np.ravel(gaussians(x, param=p)-y)
+
+
+def fitgaussian_batch(y, x, mask, guess, bg=None, fitbg=0, maxiter=100,
+                      ftol=1.49012e-08):
+    """Fit many 1D Gaussians (with a fixed or fitted background) at once.
+
+    Each row of y is fit independently using a Levenberg-Marquardt
+    optimizer which is vectorized over all of the rows, so that thousands
+    of small fits can be performed without a Python loop over each one.
+
+    Parameters
+    ----------
+    y : 2D ndarray
+        Array of shape (nfit, npts) giving the values of the functions.
+    x : 1D ndarray
+        Array of length npts giving the abcissas shared by all rows of y.
+    mask : 2D ndarray
+        Same shape as y. Values where its corresponding mask value is
+        0 are disregarded for the minimization (and need not be finite).
+    guess : 2D ndarray
+        Array of shape (nfit, 3) giving the initial [width, center, height]
+        of each Gaussian, or of shape (nfit, 4) giving the initial [width,
+        center, height, bg] if fitbg=1.
+    bg : 1D ndarray; optional
+        Fixed (not fitted) background level of each row, as used by
+        fitgaussian with fitbg=0. Defaults to None (no background).
+    fitbg : int; optional
+        0 to keep the background fixed at bg, or 1 to fit a constant
+        background to each row (bg = c) as in fitgaussian. Defaults to 0.
+    maxiter : int; optional
+        The maximum number of Levenberg-Marquardt steps. Defaults to 100.
+    ftol : float; optional
+        Relative reduction in the sum of squares below which a fit is
+        considered to be converged. Defaults to 1.49012e-08 (the same as
+        scipy.optimize.leastsq).
+
+    Returns
+    -------
+    params : 2D ndarray
+        Array of shape (nfit, 3) with the fitted [width, center, height]
+        of each Gaussian, with the fitted bg as a fourth column if fitbg=1.
+    failed : 1D ndarray
+        Boolean array of length nfit which is True for the fits whose
+        parameters or chi-squared are not finite, whose Jacobian is
+        singular at the best fit (where fitgaussian would not return
+        uncertainties), or which did not converge within maxiter steps.
+    """
+    mask = np.asarray(mask, dtype=float)
+    # Masked values do not need to be finite
+    y = np.where(mask != 0, np.asarray(y, dtype=float), 0)
+    x = np.asarray(x, dtype=float)
+    params = np.array(guess, dtype=float)
+    nfit = y.shape[0]
+    npars = 3+fitbg
+    if bg is not None:
+        y = y - np.asarray(bg, dtype=float)[:, np.newaxis]
+
+    def model_jac(p):
+        width, center, height = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+        dx = x - center
+        expo = np.exp(-0.5*(dx/width)**2)
+        model = height*expo
+        derivs = [model*dx**2/width**3, model*dx/width**2, expo]
+        if fitbg:
+            model = model + p[:, 3:4]
+            derivs.append(np.ones_like(expo))
+        return model, np.stack(derivs, axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        model, jac = model_jac(params)
+        res = mask*(y-model)
+        chi2 = np.sum(res**2, axis=1)
+        lam = np.full(nfit, 1e-3)
+        active = np.arange(nfit)
+        for _ in range(maxiter):
+            if len(active) == 0:
+                break
+            # Damped normal equations for the active fits
+            jmask = jac[active]*mask[active, :, np.newaxis]
+            alpha = np.einsum('nki,nkj->nij', jmask, jmask)
+            beta = np.einsum('nki,nk->ni', jmask, res[active])
+            diag = np.arange(npars)
+            alpha[:, diag, diag] *= 1+lam[active, np.newaxis]
+            alpha[~np.isfinite(alpha)] = 0
+            beta[~np.isfinite(beta)] = 0
+            step = (np.linalg.pinv(alpha) @ beta[:, :, np.newaxis])[:, :, 0]
+            newparams = params[active] + step
+            newmodel, newjac = model_jac(newparams)
+            newres = mask[active]*(y[active]-newmodel)
+            newchi2 = np.sum(newres**2, axis=1)
+
+            better = np.isfinite(newchi2) & (newchi2 <= chi2[active])
+            converged = better & ((chi2[active]-newchi2) <=
+                                  ftol*chi2[active])
+            ind = active[better]
+            params[ind] = newparams[better]
+            model[ind] = newmodel[better]
+            jac[ind] = newjac[better]
+            res[ind] = newres[better]
+            chi2[ind] = newchi2[better]
+            lam[ind] /= 10
+            lam[active[~better]] *= 10
+            # Stop once converged or the step can no longer be improved
+            done = converged | (lam[active] > 1e10)
+            active = active[~done]
+
+        failed = ~np.all(np.isfinite(params), axis=1) | ~np.isfinite(chi2)
+        failed[active] = True
+        # The covariance matrix cannot be computed if the Jacobian is not
+        # of full rank at the best fit
+        jmask = jac*mask[:, :, np.newaxis]
+        ok = ~failed & np.all(np.isfinite(jmask), axis=(1, 2))
+        failed[~ok] = True
+        if np.any(ok):
+            failed[ok] = np.linalg.matrix_rank(jmask[ok]) < npars
+
+    return params, failed
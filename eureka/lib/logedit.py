@@ -122,3 +122,47 @@ class Logedit:
         """
         self.writelog(message, mute, end)
         self.closelog()
+
+
+class LogBuffer:
+    """This object stores log messages so that they can be written to
+    a Logedit log later on, e.g. by the main process after a worker
+    process has finished.
+    """
+
+    def __init__(self):
+        """Creates an empty buffer of messages."""
+        self.messages = []
+
+    def writelog(self, message, mute=False, end='\n'):
+        r"""Stores a message to be logged later.
+
+        Parameters
+        ----------
+        message : str
+            The message to log.
+        mute : bool; optional
+            If True, only log and do not print. Defaults to False.
+        end : str; optional
+            Can be set to '\r' to have the printed line overwritten which
+            is useful for progress bars. Defaults to '\n'.
+        """
+        self.messages.append((message, mute, end))
+
+    def writeto(self, log, mute=False, clear=True):
+        """Writes all of the stored messages to a log.
+
+        Parameters
+        ----------
+        log : logedit.Logedit
+            The open log in which the messages should be written.
+        mute : bool; optional
+            If True, only log and do not print any of the messages.
+            Defaults to False.
+        clear : bool; optional
+            If True, empty the buffer afterwards. Defaults to True.
+        """
+        for message, mute_message, end in self.messages:
+            log.writelog(message, mute=(mute or mute_message), end=end)
+        if clear:
+            self.messages = []
@@ -0,0 +1,84 @@
+"""Bit flags recording why Stage 3 masked a pixel.
+
+The pixel mask (data['mask']) holds one uint8 per pixel which is 0 for
+good pixels. Each step which masks pixels sets its own bit, so the mask
+saved in the FluxData files shows which step(s) flagged each pixel.
+"""
+import numpy as np
+
+# NaN in the flux, error, or variance arrays
+NAN = 1
+# Inside one of the manually masked regions (meta.manmask)
+MANUAL = 2
+# Outlier in the background region along the time axis (flag_bg)
+BG_OUTLIER = 4
+# Outlier in the background fit (fit_bg)
+BG_FIT = 8
+# Outlier during optimal spectral extraction (e.g. a cosmic ray)
+OPTSPEX = 16
+# Shifted in from outside the frame by the WFC3 drift correction
+DRIFT = 32
+
+NAMES = {NAN: 'NAN', MANUAL: 'MANUAL', BG_OUTLIER: 'BG_OUTLIER',
+         BG_FIT: 'BG_FIT', OPTSPEX: 'OPTSPEX', DRIFT: 'DRIFT'}
+
+DTYPE = np.uint8
+
+
+def good(flags):
+    '''Gets the good pixel mask used by the fitting functions.
+
+    Parameters
+    ----------
+    flags : ndarray
+        The flags of each pixel.
+
+    Returns
+    -------
+    ndarray
+        A boolean array which is True (1 = good) where no flag is set.
+    '''
+    return flags == 0
+
+
+def flag(flags, isbad, bit):
+    '''Sets a flag on the given pixels.
+
+    Parameters
+    ----------
+    flags : ndarray
+        The flags of each pixel, which are updated in place.
+    isbad : ndarray
+        A boolean array which is True for the pixels to flag.
+    bit : int
+        The flag to set (e.g. maskflags.NAN).
+
+    Returns
+    -------
+    flags : ndarray
+        The updated flags.
+    '''
+    flags[isbad] |= bit
+    return flags
+
+
+def update(flags, isgood, bit):
+    '''Flags the pixels which a step newly marked as bad.
+
+    Parameters
+    ----------
+    flags : ndarray
+        The flags of each pixel before the step, which are updated in place.
+    isgood : ndarray
+        The good pixel mask returned by the step (1 = good, 0 = bad).
+        Pixels which were already flagged keep their flags.
+    bit : int
+        The flag to set (e.g. maskflags.BG_OUTLIER).
+
+    Returns
+    -------
+    flags : ndarray
+        The updated flags.
+    '''
+    flags[np.logical_not(isgood) & (flags == 0)] = bit
+    return flags
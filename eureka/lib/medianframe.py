@@ -0,0 +1,188 @@
+import numpy as np
+
+# The P-squared algorithm's desired marker positions after the first five
+# values and their increments for each new value, for the median (p=0.5)
+P2_POSITIONS = np.array([1., 2., 3., 4., 5.])
+P2_INCREMENTS = np.array([0., 0.25, 0.5, 0.75, 1.])
+
+
+class MedianFrame:
+    '''The median along time of a range of rows of a data cube.
+
+    Each row is only computed once, so the median frames of nested
+    regions (e.g. the apertures of different sizes around the same
+    source position) are views of the rows which were already computed.
+
+    Parameters
+    ----------
+    cube : ndarray
+        The data cube, with time as the first axis and rows as the second.
+    '''
+    def __init__(self, cube):
+        self.cube = cube
+        self.ny = cube.shape[1]
+        self.start = 0
+        self.stop = 0
+        self.median = None
+
+    def compute(self, start, stop):
+        '''Computes the median frame of some rows.
+
+        Parameters
+        ----------
+        start : int
+            The first row.
+        stop : int
+            The row after the last row.
+
+        Returns
+        -------
+        ndarray
+            The median frame of the rows.
+        '''
+        return np.median(self.cube[:, start:stop], axis=0)
+
+    def rows(self, start, stop):
+        '''Gets the median frame of cube[:, start:stop].
+
+        Parameters
+        ----------
+        start : int
+            The first row, as in cube[:, start:stop].
+        stop : int
+            The row after the last row, as in cube[:, start:stop].
+
+        Returns
+        -------
+        ndarray
+            The median frame of the rows, which is a view of the rows
+            computed so far.
+        '''
+        # Follow numpy's slicing rules for out of range and negative rows
+        start, stop, _ = slice(start, stop).indices(self.ny)
+        stop = max(start, stop)
+        if self.median is None:
+            self.median = self.compute(start, stop)
+            self.start, self.stop = start, stop
+        elif start < self.start or stop > self.stop:
+            # Only compute the rows which are missing
+            parts = []
+            if start < self.start:
+                parts.append(self.compute(start, self.start))
+            parts.append(self.median)
+            if stop > self.stop:
+                parts.append(self.compute(self.stop, stop))
+            self.median = np.concatenate(parts)
+            self.start = min(start, self.start)
+            self.stop = max(stop, self.stop)
+        return self.median[start-self.start:stop-self.start]
+
+
+class StreamingMedian:
+    '''An approximate median frame which is updated one integration at a
+    time, using the P-squared algorithm (Jain & Chlamtac 1985).
+
+    Five markers per pixel track the minimum, the maximum, the median,
+    and the quartiles of the values seen so far, so the memory used does
+    not depend on the number of integrations and the frames never need to
+    be read again. The estimate is exact for up to five integrations.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of each frame.
+    '''
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.first = []
+        self.isnan = np.zeros(self.shape, dtype=bool)
+        self.heights = None
+        self.positions = None
+        self.desired = P2_POSITIONS.copy()
+
+    def update(self, frames):
+        '''Adds some integrations to the estimate.
+
+        Parameters
+        ----------
+        frames : ndarray
+            The new frames, with time as the first axis.
+        '''
+        for frame in frames:
+            self.add(np.asarray(frame, dtype=np.float64))
+
+    def add(self, x):
+        '''Adds one integration to the estimate.
+
+        Parameters
+        ----------
+        x : ndarray
+            The new frame.
+        '''
+        # np.median gives NaN for pixels with any NaNs
+        self.isnan |= np.isnan(x)
+        if self.heights is None:
+            self.first.append(x)
+            if len(self.first) == 5:
+                self.heights = np.sort(np.array(self.first), axis=0)
+                self.positions = np.ones(self.heights.shape)
+                self.positions *= P2_POSITIONS.reshape(
+                    (5,)+(1,)*len(self.shape))
+                self.first = []
+            return
+
+        q, n = self.heights, self.positions
+        with np.errstate(invalid='ignore'):
+            # Extend the range of the outer markers, and move the markers
+            # above the new value up by one
+            q[0] = np.minimum(q[0], x)
+            q[4] = np.maximum(q[4], x)
+            n[1:4] += x < q[1:4]
+            n[4] += 1
+            self.desired += P2_INCREMENTS
+
+            # Adjust the middle markers which are too far from their desired
+            # positions
+            for i in range(1, 4):
+                d = self.desired[i] - n[i]
+                move = (((d >= 1) & (n[i+1]-n[i] > 1)) |
+                        ((d <= -1) & (n[i-1]-n[i] < -1)))
+                if not np.any(move):
+                    continue
+                s = np.where(move, np.sign(d), 0)
+                # Piecewise-parabolic prediction
+                parabolic = q[i] + s/(n[i+1]-n[i-1])*(
+                    (n[i]-n[i-1]+s)*(q[i+1]-q[i])/(n[i+1]-n[i]) +
+                    (n[i+1]-n[i]-s)*(q[i]-q[i-1])/(n[i]-n[i-1]))
+                # Linear prediction, used when the parabolic one is not
+                # between the neighbouring markers
+                linear = np.where(
+                    s > 0, q[i] + (q[i+1]-q[i])/(n[i+1]-n[i]),
+                    q[i] - (q[i-1]-q[i])/(n[i-1]-n[i]))
+                isinside = (q[i-1] < parabolic) & (parabolic < q[i+1])
+                q[i] = np.where(move, np.where(isinside, parabolic, linear),
+                                q[i])
+                n[i] += s
+
+    def result(self):
+        '''Gets the current estimate of the median frame.
+
+        Returns
+        -------
+        ndarray
+            The estimated median frame.
+
+        Raises
+        ------
+        ValueError
+            No integrations have been added.
+        '''
+        if self.heights is None:
+            if len(self.first) == 0:
+                raise ValueError('No integrations have been added to the '
+                                 'streaming median.')
+            median = np.median(np.array(self.first), axis=0)
+        else:
+            median = self.heights[2].copy()
+        median[self.isnan] = np.nan
+        return median
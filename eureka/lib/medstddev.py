@@ -17,8 +17,9 @@ def medstddev(data, mask=None, medi=False, axis=0):
         If True return a tuple with (stddev, median) of data. Defaults
         to False.
     axis : int; optional
-        The axis along wich the median std deviation is calculated.
-        Defaults to 0.
+        The axis along wich the median std deviation is calculated, so
+        each element of the other axes gets its own median and std
+        deviation. Defaults to 0.
 
     Returns
     -------
@@ -103,25 +104,21 @@ def medstddev(data, mask=None, medi=False, axis=0):
     # calculate median of good values:
     median = np.ma.median(data, axis=axis)
     # residuals is data - median, masked values don't count:
-    residuals = data - median
+    residuals = data - np.ma.expand_dims(median, axis)
     # calculate standar deviation:
     with np.errstate(divide='ignore', invalid='ignore'):
-        std = np.ma.sqrt(np.ma.sum(residuals**2.0) / (ngood - 1.0))
+        std = np.ma.sqrt(np.ma.sum(residuals**2.0, axis=axis) /
+                         (ngood - 1.0))
 
-    # Convert masked arrays to just arrays
-    std = np.array(std)
-    median = np.array(median)
-    if std.shape == ():
-        # If just a single value, make sure using a shaped array
-        std = std.reshape(-1)
-        median = median.reshape(-1)
+    # Convert masked arrays to just arrays, making sure using shaped arrays
+    std = np.atleast_1d(np.ma.getdata(std)).astype(float)
+    median = np.atleast_1d(np.ma.getdata(median)).astype(float)
+    ngood = np.atleast_1d(ngood)
 
     # critical case fixes:
-    if np.any(ngood == 0):
-        std[np.where(ngood == 0)[0]] = np.nan
-        median[np.where(ngood == 0)[0]] = np.nan
-    if np.any(ngood == 1):
-        std[np.where(ngood == 1)[0]] = 0.
+    std[ngood == 0] = np.nan
+    median[ngood == 0] = np.nan
+    std[ngood == 1] = 0.
 
     if len(std) == 1:
         std = std[0]
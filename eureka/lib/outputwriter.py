@@ -0,0 +1,204 @@
+import queue
+import threading
+import h5py
+import astraeus.xarrayIO as xrio
+try:
+    # Registers the zstd, lz4, and blosc filters with h5py
+    import hdf5plugin
+except ModuleNotFoundError:
+    hdf5plugin = None
+
+# Compression filters which are built into h5py
+H5PY_COMPRESSION = ['gzip', 'lzf']
+# Compression filters which need the hdf5plugin package
+PLUGIN_COMPRESSION = {'zstd': 'Zstd', 'lz4': 'LZ4', 'blosc': 'Blosc'}
+
+
+def get_encoding(data, compression=None, chunk_nint=None):
+    '''Gets the HDF5 chunking and compression settings of each array.
+
+    Parameters
+    ----------
+    data : Xarray Dataset
+        The Dataset object which will be saved.
+    compression : str; optional
+        The compression filter ('gzip', 'lzf', or, if hdf5plugin is
+        installed, 'zstd', 'lz4', or 'blosc'). Defaults to None (no
+        compression).
+    chunk_nint : int; optional
+        The number of integrations in each HDF5 chunk of the arrays with a
+        time axis. Other axes are never split, so reading one integration
+        only decompresses its own chunk. Defaults to None, which uses one
+        integration per chunk if compressing and no chunking otherwise.
+
+    Returns
+    -------
+    encoding : dict
+        The encoding of each array for xarray.Dataset.to_netcdf.
+
+    Raises
+    ------
+    ValueError
+        The compression filter is unknown or needs hdf5plugin, which
+        is not installed.
+    '''
+    if compression is None:
+        filters = {}
+    elif compression in H5PY_COMPRESSION:
+        filters = {'compression': compression}
+    elif compression in PLUGIN_COMPRESSION:
+        if hdf5plugin is None:
+            raise ValueError(f'The {compression} compression filter requires '
+                             f'the hdf5plugin package, which is not '
+                             f'installed.')
+        plugin = getattr(hdf5plugin, PLUGIN_COMPRESSION[compression])()
+        filters = {'compression': plugin.filter_id,
+                   'compression_opts': plugin.filter_options}
+    else:
+        raise ValueError(f'Unknown compression filter {compression}. '
+                         f'Options are {H5PY_COMPRESSION} or '
+                         f'{list(PLUGIN_COMPRESSION)}.')
+    if chunk_nint is None and compression is not None:
+        chunk_nint = 1
+
+    encoding = {}
+    for name, var in data.data_vars.items():
+        if var.ndim == 0 or var.dtype.kind not in 'biuf':
+            continue
+        encoding[name] = dict(filters)
+        if chunk_nint is not None:
+            encoding[name]['chunksizes'] = tuple(
+                min(chunk_nint, size) if dim == 'time' else size
+                for dim, size in zip(var.dims, var.shape))
+    return encoding
+
+
+def writeXR(filename, data, verbose=True, append=False, compression=None,
+            chunk_nint=None):
+    '''Saves a Dataset like astraeus.xarrayIO.writeXR, but with optional
+    HDF5 chunking and compression.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the output file.
+    data : Xarray Dataset
+        The Dataset object to save.
+    verbose : bool; optional
+        If True, print when the file has been written. Defaults to True.
+    append : bool; optional
+        If True, add to an existing file. Defaults to False.
+    compression : str; optional
+        The compression filter, see get_encoding. Defaults to None.
+    chunk_nint : int; optional
+        The number of integrations in each HDF5 chunk, see get_encoding.
+        Defaults to None.
+
+    Returns
+    -------
+    success : int
+        1 if the file was written, or 0 if some attributes could not be
+        saved.
+    '''
+    if compression is None and chunk_nint is None:
+        return xrio.writeXR(filename, data, verbose=verbose, append=append)
+
+    encoding = get_encoding(data, compression, chunk_nint)
+    try:
+        data.to_netcdf(filename, mode=('a' if append else 'w'),
+                       engine='h5netcdf', encoding=encoding,
+                       invalid_netcdf=True)
+    except TypeError as e:
+        # Attributes such as FITS headers cannot be saved
+        print(f'Unable to write {filename}: {e}')
+        return 0
+    if verbose:
+        print(f'Finished writing to {filename}')
+    return 1
+
+
+def update_array(filename, name, key, values):
+    '''Overwrites part of an array in a saved file in place.
+
+    Parameters
+    ----------
+    filename : str
+        The file written by writeXR.
+    name : str
+        The name of the array (e.g. 'mask').
+    key : tuple
+        The index of the part of the array to overwrite.
+    values : ndarray
+        The new values of that part of the array.
+    '''
+    with h5py.File(filename, 'r+') as f:
+        f[name][key] = values
+
+
+class OutputWriter:
+    '''Runs the writing of output files on a background thread.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of outputs waiting to be written. Once it is
+        reached, submit blocks until the oldest output has been written,
+        which bounds the memory held by pending outputs.
+    '''
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        '''Writes the submitted outputs until None is submitted.'''
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args):
+        '''Queues func(*args) to be run on the background thread.
+
+        Parameters
+        ----------
+        func : callable
+            The function which writes the output.
+        *args
+            The arguments of func.
+        '''
+        self.queue.put((func, args))
+
+    def flush(self):
+        '''Waits until every submitted output has been written.
+
+        Raises
+        ------
+        Exception
+            The first error raised while writing, if any.
+        '''
+        self.queue.join()
+        if len(self.errors) > 0:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    def close(self):
+        '''Writes the remaining outputs and stops the background thread.'''
+        self.queue.put(None)
+        self.thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
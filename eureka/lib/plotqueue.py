@@ -0,0 +1,164 @@
+"""Deferred rendering of the diagnostic figures made for each integration.
+
+Figures passed to render are drawn right away unless a PlotQueue is
+active, in which case they are drawn by a pool of renderer processes
+using the Agg backend while the reduction continues.
+"""
+import os
+import pickle
+import collections
+import multiprocessing as mp
+import matplotlib
+import matplotlib.pyplot as plt
+
+# The PlotQueue which render sends the figures to, if any
+_active = None
+
+
+def _init_renderer(rc):
+    # Renderer processes never show figures, and they should look the same
+    # as those drawn by the main process
+    plt.switch_backend('Agg')
+    matplotlib.rcParams.update(rc)
+
+
+def _run(job):
+    func, meta, args, kwargs = pickle.loads(job)
+    # Figures cannot be shown from the renderer processes, so do not wait
+    # for them to be drawn on screen
+    meta.hide_plots = True
+    func(meta, *args, **kwargs)
+
+
+class PlotQueue:
+    '''A pool of processes which render figures in the background.
+
+    While the queue is active, every figure passed to render is drawn by
+    the pool. Closing the queue waits until every figure has been saved.
+
+    Parameters
+    ----------
+    ncpu : int
+        The number of renderer processes.
+    max_pending : int; optional
+        The maximum number of figures waiting to be drawn. Once it is
+        reached, render blocks until the oldest figure has been saved,
+        which bounds the memory held by pending figures. Defaults to
+        None, which allows 16 per renderer process.
+    '''
+    def __init__(self, ncpu, max_pending=None):
+        rc = {key: value for key, value in matplotlib.rcParams.items()
+              if key != 'backend'}
+        self.pool = mp.Pool(ncpu, initializer=_init_renderer,
+                            initargs=(rc,))
+        if max_pending is None:
+            max_pending = 16*ncpu
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        # Processes forked from this one must draw their own figures
+        self.pid = os.getpid()
+        self.previous = None
+
+    def activate(self):
+        '''Sends the figures passed to render to this queue.'''
+        global _active
+        self.previous, _active = _active, self
+
+    def deactivate(self):
+        '''Stops sending the figures passed to render to this queue.'''
+        global _active
+        if _active is self:
+            _active = self.previous
+
+    def submit(self, func, meta, *args, **kwargs):
+        '''Queues a figure to be drawn by the renderer processes.
+
+        The arguments are copied right away, so they can be changed
+        afterwards without affecting the figure.
+
+        Parameters
+        ----------
+        func : callable
+            The module-level function which draws and saves the figure.
+        meta : eureka.lib.readECF.MetaClass
+            The metadata object, the first argument of func.
+        *args, **kwargs
+            The other arguments of func.
+        '''
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().get()
+        job = pickle.dumps((func, meta, args, kwargs),
+                           protocol=pickle.HIGHEST_PROTOCOL)
+        self.pending.append(self.pool.apply_async(_run, (job,)))
+
+    def flush(self):
+        '''Waits until every queued figure has been saved.
+
+        Raises
+        ------
+        Exception
+            The first error raised while drawing a figure, if any.
+        '''
+        while len(self.pending) > 0:
+            self.pending.popleft().get()
+
+    def close(self):
+        '''Saves the remaining figures and stops the renderer processes.'''
+        self.deactivate()
+        try:
+            self.flush()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not wait for the figures of a failed reduction
+            self.deactivate()
+            self.pool.terminate()
+            self.pool.join()
+
+
+def start(ncpu):
+    '''Starts and activates a PlotQueue if ncpu is positive.
+
+    Parameters
+    ----------
+    ncpu : int
+        The number of renderer processes (e.g. meta.plot_ncpu).
+
+    Returns
+    -------
+    PlotQueue or None
+        The active PlotQueue, or None if ncpu is 0 (figures are drawn
+        right away).
+    '''
+    if ncpu <= 0:
+        return None
+    plotter = PlotQueue(ncpu)
+    plotter.activate()
+    return plotter
+
+
+def render(func, meta, *args, **kwargs):
+    '''Draws a figure, in the background if a PlotQueue is active.
+
+    Parameters
+    ----------
+    func : callable
+        The module-level function which draws and saves the figure.
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object, the first argument of func.
+    *args, **kwargs
+        The other arguments of func.
+    '''
+    if _active is None or _active.pid != os.getpid():
+        func(meta, *args, **kwargs)
+    else:
+        _active.submit(func, meta, *args, **kwargs)
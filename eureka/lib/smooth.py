@@ -73,13 +73,15 @@ def smooth(x, window_len=10, window='hanning'):
 
 
 def medfilt(x, window_len):
-    """Apply a length-k median filter to a 1D array x.
+    """Apply a length-k median filter along the last axis of x.
     Boundaries are extended by repeating endpoints.
 
     Parameters
     ----------
-    x : ndarray (1D)
-        The data to be smoothed.
+    x : ndarray
+        The data to be smoothed. Arrays with more than one dimension are
+        smoothed independently along their last axis (e.g. every row of
+        an image at once).
     window_len : int
         The smoothing window length.
 
@@ -88,20 +90,22 @@ def medfilt(x, window_len):
     ndarray
         A smoothed copy of x.
     """
-    assert(x.ndim == 1), "Input must be one-dimensional."
+    assert x.ndim >= 1, "Input must be at least one-dimensional."
     if window_len % 2 == 0:
         print("Median filter length ("+str(window_len)+") must be odd." +
               "Adding 1.")
         window_len += 1
     k2 = (window_len - 1) // 2
-    s = np.r_[2*np.median(x[0:window_len//5])-x[window_len:1:-1], x,
-              2*np.median(x[-window_len//5:])-x[-1:-window_len:-1]]
-    y = np.zeros((len(s), window_len), dtype=s.dtype)
-    y[:, k2] = s
+    med0 = np.median(x[..., 0:window_len//5], axis=-1, keepdims=True)
+    med1 = np.median(x[..., -window_len//5:], axis=-1, keepdims=True)
+    s = np.concatenate((2*med0-x[..., window_len:1:-1], x,
+                        2*med1-x[..., -1:-window_len:-1]), axis=-1)
+    y = np.zeros(s.shape+(window_len,), dtype=s.dtype)
+    y[..., k2] = s
     for i in range(k2):
         j = k2 - i
-        y[j:, i] = s[:-j]
-        y[:j, i] = s[0]
-        y[:-j, -(i+1)] = s[j:]
-        y[-j:, -(i+1)] = s[-1]
-    return np.median(y[window_len-1:-window_len+1], axis=1)
+        y[..., j:, i] = s[..., :-j]
+        y[..., :j, i] = s[..., :1]
+        y[..., :-j, -(i+1)] = s[..., j:]
+        y[..., -j:, -(i+1)] = s[..., -1:]
+    return np.median(y[..., window_len-1:-window_len+1, :], axis=-1)
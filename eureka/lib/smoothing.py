@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.ndimage as spnd
 
 
 def gauss_kernel_mask2(ny_nx, sy_sx, j_i, mask):
@@ -39,3 +40,50 @@ def gauss_kernel_mask2(ny_nx, sy_sx, j_i, mask):
         kernel = 0.
 
     return kernel
+
+
+def gauss_smooth_mask(data, mask, ny_nx, sy_sx):
+    """Computes the Gaussian-weighted mean of the good pixels around every
+    pixel of an image.
+
+    This is the same as summing the image times gauss_kernel_mask2 at each
+    pixel, but the whole image is done at once with normalized convolution:
+    the masked image and the mask are each convolved with the (separable)
+    Gaussian kernel, and then divided.
+
+    Parameters
+    ----------
+    data : ndarray
+        The image, or a stack of images along the first axes.
+    mask : ndarray
+        The mask, which is 1 (or True) for good pixels and 0 for bad pixels.
+        Same shape as data.
+    ny_nx : list/ndarray
+        The half-size of the kernel along the y and x axes.
+    sy_sx : list/ndarray
+        The standard deviation of the Gaussian along the y and x axes.
+
+    Returns
+    -------
+    ndarray
+        The smoothed image, which is 0 where there are no good pixels
+        within the kernel.
+    """
+    ny = int(ny_nx[0])
+    nx = int(ny_nx[1])
+    sy, sx = sy_sx
+    kerny = np.exp(-0.5*(np.arange(-ny, ny+1)/sy)**2)
+    kernx = np.exp(-0.5*(np.arange(-nx, nx+1)/sx)**2)
+
+    def convolve(image):
+        # Pixels outside the image are zero, as in gauss_kernel_mask2
+        image = spnd.correlate1d(image, kerny, axis=-2, mode='constant')
+        return spnd.correlate1d(image, kernx, axis=-1, mode='constant')
+
+    mask = np.asarray(mask, dtype=float)
+    weights = convolve(mask)
+    smoothed = convolve(np.where(mask > 0, data, 0.)*mask)
+    good = weights > 0
+    smoothed[good] /= weights[good]
+    smoothed[~good] = 0.
+    return smoothed
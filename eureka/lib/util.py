@@ -1,5 +1,6 @@
 import numpy as np
 from . import sort_nicely as sn
+from . import maskflags
 import os
 import time
 import glob
@@ -41,14 +42,22 @@ def trim(data, meta):
     -------
     subdata : Xarray Dataset
         A new Dataset object with arrays that have been trimmed, depending on
-        xwindow and ywindow as set in the S3 ecf.
+        xwindow and ywindow as set in the S3 ecf. If the data were already
+        trimmed when they were read in (see read_trimmed), data is
+        returned unchanged.
     meta : eureka.lib.readECF.MetaClass
         The metadata object.
     """
-    subdata = data.isel(y=np.arange(meta.ywindow[0], meta.ywindow[1]),
-                        x=np.arange(meta.xwindow[0], meta.xwindow[1]))
     meta.subny = meta.ywindow[1] - meta.ywindow[0]
     meta.subnx = meta.xwindow[1] - meta.xwindow[0]
+    if (data.y.size == meta.subny and data.x.size == meta.subnx and
+            data.y.values[0] == meta.ywindow[0] and
+            data.x.values[0] == meta.xwindow[0]):
+        # Only the region of interest was read in
+        subdata = data
+    else:
+        subdata = data.isel(y=np.arange(meta.ywindow[0], meta.ywindow[1]),
+                            x=np.arange(meta.xwindow[0], meta.xwindow[1]))
     if hasattr(meta, 'diffmask'):
         # Need to crop diffmask and variance from WFC3 as well
         meta.subdiffmask.append(
@@ -62,6 +71,48 @@ def trim(data, meta):
     return subdata, meta
 
 
+def read_trimmed(hdu, meta, swap=False):
+    """Reads only the region of interest of a 3D FITS image extension.
+
+    Unscaled data are returned as views of the memory-mapped file, so
+    nothing is read until it is used and only the region of interest is
+    ever paged in. Scaled data (e.g. unsigned DQ arrays stored with BZERO)
+    cannot be memory-mapped, so only the region of interest is read
+    through hdu.section.
+
+    Parameters
+    ----------
+    hdu : astropy.io.fits.ImageHDU
+        The FITS extension with shape (n_int, ny, nx).
+    meta : eureka.lib.readECF.MetaClass
+        The metadata object, with the xwindow and ywindow of the
+        region of interest.
+    swap : bool; optional
+        If True, the y and x axes are swapped and the new x axis is
+        reversed (as done for MIRI data with DISPAXIS = 2), and xwindow
+        and ywindow refer to this swapped frame. Defaults to False.
+
+    Returns
+    -------
+    ndarray
+        The region of interest with shape (n_int, subny, subnx).
+    """
+    y0, y1 = meta.ywindow
+    x0, x1 = meta.xwindow
+    if swap:
+        ny = hdu.shape[1]
+        region = (slice(None), slice(ny-x1, ny-x0), slice(y0, y1))
+    else:
+        region = (slice(None), slice(y0, y1), slice(x0, x1))
+    if hdu.header.get('BZERO', 0) != 0 or hdu.header.get('BSCALE', 1) != 1:
+        data = hdu.section[region]
+    else:
+        data = hdu.data[region]
+    if swap:
+        data = np.swapaxes(data, 1, 2)[:, :, ::-1]
+    return data
+
+
 def check_nans(data, mask, log, name=''):
     """Checks where a data array has NaNs.
 
@@ -70,7 +121,7 @@ def check_nans(data, mask, log, name=''):
     data : ndarray
         a data array (e.g. data, err, dq, ...).
     mask : ndarray
-        Input mask.
+        Input mask of flags (see eureka.lib.maskflags).
     log : logedit.Logedit
         The open log in which NaNs will be mentioned if existent.
     name : str; optional
@@ -80,17 +131,91 @@ def check_nans(data, mask, log, name=''):
     Returns
     -------
     mask : ndarray
-        Output mask where 0 will be written where the input data array has NaNs
+        Output mask with the NAN flag set where the input data array has NaNs
+    """
+    num_nans = flag_nans(data, mask)
+    warn_nans(log, name, num_nans)
+    return mask
+
+
+def flag_nans(data, mask):
+    """Sets the NAN flag of a mask where a data array has NaNs.
+
+    Parameters
+    ----------
+    data : ndarray
+        a data array (e.g. data, err, dq, ...).
+    mask : ndarray
+        Mask of flags (see eureka.lib.maskflags), which is updated in
+        place.
+
+    Returns
+    -------
+    num_nans : int
+        The number of NaNs in the data array.
+    """
+    # Index the underlying arrays, since xarray would treat the indices
+    # of the NaNs as an outer product
+    isnan = np.isnan(np.asarray(data))
+    num_nans = np.sum(isnan)
+    if num_nans > 0:
+        maskflags.flag(np.asarray(mask), isnan, maskflags.NAN)
+    return num_nans
+
+
+def warn_nans(log, name, num_nans):
+    """Warns that a data array has NaNs, if there are any.
+
+    Parameters
+    ----------
+    log : logedit.Logedit
+        The open log in which NaNs will be mentioned if existent.
+    name : str
+        The name of the data array (e.g. SUBDATA, SUBERR, SUBV0).
+    num_nans : int
+        The number of NaNs in the data array.
     """
-    num_nans = np.sum(np.isnan(data))
     if num_nans > 0:
         log.writelog(f"  WARNING: {name} has {num_nans} NaNs. Your subregion "
                      f"may be off the edge of the detector subarray.\n"
                      "Masking NaN region and continuing, but you should really"
                      " stop and reconsider your choices.")
-        inan = np.where(np.isnan(data))
-        # subdata[inan]  = 0
-        mask[inan] = 0
+
+
+def mask_manual(mask, manmask, ystart=0, ny=None):
+    """Sets the MANUAL flag of a mask in the manually masked regions.
+
+    Each region is given as [colstart, colend, rowstart, rowend], where
+    rowstart:rowend and colstart:colend index the first two axes of the
+    mask (the integrations and the spatial rows of a 3D mask).
+
+    Parameters
+    ----------
+    mask : ndarray
+        Mask of flags (see eureka.lib.maskflags), which is updated in
+        place.
+    manmask : list
+        The manually masked regions (meta.manmask).
+    ystart : int; optional
+        The index along the second axis of the full mask at which the
+        given mask starts, if it only holds a block of it. Defaults to 0.
+    ny : int; optional
+        The length of the second axis of the full mask. Defaults to None,
+        which uses ystart plus the length of the given mask.
+
+    Returns
+    -------
+    mask : ndarray
+        The updated mask.
+    """
+    mask = np.asarray(mask)
+    if ny is None:
+        ny = ystart+mask.shape[1]
+    for colstart, colend, rowstart, rowend in manmask:
+        # Only keep the part of the region inside the given mask
+        start, stop, _ = slice(colstart, colend).indices(ny)
+        cols = slice(max(start-ystart, 0), max(stop-ystart, 0))
+        mask[rowstart:rowend, cols] |= maskflags.MANUAL
     return mask
 
 
@@ -3,6 +3,8 @@
 import numpy as np
 import sys
 import os
+import copy
+import glob
 
 sys.path.insert(0, '..'+os.sep)
 from eureka.lib import util
@@ -49,6 +51,30 @@ def test_trim(capsys):
                                   (trim_x1 - trim_x0))
 
 
+def test_read_trimmed(capsys, tmp_path):
+    # eureka.lib.util.read_trimmed test
+    from astropy.io import fits
+
+    rng = np.random.default_rng(0)
+    sci = rng.normal(0, 1, (3, 20, 30)).astype(np.float32)
+    dq = rng.integers(0, 2**32, (3, 20, 30), dtype=np.uint32)
+    filename = str(tmp_path / 'test.fits')
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(sci, name='SCI'),
+                  fits.ImageHDU(dq, name='DQ')]).writeto(filename)
+
+    meta = MetaClass(ywindow=[2, 14], xwindow=[5, 25])
+    with fits.open(filename) as hdulist:
+        # The unsigned DQ array is scaled, so it cannot be memory-mapped
+        for name, full in [('SCI', sci), ('DQ', dq)]:
+            trimmed = util.read_trimmed(hdulist[name], meta)
+            np.testing.assert_array_equal(trimmed, full[:, 2:14, 5:25])
+            # The windows of swapped data refer to the swapped frame
+            swapmeta = MetaClass(ywindow=[4, 27], xwindow=[3, 16])
+            trimmed = util.read_trimmed(hdulist[name], swapmeta, swap=True)
+            swapped = np.swapaxes(full, 1, 2)[:, :, ::-1]
+            np.testing.assert_array_equal(trimmed, swapped[:, 4:27, 3:16])
+
+
 def test_medstddev(capsys):
     # eureka.lib.util.medstddev.medstddev test
     a = np.array([1, 3, 4, 5, 6, 7, 7])
@@ -78,3 +104,1054 @@ def test_medstddev(capsys):
     std, med = medstddev(a, mask, medi=True)
     assert np.isnan(std)
     assert np.isnan(med)
+
+    # each element of the other axes gets its own std
+    a = np.array([[1, 3, 4, 5, 6, 7, 7], [1, 4, 6, 1, 4, 6, 1]])
+    mask = np.ones(a.shape)
+    mask[1, 1:] = 0
+    std, med = medstddev(a, mask, medi=True, axis=1)
+    np.testing.assert_allclose(std, [2.2360679775, 0])
+    np.testing.assert_allclose(med, [5, 1])
+    std, med = medstddev(a.T, mask.T, medi=True, axis=0)
+    np.testing.assert_allclose(std, [2.2360679775, 0])
+
+
+def test_sigrej_cube(capsys):
+    # eureka.S3_data_reduction.sigrej.sigrej_cube test
+    from eureka.S3_data_reduction import sigrej
+
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 1, (40, 6, 5))
+    data[3, 1, 1] = 50
+    data[5, 2, 2] = np.nan
+    data[7, 0, 0] = np.inf
+    mask = rng.random(data.shape) > 0.1
+    mask[:, 4, 4] = False
+    mask[:, 3, 3] = False
+    mask[0, 3, 3] = True
+    good = sigrej.sigrej_cube(data, [5, 5], mask)
+
+    # Each pixel is rejected using the median and standard deviation of
+    # its own good points
+    for j in range(6):
+        for i in range(5):
+            values = data[:, j, i]
+            expected = mask[:, j, i] & np.isfinite(values)
+            for sigma in [5, 5]:
+                if not np.any(expected):
+                    break
+                median = np.median(values[expected])
+                std = np.sqrt(np.sum((values[expected]-median)**2) /
+                              max(np.sum(expected)-1, 1))
+                expected &= np.abs(values-median) <= sigma*std
+            np.testing.assert_array_equal(good[:, j, i], expected)
+    assert not good[3, 1, 1]
+    assert not good[5, 2, 2] and not good[7, 0, 0]
+    assert not np.any(good[:, 4, 4])
+    # A single good point is kept
+    assert np.sum(good[:, 3, 3]) == 1
+    # The input mask is not modified
+    assert np.sum(mask[:, 3, 3]) == 1
+    np.testing.assert_array_equal(
+        sigrej.sigrej_cube(data, [5, 5], mask, chunk_size=7), good)
+    # sigrej gives the same mask
+    np.testing.assert_array_equal(
+        sigrej.sigrej(data, [5, 5], mask.copy(), axis=0), good)
+
+
+def test_optimize_batch(capsys):
+    # eureka.S3_data_reduction.optspex.optimize_batch test
+    from eureka.S3_data_reduction import optspex
+
+    meta = MetaClass()
+    meta.isplots_S3 = 0
+    rng = np.random.default_rng(0)
+    nt, ny, nx = 4, 12, 30
+    y = np.arange(ny)[:, np.newaxis]
+    profile = np.exp(-0.5*((y-5.5)/1.5)**2)*np.ones(nx)
+    data = 1000*profile + 3*rng.standard_normal((nt, ny, nx))
+    # Add some cosmic rays
+    data[1, 4, 10] += 800
+    data[3, 6, 20] += 800
+    mask = np.ones(data.shape, dtype=bool)
+    bg = np.zeros(data.shape)
+    v0 = 9*np.ones(data.shape)
+    stdspec = np.sum(data, axis=1)
+    meddata = np.median(data, axis=0)
+
+    for fittype in ['meddata', 'smooth']:
+        spec, err, submask = optspex.optimize_batch(
+            meta, data, mask, bg, stdspec, 1, v0, p7thresh=5,
+            fittype=fittype, window_len=11, meddata=meddata)
+        for n in range(nt):
+            spec1, err1, submask1 = optspex.optimize(
+                meta, data[n], mask[n], bg[n], stdspec[n], 1, v0[n],
+                p7thresh=5, fittype=fittype, window_len=11,
+                meddata=meddata)
+            np.testing.assert_allclose(spec[n], spec1)
+            np.testing.assert_allclose(err[n], err1)
+            assert np.all(submask[n] == submask1)
+        # The cosmic rays should have been masked
+        assert not submask[1, 4, 10]
+        assert not submask[3, 6, 20]
+
+
+def test_profile_stack(capsys):
+    # eureka.S3_data_reduction.optspex.profile_smooth/profile_poly test
+    from eureka.S3_data_reduction import optspex
+
+    rng = np.random.default_rng(1)
+    nt, ny, nx = 3, 10, 40
+    y = np.arange(ny)[:, np.newaxis]
+    profile = np.exp(-0.5*((y-4.5)/1.5)**2)*np.ones(nx)
+    data = 1000*profile + 3*rng.standard_normal((nt, ny, nx))
+    data[1, 5, 12] += 500
+    mask = np.ones(data.shape, dtype=bool)
+    mask[2, 3, 30] = False
+
+    # Fitting the whole stack should match fitting one frame at a time
+    for func, kwargs in [(optspex.profile_smooth, {'window_len': 11}),
+                         (optspex.profile_poly, {'deg': 3})]:
+        stack = func(data, mask, threshold=5, **kwargs)
+        assert stack.shape == data.shape
+        for n in range(nt):
+            frame = func(data[n], mask[n], threshold=5, **kwargs)
+            np.testing.assert_allclose(stack[n], frame)
+        # Profiles should be normalized along the spatial direction
+        np.testing.assert_allclose(np.sum(stack, axis=1), 1)
+
+
+def test_profile_gauss(capsys):
+    # eureka.S3_data_reduction.optspex.profile_gauss test
+    from eureka.S3_data_reduction import optspex
+    from eureka.lib import gaussian as g
+
+    rng = np.random.default_rng(2)
+    nt, ny, nx = 2, 20, 15
+    y = np.arange(ny)
+    data = (1000*np.exp(-0.5*((y[:, np.newaxis]-9.3)/1.6)**2) +
+            3*rng.standard_normal((nt, ny, nx)))
+    data[1, 2, 4] += 500
+    mask = np.ones(data.shape, dtype=bool)
+
+    # The batched fits should match scipy's fit of each column
+    fit, failed = g.fitgaussian_batch(data[0].T, y, mask[0].T,
+                                      np.tile([ny/10., 9, 1000], (nx, 1)))
+    assert not np.any(failed)
+    for i in range(nx):
+        params, err = g.fitgaussian(data[0, :, i], y, fitbg=0,
+                                    bgpars=[0., 0., 0.],
+                                    guess=[ny/10., 9, 1000])
+        np.testing.assert_allclose(fit[i], params, rtol=1e-6)
+    # A column without a source has a singular fit
+    _, failed = g.fitgaussian_batch(np.zeros((1, ny)), y, np.ones((1, ny)),
+                                    [[ny/10., 9, 1000]])
+    assert failed[0]
+
+    stack = optspex.profile_gauss(data, mask, threshold=5)
+    assert stack.shape == data.shape
+    for n in range(nt):
+        frame = optspex.profile_gauss(data[n], mask[n], threshold=5)
+        np.testing.assert_allclose(stack[n], frame)
+    np.testing.assert_allclose(np.sum(stack, axis=1), 1)
+    # The profile should be close to the true (normalized) trace
+    truth = np.exp(-0.5*((y-9.3)/1.6)**2)
+    np.testing.assert_allclose(stack[0, :, 0], truth/np.sum(truth),
+                               atol=2e-3)
+
+
+def test_fitbg(capsys):
+    # eureka.S3_data_reduction.background.fitbg test
+    from eureka.S3_data_reduction import background
+
+    rng = np.random.default_rng(3)
+    nt, ny, nx = 3, 30, 20
+    y = np.arange(ny)[:, np.newaxis]
+    data = 50 + 0.2*y + rng.normal(0, 1, (nt, ny, nx))
+    data[:, 12:18] += 1000
+    data[1, 3, 5] += 200
+    mask = np.ones(data.shape, dtype=bool)
+    mask[2, 25, :] = False
+
+    meta = MetaClass()
+    bg, bgmask = background.fitbg(data, meta, mask.copy(), 10, 20, deg=1,
+                                  threshold=5, isrotate=2)
+    assert bg.shape == data.shape
+    # The cosmic ray in the background region should have been masked
+    assert not bgmask[1, 3, 5]
+    assert np.sum(~bgmask) == np.sum(~mask) + 1
+    # Fitting the whole stack should match fitting one frame at a time
+    for n in range(nt):
+        frame, framemask = background.fitbg(data[n], meta, mask[n].copy(),
+                                            10, 20, deg=1, threshold=5,
+                                            isrotate=2)
+        np.testing.assert_allclose(bg[n], frame)
+        np.testing.assert_array_equal(bgmask[n], framemask)
+    # Each column should match an unweighted linear fit of the good pixels
+    good = np.where(bgmask[0, :, 0] & ((y[:, 0] < 10) | (y[:, 0] > 20)))[0]
+    coeffs = np.polyfit(good, data[0, good, 0], 1)
+    np.testing.assert_allclose(bg[0, :, 0], np.polyval(coeffs, y[:, 0]))
+
+
+def test_bgpool(capsys):
+    # eureka.S3_data_reduction.background.BGPool test
+    from eureka.S3_data_reduction import background
+
+    class Log:
+        def writelog(self, *args, **kwargs):
+            pass
+
+    def make_data(seed, nt):
+        rng = np.random.default_rng(seed)
+        flux = 20 + rng.normal(0, 1, (nt, 30, 40))
+        flux[:, :, 5] += 500
+        data = xrio.makeDataset()
+        data['flux'] = xrio.makeFluxLikeDA(flux, np.arange(nt), 'electrons',
+                                           'BJD_TDB', name='flux')
+        data['mask'] = (['time', 'y', 'x'], np.zeros(flux.shape,
+                                                     dtype=np.uint8))
+        return data
+
+    meta = MetaClass(inst='nircam', int_start=0, bg_y1=10, bg_y2=20,
+                     bg_deg=1, p3thresh=5, verbose=False, precision='float64')
+    # The same pool should be reusable for segments of different sizes
+    with background.BGPool(2) as pool:
+        for seed, nt in enumerate([3, 6, 2]):
+            meta.n_int = nt
+            meta.ncpu = 1
+            serial = background.BGsubtraction(make_data(seed, nt), meta, Log(),
+                                              0)
+            meta.ncpu = 2
+            shared = background.BGsubtraction(make_data(seed, nt), meta, Log(),
+                                              0, pool=pool)
+            np.testing.assert_allclose(shared.bg, serial.bg, atol=1e-10)
+            np.testing.assert_array_equal(shared.mask, serial.mask)
+
+
+def test_logbuffer(capsys, tmp_path):
+    # eureka.lib.logedit.LogBuffer test
+    from eureka.lib import logedit
+
+    buffer = logedit.LogBuffer()
+    buffer.writelog('first')
+    buffer.writelog('second', mute=True)
+    logname = str(tmp_path / 'test.log')
+    log = logedit.Logedit(logname)
+    # Messages can be written to several logs before clearing the buffer
+    buffer.writeto(log, mute=True, clear=False)
+    assert len(buffer.messages) == 2
+    buffer.writeto(log)
+    log.closelog()
+    with open(logname) as f:
+        assert f.read() == 'first\nsecond\nfirst\nsecond\n'
+    assert buffer.messages == []
+
+
+def write_nircam_segment(filename, nt=7, ny=40, nx=30, seed=0,
+                         bunit='ELECTRONS/S'):
+    # Write a small NIRCam-like segment and return its metadata
+    from astropy.io import fits
+
+    rng = np.random.default_rng(seed)
+    y = np.arange(ny)[:, np.newaxis]
+    sci = (5 + 100*np.exp(-(y-20)**2/4) + rng.normal(0, 1, (nt, ny, nx)))
+    sci[3, 5, 7] = 1000
+    sci[4, 30, 2] = np.nan
+    mhdr = fits.Header({'INSTRUME': 'NIRCAM', 'TELESCOP': 'JWST',
+                        'DETECTOR': 'NRCALONG', 'EXP_TYPE': 'NRC_TSGRISM',
+                        'DATE-OBS': '2022-07-01', 'TIME-OBS': '12:00:00.000',
+                        'FILTER': 'F322W2', 'PUPIL': 'GRISMR',
+                        'SUBSTRT1': 0, 'SUBSTRT2': 0, 'SUBSIZE1': nx,
+                        'SUBSIZE2': ny, 'INTSTART': 1, 'INTEND': nt,
+                        'EFFINTTM': 2.})
+    shdr = fits.Header({'BUNIT': bunit, 'SRCYPOS': 22, 'DISPAXIS': 1,
+                        'PHOTMJSR': 4., 'PIXAR_SR': 1e-13})
+    times = fits.BinTableHDU.from_columns(
+        [fits.Column(name='int_mid_BJD_TDB', format='D',
+                     array=np.arange(nt, dtype=float))], name='INT_TIMES')
+    wave = np.tile(np.linspace(2, 4, nx), (ny, 1))
+    fits.HDUList([fits.PrimaryHDU(header=mhdr),
+                  fits.ImageHDU(sci.astype(np.float32), shdr, name='SCI'),
+                  fits.ImageHDU(np.ones(sci.shape, dtype=np.float32),
+                                name='ERR'),
+                  fits.ImageHDU(np.zeros(sci.shape, dtype=np.uint32),
+                                name='DQ'),
+                  fits.ImageHDU(np.ones(sci.shape, dtype=np.float32),
+                                name='VAR_RNOISE'),
+                  fits.ImageHDU(wave, name='WAVELENGTH'),
+                  times]).writeto(filename)
+
+    outputdir = os.path.dirname(filename)+os.sep
+    return MetaClass(segment_list=[filename], num_data_files=1,
+                     inst='nircam', ywindow=[2, 38], xwindow=[1, 29],
+                     ncpu=1, bg_hw=8, bg_thresh=[5, 5], bg_deg=1,
+                     p3thresh=5, spec_hw=5, fittype='meddata',
+                     window_len=11, prof_deg=3, p5thresh=10, p7thresh=10,
+                     batch_optspex=False, isplots_S3=0, testing_S3=False,
+                     save_output=False, verbose=False, firstFile=False,
+                     outputdir=outputdir, int_chunk_size=None,
+                     output_compression=None, output_chunk_nint=None,
+                     precision='float64', cache_dir=None, cache_max_size=None,
+                     median_method='exact', ancil_dir=None,
+                     plot_ncpu=0, plot_every=1, hide_plots=True,
+                     track_ypos=False, src_pos_type='gaussian',
+                     manmask=[[10, 12, 1, 3]])
+
+
+def write_nircam_ecf(tmp_path, nseg=3, **options):
+    # Write a few small NIRCam-like segments and an S3 ECF to reduce them,
+    # and return the directory holding the ECF
+    os.makedirs(tmp_path / 'in', exist_ok=True)
+    for m in range(nseg):
+        write_nircam_segment(str(tmp_path / 'in' / f'seg{m}_calints.fits'),
+                             seed=m)
+    settings = dict(ncpu=1, suffix='calints', ywindow=[2, 38],
+                    xwindow=[1, 29], src_pos_type='gaussian', bg_hw=8,
+                    bg_thresh=[5, 5], bg_deg=1, p3thresh=5, save_bgsub=False,
+                    spec_hw=5, fittype='meddata', window_len=11, prof_deg=3,
+                    p5thresh=10, p7thresh=10, isplots_S3=0, testing_S3=False,
+                    hide_plots=True, save_output=False, verbose=False,
+                    topdir=str(tmp_path), inputdir='/in', outputdir='/out')
+    settings.update(options)
+    with open(tmp_path / 'S3_test.ecf', 'w') as f:
+        for name, value in settings.items():
+            f.write(f'{name} {value}\n'.replace(', ', ','))
+    return str(tmp_path)
+
+
+def test_source_pos_ints(capsys, tmp_path):
+    # eureka.S3_data_reduction.source_pos.source_pos_ints test
+    from scipy.optimize import curve_fit
+    from eureka.lib import logedit
+    from eureka.S3_data_reduction import s3_reduce, source_pos
+
+    rng = np.random.default_rng(0)
+    y = np.arange(40)
+    drift = 20 + 0.3*np.sin(np.arange(50)/5)
+    trace = y[:, np.newaxis] - drift[:, np.newaxis, np.newaxis]
+    flux = 5 + 100*np.exp(-trace**2/4.5) + rng.normal(0, 1, (50, 40, 30))
+    meta = MetaClass(spec_hw=8, src_pos_type='gaussian')
+    y_pos, y_width = source_pos.source_pos_ints(flux, meta, 20)
+    # Same as fitting each integration on its own
+    sum_rows = np.sum(flux[:, 12:28], axis=2)
+    for n in [0, 17, 49]:
+        popt, _ = curve_fit(source_pos.gauss, y[12:28], sum_rows[n],
+                            [np.max(sum_rows[n]), 20, 2,
+                             np.min(sum_rows[n])])
+        np.testing.assert_allclose((y_pos[n], y_width[n]),
+                                   (popt[1], abs(popt[2])), atol=1e-6)
+    assert np.std(y_pos-drift) < 0.01
+    # Profiles which are not finite give NaN
+    bad = flux.copy()
+    bad[5, 15, 3] = np.inf
+    y_pos, y_width = source_pos.source_pos_ints(bad, meta, 20)
+    assert np.isnan(y_pos[5]) and np.isnan(y_width[5])
+    assert np.sum(np.isnan(y_pos)) == 1
+    meta.src_pos_type = 'weighted'
+    y_pos, y_width = source_pos.source_pos_ints(flux, meta, 20)
+    assert np.std(y_pos-drift) < 0.02
+    np.testing.assert_allclose(y_width, 1.5, rtol=0.05)
+
+    # The time series is kept in the segment's Dataset
+    filename = str(tmp_path / 'test_calints.fits')
+    basemeta = write_nircam_segment(filename)
+    basemeta.track_ypos = True
+    results = []
+    for int_chunk_size in [None, 3]:
+        meta = copy.deepcopy(basemeta)
+        meta.int_chunk_size = int_chunk_size
+        data, meta = s3_reduce.reduce_segment(
+            xrio.makeDataset(), meta, logedit.LogBuffer(), 0, 'test')
+        results.append(data)
+    assert results[0].centroid_y.dims == ('time',)
+    # The trace is at row 20, or 18 after trimming
+    np.testing.assert_allclose(results[0].centroid_y, 18, atol=0.05)
+    np.testing.assert_allclose(results[1].centroid_y, results[0].centroid_y)
+    np.testing.assert_allclose(results[1].centroid_sy,
+                               results[0].centroid_sy)
+
+
+def test_drift2D(capsys):
+    # eureka.S3_data_reduction.hst_scan.Drift2D test
+    from scipy.ndimage import shift
+    from eureka.S3_data_reduction import hst_scan
+
+    rng = np.random.default_rng(0)
+    yy, xx = np.indices((60, 80))
+    image = (((yy > 10) & (yy < 50))*1000*np.exp(-(xx-40)**2/200) + 10)
+    shifts = rng.uniform(-2, 2, (5, 2))
+    images = np.array([shift(image, s, order=3) + rng.normal(0, 1, image.shape)
+                       for s in shifts])
+    drift = hst_scan.Drift2D(image).measure(images)
+    # The x and y offsets of each image
+    np.testing.assert_allclose(drift, shifts[:, ::-1], atol=0.1)
+    # Same as searching the whole upsampled map one image at a time
+    np.testing.assert_array_equal(
+        hst_scan.Drift2D(image, step=1, batch_size=1).measure(images), drift)
+
+
+def test_replace_pixels_frame(capsys):
+    # eureka.S3_data_reduction.hst_scan.replacePixelsFrame test
+    from eureka.S3_data_reduction import hst_scan
+
+    rng = np.random.default_rng(0)
+    data = rng.normal(100, 5, (30, 40))
+    mask = (rng.random(data.shape) > 0.1).astype(float)
+    mask[:8, :8] = 0
+    data[mask == 0] = np.nan
+    replaced = hst_scan.replacePixelsFrame(data, mask, 3, 3, 1.5, 1.5)
+    np.testing.assert_array_equal(replaced[mask == 1], data[mask == 1])
+    # Same as replacing one pixel at a time
+    clean = np.where(mask == 1, data, 0)
+    bad = np.argwhere(mask == 0)
+    for k, (j, i) in enumerate(bad):
+        expected, _, _, _, _ = hst_scan.replacePixels(
+            clean, mask, j, 0, i, 0, k, len(bad), 3, 3, 1.5, 1.5)
+        np.testing.assert_allclose(replaced[j, i], expected)
+    # No good pixels within the kernel
+    assert replaced[0, 0] == 0
+
+
+def test_difference_frames(capsys):
+    # eureka.S3_data_reduction.wfc3.difference_frames test
+    from eureka.S3_data_reduction import wfc3
+
+    rng = np.random.default_rng(1)
+    nreads, ny, nx = 5, 40, 30
+    # A scan which moves down the detector by 4 rows each read
+    flux = np.zeros((nreads, ny, nx))
+    for n in range(1, nreads):
+        flux[n] = flux[n-1]
+        flux[n, 4*n+5:4*n+12, 5:25] += 1000
+    flux += rng.normal(0, 1, flux.shape)
+    err = rng.uniform(1, 2, flux.shape)
+    err[2, 3, 7] = 50
+    time = np.arange(nreads, dtype=float)
+    data = xrio.makeDataset()
+    data['flux'] = xrio.makeFluxLikeDA(flux, time, 'electrons', 'BJD_TDB',
+                                       name='flux')
+    data['err'] = xrio.makeFluxLikeDA(err, time, 'electrons', 'BJD_TDB',
+                                      name='err')
+    meta = MetaClass()
+    meta.nreads, meta.ny, meta.nx = nreads, ny, nx
+    meta.flatmask = [np.ones((1, ny, nx))]
+    meta.flatmask[-1][0][0, 0] = 0
+    meta.diffthresh = 5
+    meta.diffmask = []
+    meta.scanHeight = []
+
+    diffdata, meta = wfc3.difference_frames(data, meta)
+
+    np.testing.assert_allclose(diffdata.flux, flux[1:]-flux[:-1])
+    np.testing.assert_allclose(diffdata.err,
+                               np.sqrt(err[1:]**2+err[:-1]**2))
+    assert diffdata.mask[0, 0, 0] == 0
+    assert diffdata.mask[1, 3, 7] == 0 and diffdata.mask[2, 3, 7] == 0
+    assert np.sum(diffdata.mask == 0) == 1*(nreads-1)+2
+    # Same guesses as taking the median row of each frame in turn
+    for n in range(nreads-1):
+        masked_data = (diffdata.flux[n]*diffdata.mask[n]).values
+        expected = np.median(np.where(masked_data > np.mean(masked_data)
+                                      )[0]).astype(int)
+        assert diffdata.guess[n] == expected
+    assert len(meta.diffmask) == 1 and len(meta.scanHeight) == 1
+
+
+def test_makeflats_cache(capsys, tmp_path, monkeypatch):
+    # eureka.S3_data_reduction.hst_scan.makeflats cache test
+    from astropy.io import fits
+    from eureka.S3_data_reduction import hst_scan
+
+    rng = np.random.default_rng(2)
+    flatfile = str(tmp_path / 'WFC3.IR.G141.flat.2.fits')
+    hdulist = fits.HDUList([fits.PrimaryHDU(rng.normal(1, 0.02, (30, 40)))]
+                           + [fits.ImageHDU(rng.normal(0, 0.01, (30, 40)))
+                              for _ in range(2)])
+    hdulist[0].header['WMIN'] = 10000.
+    hdulist[0].header['WMAX'] = 17000.
+    hdulist[0].data[5, 5] = 2
+    hdulist.writeto(flatfile)
+    cachedir = str(tmp_path / 'cache')
+    wave = [np.linspace(1.1, 1.7, 20)]
+    args = (flatfile, wave, [[0, 20]], [[0, 10]], [[3, 4]], 1, 10, 20)
+
+    expected = hst_scan.makeflats(*args, sigma=5)
+    for _ in range(2):
+        flat, mask = hst_scan.makeflats(*args, sigma=5, cachedir=cachedir)
+        np.testing.assert_array_equal(flat, expected[0])
+        np.testing.assert_array_equal(mask, expected[1])
+    assert mask[0][2, 1] == 0
+    # The second call was loaded from the cache
+    assert isinstance(flat[0], np.memmap)
+    assert len(os.listdir(cachedir)) == 2
+    # Changing the loaded frames does not change the cache
+    flat[0][:] = 0
+    flat, mask = hst_scan.makeflats(*args, sigma=5, cachedir=cachedir)
+    np.testing.assert_array_equal(flat, expected[0])
+    # Other settings make a new entry
+    hst_scan.makeflats(*args, sigma=3, cachedir=cachedir)
+    assert len(os.listdir(cachedir)) == 4
+    # Entries made by other versions of the code are not reused
+    monkeypatch.setattr(hst_scan, 'CACHE_VERSION', hst_scan.CACHE_VERSION+1)
+    hst_scan.makeflats(*args, sigma=3, cachedir=cachedir)
+    assert len(os.listdir(cachedir)) == 6
+
+
+def test_wfc3_preparation_step(capsys, tmp_path):
+    # eureka.S3_data_reduction.wfc3.preparation_step test
+    from astropy.io import fits
+    from eureka.lib import logedit
+    from eureka.S3_data_reduction import wfc3, hst_scan
+
+    rng = np.random.default_rng(4)
+    y, x = np.indices((40, 40))
+    filenames = []
+    for i, (obstype, postarg2) in enumerate([('IMAGING', 0.),
+                                             ('SPECTROSCOPIC', 1.),
+                                             ('SPECTROSCOPIC', -1.),
+                                             ('IMAGING', 0.),
+                                             ('SPECTROSCOPIC', 1.)]):
+        image = 100*np.exp(-((y-20.3-i)**2+(x-18.6)**2)/4.)
+        hdulist = fits.HDUList([fits.PrimaryHDU(),
+                                fits.ImageHDU(image+rng.normal(0, 0.1,
+                                                               image.shape))])
+        hdulist[0].header.update(OBSTYPE=obstype, EXPSTART=58000.+0.01*i,
+                                 POSTARG1=0., POSTARG2=postarg2)
+        hdulist[1].header.update(CRPIX1=10., CRPIX2=12.)
+        filenames.append(str(tmp_path / f'file{i}_ima.fits'))
+        # Write them out of order to check the sorting by time
+        hdulist.writeto(filenames[-1])
+
+    meta = MetaClass()
+    meta.segment_list = np.array(filenames[::-1])
+    meta.centroidguess = [20, 19]
+    meta.centroidtrim = 5
+    meta.verbose = False
+    meta.ncpu = 2
+    meta.cache_dir = str(tmp_path / 'cache')
+    meta, _ = wfc3.preparation_step(meta, logedit.LogBuffer())
+
+    np.testing.assert_array_equal(meta.direct_list, filenames[::3])
+    np.testing.assert_array_equal(meta.segment_list,
+                                  np.array(filenames)[[1, 2, 4]])
+    np.testing.assert_array_equal(meta.direct_index, [0, 0, 1])
+    np.testing.assert_array_equal(meta.scandir, [0, 1, 0])
+    # Same as centroiding each direct image from the files
+    expected = hst_scan.imageCentroid(meta.direct_list, meta.centroidguess,
+                                      meta.centroidtrim, 40, 10., 12.,
+                                      [0., 0., 0.], [1., -1., 1.])
+    np.testing.assert_allclose(meta.centroid, expected)
+    # The offset between the direct and science POSTARG2 is added
+    np.testing.assert_allclose(meta.centroid, [[20.3+1/0.121, 18.6],
+                                               [23.3-1/0.121, 18.6]],
+                               atol=0.05)
+    # The centroids are loaded from the cache the second time
+    cachedir = os.path.join(meta.cache_dir, 'wfc3_centroids')
+    assert len(os.listdir(cachedir)) == 2
+    meta.segment_list = np.array(filenames)
+    meta.ncpu = 1
+    meta, _ = wfc3.preparation_step(meta, logedit.LogBuffer())
+    np.testing.assert_allclose(meta.centroid, expected)
+
+
+def test_parallel_segments(capsys, tmp_path):
+    # eureka.S3_data_reduction.s3_reduce.reduce_segments_parallel test
+    from eureka.S3_data_reduction import s3_reduce
+
+    ecf_path = write_nircam_ecf(tmp_path, nseg=4, save_output=True,
+                                max_pending_writes=2)
+    spectra = []
+    fluxdata = []
+    for max_concurrent_segments in [1, 3]:
+        with open(os.path.join(ecf_path, 'S3_test.ecf'), 'a') as f:
+            f.write(f'max_concurrent_segments {max_concurrent_segments}\n')
+        spec, meta = s3_reduce.reduce('test', ecf_path)
+        assert meta.ncpu == 1
+        spectra.append(spec)
+        filenames = sorted(glob.glob(meta.outputdir+'*_FluxData_seg*.h5'))
+        assert len(filenames) == 4
+        fluxdata.append([xrio.readXR(filename) for filename in filenames])
+    for name in ['optspec', 'opterr', 'stdspec', 'optmask', 'time']:
+        np.testing.assert_array_equal(spectra[1][name], spectra[0][name])
+    for serial, parallel in zip(*fluxdata):
+        for name in ['flux', 'mask', 'bg', 'optspec']:
+            np.testing.assert_array_equal(parallel[name], serial[name])
+
+
+def test_sweep_reuse(capsys, tmp_path):
+    # eureka.S3_data_reduction.s3_reduce.reduce_sweep test
+    from eureka.S3_data_reduction import s3_reduce
+
+    ecf_path = write_nircam_ecf(tmp_path, nseg=2, spec_hw=[4, 6, 2],
+                                bg_hw=[8, 10, 2])
+    spectra = []
+    for sweep_reuse in [False, True]:
+        with open(os.path.join(ecf_path, 'S3_test.ecf'), 'a') as f:
+            f.write(f'sweep_reuse {sweep_reuse}\n')
+        _, meta = s3_reduce.reduce('test', ecf_path)
+        rundir = os.path.dirname(os.path.dirname(meta.outputdir))
+        filenames = sorted(glob.glob(os.path.join(rundir, '*',
+                                                  '*_SpecData.h5')))
+        assert [os.path.basename(os.path.dirname(filename))
+                for filename in filenames] == ['ap4_bg10', 'ap4_bg8',
+                                               'ap6_bg10', 'ap6_bg8']
+        spectra.append([xrio.readXR(filename) for filename in filenames])
+    for separate, shared in zip(*spectra):
+        for name in ['optspec', 'opterr', 'stdspec', 'optmask']:
+            np.testing.assert_array_equal(shared[name], separate[name])
+    # The background annulus changes the spectra
+    assert not np.array_equal(spectra[0][0].optspec, spectra[0][1].optspec)
+
+
+def test_int_chunk_size(capsys, tmp_path):
+    # eureka.S3_data_reduction.s3_reduce.reduce_segment_chunked test
+    from eureka.lib import logedit
+    from eureka.S3_data_reduction import s3_reduce
+
+    from astropy.io import fits
+
+    filename = str(tmp_path / 'test_calints.fits')
+    # Use enough integrations for the background outliers to be rejected,
+    # and leave their rejection to flag_bg rather than the background fit
+    basemeta = write_nircam_segment(filename, nt=30)
+    basemeta.bg_thresh = [4, 4]
+    basemeta.p3thresh = 100
+    # Add a background outlier in a later block of rows
+    with fits.open(filename, mode='update') as hdulist:
+        hdulist['SCI'].data[2, 34, 10] = 1000
+    spectra = []
+    for int_chunk_size in [None, 2, 5]:
+        meta = copy.deepcopy(basemeta)
+        meta.int_chunk_size = int_chunk_size
+        data, meta = s3_reduce.reduce_segment(xrio.makeDataset(), meta,
+                                              logedit.LogBuffer(), 0, 'test')
+        spectra.append(data)
+    # The row blocks of the outlier rejection depend on int_chunk_size
+    for chunked in spectra[1:]:
+        for name in ['medflux', 'stdspec', 'stdvar', 'optspec', 'opterr']:
+            np.testing.assert_allclose(chunked[name], spectra[0][name],
+                                       rtol=1e-6)
+        np.testing.assert_array_equal(chunked.optmask, spectra[0].optmask)
+    # The temporary files should have been removed
+    assert os.listdir(tmp_path) == ['test_calints.fits']
+
+
+def test_precision(capsys, tmp_path):
+    # eureka.S3_data_reduction.s3_reduce precision='float32' test
+    from eureka.lib import logedit
+    from eureka.S3_data_reduction import s3_reduce
+
+    filename = str(tmp_path / 'test_calints.fits')
+    basemeta = write_nircam_segment(filename)
+    basemeta.batch_optspex = True
+    expected, _ = s3_reduce.reduce_segment(xrio.makeDataset(),
+                                           copy.deepcopy(basemeta),
+                                           logedit.LogBuffer(), 0, 'test')
+    for int_chunk_size in [None, 3]:
+        meta = copy.deepcopy(basemeta)
+        meta.precision = 'float32'
+        meta.int_chunk_size = int_chunk_size
+        if int_chunk_size is None:
+            data, meta = s3_reduce.calibrate_segment(
+                xrio.makeDataset(), meta, logedit.LogBuffer(), 0)
+            data, meta = s3_reduce.subtract_background(
+                data, meta, logedit.LogBuffer(), 0)
+            for name in ['flux', 'err', 'v0', 'bg']:
+                assert data[name].dtype == np.float32
+            data, meta = s3_reduce.extract_segment(data, meta,
+                                                   logedit.LogBuffer(), 0,
+                                                   'test')
+        else:
+            data, meta = s3_reduce.reduce_segment(xrio.makeDataset(), meta,
+                                                  logedit.LogBuffer(), 0,
+                                                  'test')
+        for name in ['stdspec', 'stdvar', 'optspec', 'opterr']:
+            assert data[name].dtype == np.float32
+            np.testing.assert_allclose(data[name], expected[name],
+                                       rtol=1e-5)
+        np.testing.assert_array_equal(data.optmask, expected.optmask)
+
+
+def test_maskflags(capsys, tmp_path):
+    # eureka.lib.maskflags test
+    from eureka.lib import logedit, maskflags
+    from eureka.S3_data_reduction import s3_reduce
+
+    from astropy.io import fits
+
+    filename = str(tmp_path / 'test_calints.fits')
+    meta = write_nircam_segment(filename)
+    log = logedit.LogBuffer()
+    data, meta = s3_reduce.calibrate_segment(xrio.makeDataset(), meta, log,
+                                             0)
+    assert data.mask.dtype == np.uint8
+    # The NaN pixel (the frames are trimmed by 2 rows and 1 column)
+    assert data.mask.values[4, 28, 1] == maskflags.NAN
+    # The manually masked region
+    assert np.all(data.mask.values[1:3, 10:12] & maskflags.MANUAL)
+    data, meta = s3_reduce.subtract_background(data, meta, log, 0)
+    # The hot pixel in the background region
+    assert data.mask.values[3, 3, 6] in [maskflags.BG_OUTLIER,
+                                         maskflags.BG_FIT]
+    # Add a cosmic ray in the spectral aperture
+    data['flux'].values[2, meta.src_ypos, 10] += 500
+    # The extraction updates the mask in place before removing it from data
+    mask = data.mask.values
+    flags = mask.copy()
+    data, meta = s3_reduce.extract_segment(data, meta, log, 0, 'test')
+    assert flags[2, meta.src_ypos, 10] == 0
+    assert mask[2, meta.src_ypos, 10] == maskflags.OPTSPEX
+    # Earlier flags are kept
+    assert np.all(mask[flags != 0] == flags[flags != 0])
+
+    # The chunked reduction saves the same flags in its FluxData files
+    src_ypos = meta.src_ypos
+    filename = str(tmp_path / 'test_cr_calints.fits')
+    basemeta = write_nircam_segment(filename)
+    with fits.open(filename, mode='update') as hdulist:
+        hdulist['SCI'].data[2, src_ypos+2, 11] += 500
+    masks = []
+    for int_chunk_size in [None, 3]:
+        meta = copy.deepcopy(basemeta)
+        meta.save_output = True
+        meta.int_chunk_size = int_chunk_size
+        meta.outputdir = str(tmp_path / str(int_chunk_size))+os.sep
+        os.mkdir(meta.outputdir)
+        s3_reduce.reduce_segment(xrio.makeDataset(), meta, log, 0, 'test')
+        # The chunked reduction saves the 3D arrays in its chunk files
+        pattern = '*_FluxData_seg0001'+('_chunk*' if int_chunk_size else '')
+        filenames = sorted(glob.glob(meta.outputdir+pattern+'.h5'))
+        masks.append(np.concatenate([xrio.readXR(filename).mask.values
+                                     for filename in filenames]))
+    assert masks[0][2, src_ypos, 10] == maskflags.OPTSPEX
+    np.testing.assert_array_equal(masks[1], masks[0])
+
+
+def test_stepcache(capsys, tmp_path, monkeypatch):
+    # eureka.S3_data_reduction.stepcache test
+    from eureka.lib import logedit
+    from eureka.S3_data_reduction import s3_reduce, stepcache
+
+    filename = str(tmp_path / 'test_calints.fits')
+    basemeta = write_nircam_segment(filename)
+    basemeta.cache_dir = str(tmp_path / 'cache')
+
+    def reduce(**kwargs):
+        meta = copy.deepcopy(basemeta)
+        for key, value in kwargs.items():
+            setattr(meta, key, value)
+        log = logedit.LogBuffer()
+        data, meta = s3_reduce.reduce_segment(xrio.makeDataset(), meta, log,
+                                              0, 'test')
+        reused = [message.split()[3] for message, _, _ in log.messages
+                  if message.startswith('  Reusing')]
+        return data, meta, reused
+
+    expected, expected_meta, reused = reduce()
+    assert reused == []
+    assert len(os.listdir(basemeta.cache_dir)) == 2
+    data, meta, reused = reduce()
+    assert reused == ['calibrate', 'background']
+    np.testing.assert_array_equal(data.optspec, expected.optspec)
+    assert meta.src_ypos == expected_meta.src_ypos
+    assert meta.n_int == expected_meta.n_int
+    # Only the extraction depends on p7thresh
+    _, _, reused = reduce(p7thresh=5)
+    assert reused == ['calibrate', 'background']
+    # The background subtraction depends on bg_hw
+    _, _, reused = reduce(bg_hw=7)
+    assert reused == ['calibrate']
+    assert len(os.listdir(basemeta.cache_dir)) == 3
+    # Everything is redone if the input file changes
+    os.utime(filename, ns=(0, 0))
+    _, _, reused = reduce()
+    assert reused == []
+    assert len(os.listdir(basemeta.cache_dir)) == 5
+    # and if the cached outputs change with the code
+    monkeypatch.setattr(stepcache, 'CACHE_VERSION',
+                        stepcache.CACHE_VERSION+1)
+    _, _, reused = reduce()
+    assert reused == []
+    assert len(os.listdir(basemeta.cache_dir)) == 7
+
+    # Only keep the most recently used entries
+    sizes = [os.path.getsize(os.path.join(basemeta.cache_dir, name))
+             for name in os.listdir(basemeta.cache_dir)]
+    reduce(cache_max_size=1.5*max(sizes)/1e9, bg_hw=6)
+    assert sorted(name.split('_')[0]
+                  for name in os.listdir(basemeta.cache_dir)) == \
+        ['background']
+
+
+def test_resume(capsys, tmp_path):
+    # eureka.S3_data_reduction.checkpoint test
+    from eureka.lib import logedit
+    from eureka.S3_data_reduction import s3_reduce, stepcache, checkpoint
+
+    filenames = [str(tmp_path / f'seg{m}_calints.fits') for m in range(3)]
+    for m, filename in enumerate(filenames):
+        meta = write_nircam_segment(filename, seed=m)
+    meta.segment_list = filenames
+    meta.num_data_files = 3
+    meta.topdir = str(tmp_path)
+    meta.outputdir_raw = 'out'
+    meta.eventlabel = 'test'
+    config = checkpoint.config_key(meta)
+    rundir = str(tmp_path / 'out' / 'S3_2022-07-01_test_run2')
+    meta.outputdir = rundir+os.sep
+    os.makedirs(rundir)
+    assert checkpoint.find_run(meta, config) is None
+
+    checkpoints = checkpoint.Checkpoint(rundir, config)
+    results = []
+    for m in [0, 2]:
+        before = stepcache.snapshot(meta)
+        data, meta = s3_reduce.reduce_segment(xrio.makeDataset(), meta,
+                                              logedit.LogBuffer(), m, 'test')
+        checkpoints.save(meta, 'test', m, data,
+                         stepcache.get_changes(meta, before))
+        results.append(data)
+    assert checkpoint.find_run(meta, config) == ('2022-07-01', 2)
+
+    # Only the segments before the first unfinished one are reused
+    done = checkpoint.Checkpoint(rundir, config).load(meta, 'test',
+                                                      range(3))
+    assert len(done) == 1
+    np.testing.assert_array_equal(done[0][0].optspec, results[0].optspec)
+    assert done[0][1]['n_int'] == 7
+    assert len(checkpoint.Checkpoint(rundir, config).load(
+        meta, 'test', range(2, 3))) == 1
+    # Segments are redone if their input file changes
+    os.utime(filenames[0], ns=(0, 0))
+    assert checkpoint.Checkpoint(rundir, config).load(
+        meta, 'test', range(3)) == []
+    # Runs made with other settings are not resumed
+    meta.p7thresh = 5
+    assert checkpoint.config_key(meta) != config
+    assert checkpoint.find_run(meta, checkpoint.config_key(meta)) is None
+    assert checkpoint.Checkpoint(rundir, checkpoint.config_key(
+        meta)).load(meta, 'test', range(2, 3)) == []
+
+
+def test_medianframe(capsys, tmp_path):
+    # eureka.lib.medianframe test
+    from eureka.lib import logedit, medianframe
+    from eureka.S3_data_reduction import s3_reduce
+
+    rng = np.random.default_rng(0)
+    cube = rng.normal(5, 1, (500, 12, 8))
+    cube[3, 2, 2] = np.nan
+    medframe = medianframe.MedianFrame(cube)
+    for start, stop in [(4, 7), (2, 9), (-3, 20), (3, 5)]:
+        np.testing.assert_array_equal(medframe.rows(start, stop),
+                                      np.median(cube[:, start:stop], axis=0))
+    # Nested regions are views of the rows computed so far
+    assert np.shares_memory(medframe.rows(3, 5), medframe.median)
+
+    streaming = medianframe.StreamingMedian(cube.shape[1:])
+    streaming.update(cube[:4])
+    # Exact for up to five integrations
+    np.testing.assert_array_equal(streaming.result(),
+                                  np.median(cube[:4], axis=0))
+    streaming.update(cube[4:])
+    np.testing.assert_allclose(streaming.result(),
+                               np.median(cube, axis=0), atol=0.2)
+    assert np.isnan(streaming.result()[2, 2])
+
+    # The streaming median of the aperture in chunked mode
+    filename = str(tmp_path / 'test_calints.fits')
+    basemeta = write_nircam_segment(filename, nt=20)
+    spectra = []
+    for int_chunk_size, median_method in [(None, 'exact'), (3, 'p2')]:
+        meta = copy.deepcopy(basemeta)
+        meta.int_chunk_size = int_chunk_size
+        meta.median_method = median_method
+        data, meta = s3_reduce.reduce_segment(xrio.makeDataset(), meta,
+                                              logedit.LogBuffer(), 0, 'test')
+        spectra.append(data)
+    np.testing.assert_allclose(spectra[1].optspec, spectra[0].optspec,
+                               rtol=0.01)
+
+
+def test_ancil_cache(capsys, tmp_path):
+    # eureka.S3_data_reduction.bright2flux reference file cache test
+    from astropy.io import fits
+    from eureka.lib import logedit
+    from eureka.S3_data_reduction import s3_reduce
+    from eureka.S3_data_reduction import bright2flux as b2f
+
+    # A local directory of reference files standing in for CRDS
+    ancil_dir = tmp_path / 'refs'
+    ancil_dir.mkdir()
+    gain = np.arange(40*30, dtype=float).reshape(40, 30)/1000 + 1
+    for name, useafter, value in [('gain_old', '2000-01-01T00:00:00', 3),
+                                  ('gain', '2020-01-01T00:00:00', gain),
+                                  ('gain_new', '2030-01-01T00:00:00', 5)]:
+        header = fits.Header({'REFTYPE': 'GAIN', 'INSTRUME': 'NIRCAM',
+                              'DETECTOR': 'NRCALONG', 'USEAFTER': useafter})
+        fits.PrimaryHDU(np.zeros((40, 30))+value, header).writeto(
+            str(ancil_dir / f'{name}.fits'))
+    header = fits.Header({'REFTYPE': 'PHOTOM', 'INSTRUME': 'NIRCAM',
+                          'EXP_TYPE': 'NRC_IMAGE|NRC_TSGRISM',
+                          'USEAFTER': '2000-01-01T00:00:00'})
+    table = fits.BinTableHDU.from_columns([
+        fits.Column(name='filter', format='6A',
+                    array=['F322W2', 'F322W2']),
+        fits.Column(name='pupil', format='6A', array=['GRISMR', 'GRISMR']),
+        fits.Column(name='order', format='J', array=[1, 2]),
+        fits.Column(name='wavelength', format='5D',
+                    array=[np.linspace(1, 5, 5)]*2),
+        fits.Column(name='relresponse', format='5D',
+                    array=[np.ones(5), 2*np.ones(5)])])
+    fits.HDUList([fits.PrimaryHDU(header=header), table]).writeto(
+        str(ancil_dir / 'photom.fits'))
+
+    b2f._ancil_cache.clear()
+    b2f.load_gain.cache_clear()
+    b2f.load_response.cache_clear()
+    electrons = str(tmp_path / 'electrons_calints.fits')
+    expected = s3_reduce.calibrate_segment(
+        xrio.makeDataset(), write_nircam_segment(electrons),
+        logedit.LogBuffer(), 0)[0]
+    for i in range(2):
+        filename = str(tmp_path / f'seg{i}_calints.fits')
+        meta = write_nircam_segment(filename, bunit='MJy/sr')
+        meta.ancil_dir = str(ancil_dir)
+        data, meta = s3_reduce.calibrate_segment(
+            xrio.makeDataset(), meta, logedit.LogBuffer(), 0)
+        assert meta.gainfile == str(ancil_dir / 'gain.fits')
+        assert meta.photfile == str(ancil_dir / 'photom.fits')
+        # MJy/sr / PHOTMJSR * gain, instead of ELECTRONS/S
+        subgain = gain[meta.ywindow[0]:meta.ywindow[1],
+                       meta.xwindow[0]:meta.xwindow[1]]
+        np.testing.assert_allclose(data.flux, expected.flux*subgain/4)
+    # The reference files were only looked up and read once
+    assert len(b2f._ancil_cache) == 1
+    assert b2f.load_gain.cache_info().misses == 1
+    assert b2f.load_gain.cache_info().hits == 1
+    assert b2f.load_response.cache_info().misses == 1
+
+
+def test_plotqueue(capsys, tmp_path):
+    # eureka.lib.plotqueue test
+    from eureka.lib import logedit, plotqueue
+    from eureka.S3_data_reduction import s3_reduce
+
+    filename = str(tmp_path / 'test_calints.fits')
+    basemeta = write_nircam_segment(filename)
+    basemeta.isplots_S3 = 3
+    basemeta.plot_every = 4
+    figures = []
+    for plot_ncpu in [0, 2]:
+        meta = copy.deepcopy(basemeta)
+        meta.outputdir = str(tmp_path / f'ncpu{plot_ncpu}')+os.sep
+        os.makedirs(meta.outputdir+'figs')
+        plotter = plotqueue.start(plot_ncpu)
+        s3_reduce.reduce_segment(xrio.makeDataset(), meta,
+                                 logedit.LogBuffer(), 0, 'test')
+        if plotter is not None:
+            plotter.close()
+        figures.append(sorted(os.listdir(meta.outputdir+'figs')))
+    # Every figure has been saved by the renderer processes
+    assert figures[1] == figures[0]
+    # Only every fourth integration is plotted
+    assert [name for name in figures[0] if name.startswith('fig3301')] == \
+        [f'fig3301_file0_int{n}_ImageAndBackground.png' for n in [0, 4]]
+    assert plotqueue._active is None
+
+
+def test_segment_prefetcher(capsys, tmp_path):
+    # eureka.S3_data_reduction.s3_reduce.SegmentPrefetcher test
+    from eureka.lib import logedit
+    from eureka.S3_data_reduction import s3_reduce
+
+    segment_list = []
+    for m in range(4):
+        filename = str(tmp_path / f'test{m}_calints.fits')
+        meta = write_nircam_segment(filename, seed=m)
+        segment_list.append(filename)
+    meta.segment_list = segment_list
+    meta.num_data_files = len(segment_list)
+
+    prefetcher = s3_reduce.SegmentPrefetcher(meta, [1, 2, 3], depth=2)
+    # Only depth segments are read ahead at once
+    assert sorted(prefetcher.futures) == [1, 2]
+    for m in [1, 2]:
+        prefetched = prefetcher.get(m)
+        assert prefetched.attrs['filename'] == segment_list[m]
+        data, _ = s3_reduce.reduce_segment(prefetched, meta,
+                                           logedit.LogBuffer(), m, 'test')
+        expected, _ = s3_reduce.reduce_segment(xrio.makeDataset(), meta,
+                                               logedit.LogBuffer(), m,
+                                               'test')
+        np.testing.assert_array_equal(data.optspec, expected.optspec)
+    assert sorted(prefetcher.futures) == [3]
+    # Unused segments are dropped
+    prefetcher.close()
+    assert prefetcher.futures == {}
+
+    # Only as many segments as fit in max_size are read ahead at once
+    size = os.path.getsize(segment_list[1])/1e9
+    prefetcher = s3_reduce.SegmentPrefetcher(meta, [1, 2, 3], depth=2,
+                                             max_size=1.5*size)
+    assert sorted(prefetcher.futures) == [1]
+    prefetcher.get(1)
+    assert sorted(prefetcher.futures) == [2]
+    prefetcher.close()
+    # The next segment is still read ahead when it is too large on its own
+    prefetcher = s3_reduce.SegmentPrefetcher(meta, [1, 2, 3], depth=2,
+                                             max_size=0.5*size)
+    assert sorted(prefetcher.futures) == [1]
+    for m in [1, 2, 3]:
+        prefetched = prefetcher.get(m)
+        assert prefetched.attrs['filename'] == segment_list[m]
+        assert sorted(prefetcher.futures) == ([m+1] if m < 3 else [])
+    prefetcher.close()
+
+
+def test_output_writer(capsys, tmp_path):
+    # eureka.lib.outputwriter test
+    import h5py
+    from eureka.lib import logedit, outputwriter
+    from eureka.S3_data_reduction import s3_reduce
+
+    filename = str(tmp_path / 'test_calints.fits')
+    meta = write_nircam_segment(filename)
+    meta.save_output = True
+    meta.outputdir = str(tmp_path / 'sync')+os.sep
+    os.mkdir(meta.outputdir)
+    expected, _ = s3_reduce.reduce_segment(xrio.makeDataset(),
+                                           copy.deepcopy(meta),
+                                           logedit.LogBuffer(), 0, 'test')
+
+    meta.outputdir = str(tmp_path / 'async')+os.sep
+    os.mkdir(meta.outputdir)
+    meta.output_compression = 'gzip'
+    with outputwriter.OutputWriter(1) as writer:
+        data, _ = s3_reduce.reduce_segment(xrio.makeDataset(),
+                                           copy.deepcopy(meta),
+                                           logedit.LogBuffer(), 0, 'test',
+                                           writer=writer)
+    np.testing.assert_array_equal(data.optspec, expected.optspec)
+    # The headers are dropped just like when writing right away
+    assert sorted(data.attrs) == sorted(expected.attrs)
+
+    fluxname = 'S3_test_FluxData_seg0001.h5'
+    sync = xrio.readXR(str(tmp_path / 'sync' / fluxname))
+    compressed = xrio.readXR(str(tmp_path / 'async' / fluxname))
+    for name in ['flux', 'mask', 'optspec']:
+        np.testing.assert_array_equal(compressed[name], sync[name])
+    with h5py.File(str(tmp_path / 'async' / fluxname), 'r') as f:
+        # One integration per chunk
+        assert f['flux'].chunks == (1,)+f['flux'].shape[1:]
+        assert f['flux'].compression == 'gzip'
+
+    # Errors on the background thread are raised when flushing
+    writer = outputwriter.OutputWriter(1)
+    writer.submit(outputwriter.get_encoding, data, 'unknown')
+    try:
+        writer.flush()
+        assert False
+    except ValueError:
+        pass
+    writer.close()